@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# benchmark.py - Compare tsv2 parsers on synthetic beeline output
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+# http://www.gnu.org/copyleft/gpl.html
+
+"""Time the per-line and bulk hive tsv2 parsers against each other
+
+Usage:
+
+    python -m relforge.benchmark --rows 10000000
+"""
+
+import argparse
+import random
+import sys
+import time
+
+import pandas as pd
+
+from relforge.query import Hive
+
+try:
+    xrange(1)
+except NameError:
+    xrange = range
+
+PROMPT = '0: jdbc:hive2://benchmark:10000> '
+
+
+def make_beeline_output(R, num_rows, tab_frac=0.05, null_frac=0.01):
+    """Generate lines of beeline tsv2 output for a click extraction style query
+
+    Columns hold a query string, a page id, a hit position and a session
+    id. A portion of query strings contain a tab, and are quoted with null
+    bytes, and a portion of rows have a NULL page id.
+    """
+    lines = [PROMPT + 'SELECT query, page_id, hit_pos, session_id FROM ...',
+             'query\tpage_id\thit_pos\tsession_id']
+    for i in xrange(num_rows):
+        query = 'query %d' % (R.randint(0, num_rows))
+        if R.random() < tab_frac:
+            query = '\0' + query.replace(' ', '\t') + '\0'
+        page_id = 'NULL' if R.random() < null_frac else str(R.randint(0, 1000000))
+        lines.append('\t'.join([query, page_id, str(R.randint(0, 20)), 'session %d' % (i // 5)]))
+    lines.append(PROMPT)
+    return lines
+
+
+def time_parser(label, fn, lines):
+    start = time.time()
+    df = fn(list(lines))
+    took = time.time() - start
+    print('%-24s %8.2fs %10.0f rows/s' % (label, took, len(df) / took if took > 0 else 0.))
+    return df, took
+
+
+def parse_lines(lines):
+    return pd.DataFrame(list(Hive({}).parse(lines)))
+
+
+def parse_frames(chunk_size):
+    def fn(lines):
+        return pd.concat(list(Hive({}).parse_frames(lines, chunk_size)), ignore_index=True)
+    return fn
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark hive tsv2 parsers', prog=sys.argv[0])
+    parser.add_argument(
+        '-r', '--rows', dest='num_rows', type=int, default=1000000,
+        help='Number of synthetic result rows to parse, default is 1000000')
+    parser.add_argument(
+        '-c', '--chunk-size', dest='chunk_size', type=int, default=100000,
+        help='Rows per chunk for the bulk parser, default is 100000')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=0, help='Random seed')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    print('Generating %d rows of beeline output' % (args.num_rows))
+    lines = make_beeline_output(random.Random(args.seed), args.num_rows)
+
+    bulk_df, bulk_took = time_parser('tsv2 (bulk)', parse_frames(args.chunk_size), lines)
+    line_df, line_took = time_parser('tsv2 (per line)', parse_lines, lines)
+    print('%-24s %8.1fx speedup, outputs %s' % (
+        '', line_took / bulk_took,
+        'match' if line_df.equals(bulk_df) else 'DIFFER'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
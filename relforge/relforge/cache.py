@@ -0,0 +1,262 @@
+# cache.py - Columnar on-disk cache of query results
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+# http://www.gnu.org/copyleft/gpl.html
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    # py 2.x
+    text_type = unicode
+except NameError:
+    # py 3.x
+    text_type = str
+
+LOG = logging.getLogger(__name__)
+
+# Separates values of string columns. Values coming from the query providers
+# are split from newline delimited output and never contain a null byte.
+STRING_SEPARATOR = u'\0'
+
+
+class QueryCache(object):
+    """Columnar on-disk cache of query results
+
+    Each entry is a directory holding one .npy file per column and a small
+    json metadata file. Numeric columns are stored as int64 or float64 arrays,
+    string columns as the utf-8 encoding of all values joined by a null byte.
+    Columns are memory-mapped on load and never unpickled.
+
+    Entries are keyed by a hash of the query text and SCHEMA_VERSION. Bumping
+    the version invalidates every previously cached entry, which is removed
+    on the next eviction pass.
+
+    Parameters
+    ----------
+    cache_dir : str
+    max_age : float or None
+        Entries older than this many seconds are evicted.
+    max_bytes : int or None
+        Least recently used entries are evicted while the cache is larger
+        than this.
+    """
+    SCHEMA_VERSION = 1
+    META_FILE = 'meta.json'
+
+    def __init__(self, cache_dir, max_age=None, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.load_sec = 0.
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'load_sec': self.load_sec,
+        }
+
+    def key(self, query):
+        query_hash = hashlib.md5(query.encode('utf8')).hexdigest()
+        return '{}.v{}'.format(query_hash, self.SCHEMA_VERSION)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """Load cached columns
+
+        Returns
+        -------
+        list of np.ndarray or list, or None
+            One entry per column, or None if the key is not cached or has
+            expired. Numeric columns are read-only memory-mapped arrays,
+            string columns are lists of str.
+        """
+        start = time.time()
+        path = self._entry_path(key)
+        try:
+            with open(os.path.join(path, self.META_FILE)) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            LOG.debug('No cached query result available.')
+            return None
+        if meta.get('version') != self.SCHEMA_VERSION:
+            self.misses += 1
+            LOG.debug('Ignoring cached query result with schema version %s', meta.get('version'))
+            return None
+        if self._expired(meta['created'], start):
+            self.misses += 1
+            LOG.debug('Evicting expired cache entry %s', path)
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        columns = []
+        for i, kind in enumerate(meta['kinds']):
+            data = np.load(os.path.join(path, 'col{}.npy'.format(i)), mmap_mode='r', allow_pickle=False)
+            if kind == 'str':
+                columns.append(decode_strings(data, meta['rows']))
+            else:
+                columns.append(data)
+        # Track last use for size based eviction
+        os.utime(os.path.join(path, self.META_FILE), None)
+
+        took = time.time() - start
+        self.hits += 1
+        self.load_sec += took
+        LOG.info('Loaded %d cached query rows in %.2fs', meta['rows'], took)
+        return columns
+
+    def put(self, key, rows):
+        """Store rows in the cache
+
+        Parameters
+        ----------
+        key : str
+        rows : list of tuple
+
+        Returns
+        -------
+        bool
+            True if the rows were cached. Rows containing values that are
+            not strings or numbers can't be stored and are not cached.
+        """
+        columns = list(zip(*rows))
+        kinds = [column_kind(column) for column in columns]
+        if None in kinds:
+            LOG.warning('Query result has values that cannot be cached')
+            return False
+
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                LOG.debug("cache directory created since checking")
+
+        # Write into a temporary directory and rename into place so
+        # readers never see a partial entry.
+        tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache_dir)
+        try:
+            for i, (kind, column) in enumerate(zip(kinds, columns)):
+                if kind == 'str':
+                    data = encode_strings(column)
+                else:
+                    data = np.asarray(column, dtype=kind)
+                np.save(os.path.join(tmp_path, 'col{}.npy'.format(i)), data, allow_pickle=False)
+            with open(os.path.join(tmp_path, self.META_FILE), 'w') as f:
+                json.dump({
+                    'version': self.SCHEMA_VERSION,
+                    'rows': len(rows),
+                    'kinds': kinds,
+                    'created': time.time(),
+                }, f)
+            path = self._entry_path(key)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+        except:  # noqa: E722
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        self.evict()
+        return True
+
+    def _entries(self):
+        """List (path, created, last_used, size) of all cache entries"""
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return []
+        entries = []
+        for name in names:
+            path = self._entry_path(name)
+            meta_path = os.path.join(path, self.META_FILE)
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                last_used = os.path.getmtime(meta_path)
+                size = sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path))
+            except (IOError, OSError, ValueError):
+                # Not a cache entry, or one being written right now
+                continue
+            if meta.get('version') != self.SCHEMA_VERSION:
+                created = None
+            else:
+                created = meta['created']
+            entries.append((path, created, last_used, size))
+        return entries
+
+    def _expired(self, created, now):
+        return self.max_age is not None and now - created > self.max_age
+
+    def evict(self):
+        """Remove outdated, expired and least recently used entries"""
+        now = time.time()
+        keep = []
+        for path, created, last_used, size in self._entries():
+            if created is None or self._expired(created, now):
+                LOG.debug('Evicting cache entry %s', path)
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                keep.append((last_used, size, path))
+
+        if self.max_bytes is not None:
+            total = sum(size for _, size, _ in keep)
+            for _, size, path in sorted(keep):
+                if total <= self.max_bytes:
+                    break
+                LOG.debug('Evicting cache entry %s', path)
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+
+def column_kind(column):
+    """Choose the storage type of a column of values
+
+    Returns
+    -------
+    str or None
+        'int64', 'float64' or 'str'. None if the column can't be stored.
+    """
+    types = set(type(x) for x in column)
+    if types <= {int}:
+        return 'int64'
+    if types <= {int, float}:
+        return 'float64'
+    if types <= {str, text_type}:
+        if any(STRING_SEPARATOR in x for x in column):
+            return None
+        return 'str'
+    return None
+
+
+def encode_strings(column):
+    encoded = STRING_SEPARATOR.join(column).encode('utf8')
+    return np.frombuffer(encoded, dtype=np.uint8)
+
+
+def decode_strings(data, num_rows):
+    if num_rows == 0:
+        return []
+    return data.tobytes().decode('utf8').split(STRING_SEPARATOR)
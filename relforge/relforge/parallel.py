@@ -0,0 +1,39 @@
+# parallel.py - Ordered maps over pools of worker processes
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+# http://www.gnu.org/copyleft/gpl.html
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+def map_ordered(fn, items, workers=1):
+    """Apply fn to items from a process pool, yielding results in input order
+
+    With workers > 1 at most 2 * workers items are in flight, or waiting
+    to be yielded, at any time, so items are read from the input only as
+    results are consumed. Otherwise fn runs in the calling process. fn
+    and the items must be picklable.
+    """
+    if workers <= 1:
+        for item in items:
+            yield fn(item)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -15,21 +15,28 @@
 # http://www.gnu.org/copyleft/gpl.html
 
 import codecs
+import csv
+import functools
+import io
+import itertools
 try:
     # py 3.x
     import configparser
 except ImportError:
     # py 2.x
     import ConfigParser as configparser
-import hashlib
 import logging
+import numpy as np
 import os
 import pandas as pd
-import pickle
 import pipes
 import subprocess
+import threading
+import time
 import yaml
 
+from relforge.cache import QueryCache
+
 try:
     # py 2.x
     unicode()
@@ -115,14 +122,75 @@ class Hive(object):
         if prefix is not None:
             raise Exception('Malformed input without \\0 terminator: {}'.format(repr(line)))
 
+    def _detect_prompt(self, line):
+        prompt = line.split('>', 1)[0] + '> '
+        LOG.debug('Detected prompt as: %s', prompt)
+        return prompt
+
+    def decode_tsv2(self, text):
+        """Decode a buffer of tsv2 output lines from beeline at once
+
+        Equivalent to parse_tsv2_line over each line, but the splitting
+        and null byte quote handling is done by the pandas C tokenizer
+        over the whole buffer. Rows containing NULL values are thrown out.
+
+        Parameters
+        ----------
+        text : str
+            Newline separated tsv2 lines, without header or prompts
+
+        Returns
+        -------
+        pd.DataFrame
+            One str column per tsv2 column, labeled by position.
+        """
+        df = pd.read_csv(
+            io.StringIO(text), sep='\t', header=None,
+            quotechar='\0', quoting=csv.QUOTE_MINIMAL, doublequote=False,
+            dtype=str, keep_default_na=False, na_values=['NULL'])
+        has_null = df.isnull().any(axis=1)
+        if has_null.any():
+            LOG.debug('Throwing out %d lines with null values', has_null.sum())
+            df = df[~has_null].reset_index(drop=True)
+        return df
+
+    def _with_prompt(self, parse, lines):
+        """Detect the prompt from the first line, which echos the query"""
+        lines = iter(lines)
+        for first_line in lines:
+            prompt = self._detect_prompt(first_line)
+            for item in parse(prompt, itertools.chain([first_line], lines)):
+                yield item
+            break
+
     def parse(self, cmd_output):
         # Beeline isn't made for this, so we get some mediocre output
         # to parse through. If we could pass the command instead of
         # piping it in it would be slightly better, but have length
         # problems.
         # Guess what the prompt looks like from the first line
-        prompt = cmd_output.pop().split('>', 1)[0] + '> '
-        LOG.debug('Detected prompt as: %s', prompt)
+        prompt = self._detect_prompt(cmd_output.pop())
+        return self._parse_lines(prompt, cmd_output)
+
+    def parse_stream(self, lines):
+        """Parse beeline output as it arrives
+
+        The final prompt is not available until the command completes, so
+        the prompt is detected from the first line which echos the query.
+        """
+        return self._with_prompt(self._parse_lines, lines)
+
+    def parse_frames(self, cmd_output, chunk_size):
+        """Parse beeline output into DataFrames of up to chunk_size rows"""
+        prompt = self._detect_prompt(cmd_output.pop())
+        return self._parse_frames(prompt, cmd_output, chunk_size)
+
+    def parse_stream_frames(self, lines, chunk_size):
+        """Parse beeline output into DataFrames as it arrives"""
+        return self._with_prompt(
+            functools.partial(self._parse_frames, chunk_size=chunk_size), lines)
+
+    def _parse_lines(self, prompt, cmd_output):
         in_results = False
         for line in cmd_output:
             has_prompt = line.startswith(prompt)
@@ -136,17 +204,48 @@ class Hive(object):
                     LOG.debug('skipping line: %s', line)
                     continue
             elif in_results:
+                if not line:
+                    # Blank lines, typically before the final prompt
+                    continue
                 cols = list(self.parse_tsv2_line(line))
                 if any(x is None for x in cols):
-                    LOG.debug('Throwing out line with null values: %s', repr(line))
+                    LOG.debug('Throwing out line with null values: %r', line)
                 else:
-                    LOG.debug('Yielding query row: %s', cols)
                     yield cols
             else:
                 header = list(self.parse_tsv2_line(line))
                 LOG.debug('Found results section with header: %s', header)
                 in_results = True
 
+    def _parse_frames(self, prompt, cmd_output, chunk_size):
+        cmd_output = iter(cmd_output)
+        for line in cmd_output:
+            if line.startswith(prompt):
+                LOG.debug('skipping line: %s', line)
+                continue
+            header = list(self.parse_tsv2_line(line))
+            LOG.debug('Found results section with header: %s', header)
+            break
+        else:
+            return
+
+        # Rather than checking each result line for the trailing prompt,
+        # join a chunk of lines and search the whole buffer at once.
+        marker = '\n' + prompt
+        while True:
+            chunk = list(itertools.islice(cmd_output, chunk_size))
+            if not chunk:
+                return
+            text = '\n' + '\n'.join(chunk)
+            end = text.find(marker)
+            if end >= 0:
+                LOG.debug('Found junk, stop looking: %s', text[end + 1:].split('\n', 1)[0])
+                text = text[:end]
+            if text.strip():
+                yield self.decode_tsv2(text[1:])
+            if end >= 0:
+                return
+
 
 class DummyProvider(object):
     def __init__(self, config):
@@ -161,6 +260,14 @@ class DummyProvider(object):
     def parse(self, cmd_output):
         return self.results
 
+    def parse_stream(self, lines):
+        return self.results
+
+    def parse_frames(self, cmd_output, chunk_size):
+        return rows_to_frames(self.results, chunk_size)
+
+    parse_stream_frames = parse_frames
+
 
 class MySql(object):
     def __init__(self, config):
@@ -189,8 +296,9 @@ class MySql(object):
         return command
 
     def parse(self, cmd_output):
+        cmd_output = iter(cmd_output)
         # burn the header
-        cmd_output.pop(0)
+        next(cmd_output, None)
         for line in cmd_output:
             if len(line) == 0:
                 continue
@@ -199,16 +307,138 @@ class MySql(object):
                 score = 0.
             yield query, title, float(score)
 
+    # parse already consumes output in order
+    parse_stream = parse
 
-def execute_remote(remote_host, cli_command, input):
+    def parse_frames(self, cmd_output, chunk_size):
+        return rows_to_frames(self.parse(cmd_output), chunk_size)
+
+    parse_stream_frames = parse_frames
+
+
+def rows_to_frames(rows, chunk_size):
+    """Collect parsed rows into DataFrames of up to chunk_size rows"""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield pd.DataFrame(chunk)
+
+
+def _remote_popen(remote_host, cli_command):
     command = cli_command.to_shell_string()
-    p = subprocess.Popen(['ssh', '-o', 'Compression=yes', remote_host, command],
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
+    return subprocess.Popen(['ssh', '-o', 'Compression=yes', remote_host, command],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+
+
+def execute_remote(remote_host, cli_command, input):
+    p = _remote_popen(remote_host, cli_command)
     stdout, stderr = p.communicate(input=input)
     return stdout, stderr, p.returncode
 
 
+class FetchProgress(object):
+    """Progress and throughput counters for a streaming fetch
+
+    Counters are updated as output is read and parsed, and logged
+    every log_interval seconds.
+    """
+    def __init__(self, log_interval=30.):
+        self.log_interval = log_interval
+        self.bytes = 0
+        self.lines = 0
+        self.rows = 0
+        self.start = time.time()
+        self._last_log = self.start
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    def _rate(self, count):
+        elapsed = self.elapsed
+        return count / elapsed if elapsed > 0 else 0.
+
+    @property
+    def summary(self):
+        return {
+            'bytes': self.bytes,
+            'lines': self.lines,
+            'rows': self.rows,
+            'elapsed_sec': self.elapsed,
+            'bytes_per_sec': self._rate(self.bytes),
+            'rows_per_sec': self._rate(self.rows),
+        }
+
+    def add_line(self, num_bytes):
+        self.bytes += num_bytes
+        self.lines += 1
+
+    def add_row(self, count=1):
+        self.rows += count
+        now = time.time()
+        if now - self._last_log >= self.log_interval:
+            self._last_log = now
+            self.log()
+
+    def log(self):
+        LOG.info('Fetched %d rows (%.1f MB) in %.1fs: %.0f rows/s, %.2f MB/s',
+                 self.rows, self.bytes / 1e6, self.elapsed,
+                 self._rate(self.rows), self._rate(self.bytes) / 1e6)
+
+
+class RemoteCommandStream(object):
+    """Run a command on a remote host, iterating over its stdout lines
+
+    Input is written and stderr collected from background threads so the
+    remote command never blocks on a full pipe while stdout is read. The
+    return code and stderr are available once iteration completes.
+    """
+    def __init__(self, remote_host, cli_command, input):
+        self.remote_host = remote_host
+        self.cli_command = cli_command
+        self.input = input
+        self.returncode = None
+        self.stderr = b''
+
+    def __iter__(self):
+        p = _remote_popen(self.remote_host, self.cli_command)
+        stderr = []
+
+        def feed_input():
+            try:
+                p.stdin.write(self.input)
+                p.stdin.close()
+            except (IOError, OSError):
+                # Remote exited before reading all input, the
+                # return code will report the problem.
+                pass
+
+        threads = [
+            threading.Thread(target=feed_input),
+            threading.Thread(target=lambda: stderr.append(p.stderr.read())),
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        complete = False
+        try:
+            for line in iter(p.stdout.readline, b''):
+                yield line
+            complete = True
+        finally:
+            if not complete and p.poll() is None:
+                # Consumer stopped early, don't wait on the remainder
+                p.kill()
+            p.stdout.close()
+            self.returncode = p.wait()
+            for thread in threads:
+                thread.join()
+            self.stderr = b''.join(stderr)
+
+
 class Query(object):
     PROVIDERS = {
         'mysql': MySql,
@@ -242,66 +472,173 @@ class Query(object):
                 return server
         raise RuntimeError("Couldn't locate host %s" % (host))
 
-    def to_df(self):
-        df = pd.DataFrame(self.fetch(), columns=self.columns)
-        for column, pd_type in self.types.items():
+    def to_df(self, stream=False, chunk_size=100000):
+        """Fetch the query results into a DataFrame
+
+        Output is parsed into DataFrames of chunk_size rows by the
+        provider, which for hive decodes each chunk in bulk rather than
+        row by row. With stream=True chunks are parsed as the remote
+        command produces them, so the full output is never held at once.
+        """
+        if stream:
+            frames = self._stream_frames(chunk_size)
+        else:
+            frames = self.provider.parse_frames(self._fetch_lines(), chunk_size)
+
+        # Categories are applied after concatenating, chunks with
+        # different categories would otherwise fall back to object.
+        chunk_types = {k: v for k, v in self.types.items() if v != 'category'}
+        chunks = []
+        for df in frames:
+            if self.columns is not None:
+                df.columns = self.columns
+            chunks.append(self._apply_types(df, chunk_types))
+        if not chunks:
+            return self._apply_types(pd.DataFrame([], columns=self.columns))
+        df = pd.concat(chunks, ignore_index=True)
+        return self._apply_types(df, {k: v for k, v in self.types.items() if v == 'category'})
+
+    def _apply_types(self, df, types=None):
+        if types is None:
+            types = self.types
+        for column, pd_type in types.items():
             df[column] = df[column].astype(pd_type)
         return df
 
-    def fetch(self):
-        cli_command = self.provider.commandline()
-        stdout, stderr, return_code = execute_remote(
-                self._remote_host, cli_command, self._query.encode('utf8'))
+    def _check_result(self, num_bytes, stderr, return_code):
         try:
             stderr = decode_unicode_bytes(stderr)
         except UnicodeDecodeError:
             # it'll print as a byte stream
             pass
 
-        if len(stdout) == 0 or return_code != 0:
+        if num_bytes == 0 or return_code != 0:
             LOG.warning('query stderr:\n%s', stderr)
             raise RuntimeError("Failed query with return code %d" % return_code)
         if len(stderr):
             LOG.debug('query stderr:\n%s', stderr)
 
+    def _decode_lines(self, remote, progress):
+        for line in remote:
+            progress.add_line(len(line))
+            try:
+                yield decode_unicode_bytes(line).rstrip('\n')
+            except UnicodeDecodeError:
+                LOG.debug("Non-utf8 data: %s", line)
+
+    def _stream_parsed(self, parse, progress):
+        if progress is None:
+            progress = FetchProgress()
+        self.progress = progress
+        remote = RemoteCommandStream(
+            self._remote_host, self.provider.commandline(), self._query.encode('utf8'))
+        lines = self._decode_lines(remote, progress)
+        for item in parse(lines):
+            yield item
+        # Parsing may stop before the end of output, drain the rest
+        # so the command can complete.
+        for _ in lines:
+            pass
+        self._check_result(progress.bytes, remote.stderr, remote.returncode)
+        progress.log()
+
+    def _stream_frames(self, chunk_size, progress=None):
+        parse = functools.partial(self.provider.parse_stream_frames, chunk_size=chunk_size)
+        for df in self._stream_parsed(parse, progress):
+            self.progress.add_row(len(df))
+            yield df
+
+    def fetch_stream(self, progress=None):
+        """Fetch query results, parsing rows as they arrive
+
+        Unlike fetch the remote command is still running while rows are
+        yielded, so a failed command is only reported once all of its
+        output has been consumed.
+
+        Parameters
+        ----------
+        progress : FetchProgress, optional
+            Counters to update while fetching. Available as
+            self.progress after the fetch starts.
+
+        Yields
+        ------
+        Rows as parsed by the query provider
+        """
+        for row in self._stream_parsed(self.provider.parse_stream, progress):
+            self.progress.add_row()
+            yield row
+
+    def _fetch_lines(self):
+        cli_command = self.provider.commandline()
+        stdout, stderr, return_code = execute_remote(
+                self._remote_host, cli_command, self._query.encode('utf8'))
+        self._check_result(len(stdout), stderr, return_code)
+
         try:
-            output = decode_unicode_bytes(stdout).split("\n")
+            return decode_unicode_bytes(stdout).split("\n")
         except UnicodeDecodeError:
             # Some unknown problem ... let's just work through it line by line
             # and throw out bad data :(
             output = []
-            for line in stdout.split("\n"):
+            for line in stdout.split(b"\n"):
                 try:
                     output.append(decode_unicode_bytes(line))
                 except UnicodeDecodeError:
                     LOG.debug("Non-utf8 data: %s", line)
-        return self.provider.parse(output)
+            return output
+
+    def fetch(self):
+        return self.provider.parse(self._fetch_lines())
 
 
 class CachedQuery(Query):
+    """Query with results cached on disk under workDir
+
+    The cache can be bounded with the optional cacheMaxAge (seconds)
+    and cacheMaxSize (bytes) settings.
+    """
     def __init__(self, settings):
         super(CachedQuery, self).__init__(settings)
-        self._cache_dir = os.path.join(settings('workDir'), '/cache')
-        query_hash = hashlib.md5(self._query.encode('utf8')).hexdigest()
-        self._cache_path = os.path.join(self._cache_dir, query_hash + '.pkl')
+        self.cache = QueryCache(
+            os.path.join(settings('workDir'), 'cache'),
+            max_age=self._optional_setting(settings, 'cacheMaxAge', float),
+            max_bytes=self._optional_setting(settings, 'cacheMaxSize', int))
+        self._cache_key = self.cache.key(self._query)
 
-    def fetch(self):
+    def _optional_setting(self, settings, key, convert):
         try:
-            with codecs.open(self._cache_path, 'r', 'utf-8') as f:
-                LOG.debug("Returning cached query result.")
-                return pickle.load(f)
-        except IOError:
-            LOG.debug("No cached query result available.")
+            return convert(settings(key))
+        except (configparser.NoOptionError, KeyError):
+            return None
+
+    def _fetch_columns(self, stream=False):
+        columns = self.cache.get(self._cache_key)
+        if columns is not None:
+            return columns
+        if stream:
+            rows = list(self.fetch_stream())
+        else:
+            rows = list(super(CachedQuery, self).fetch())
+        self.cache.put(self._cache_key, rows)
+        return [list(column) for column in zip(*rows)]
 
-        result = super(CachedQuery, self).fetch()
+    def fetch(self):
+        return list(zip(*(
+            column.tolist() if isinstance(column, np.ndarray) else column
+            for column in self._fetch_columns())))
 
-        if not os.path.isdir(self._cache_dir):
-            try:
-                os.makedirs(self._cache_dir)
-            except OSError:
-                LOG.debug("cache directory created since checking")
-                pass
+    def to_df(self, stream=False, chunk_size=100000):
+        """Fetch the query results into a DataFrame
 
-        with codecs.open(self._cache_path, 'w', 'utf-8') as f:
-            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
-        return result
+        Accepts the same arguments as Query.to_df. On a cache miss
+        stream=True parses rows as the remote command produces them
+        instead of buffering its whole output. chunk_size is ignored,
+        cached results are already stored column by column.
+        """
+        columns = self._fetch_columns(stream)
+        names = self.columns if self.columns is not None else range(len(columns))
+        df = pd.DataFrame(dict(zip(names, columns)), columns=names)
+        for column, pd_type in self.types.items():
+            df[column] = df[column].astype(pd_type)
+        return df
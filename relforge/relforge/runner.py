@@ -13,6 +13,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 # http://www.gnu.org/copyleft/gpl.html
 
+import hashlib
+import io
 import os
 import pipes
 import shutil
@@ -20,6 +22,10 @@ import subprocess
 import re
 import json
 import base64
+import fcntl
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 
 def defaults(config, section, settings):
@@ -45,55 +51,519 @@ def getSafeWorkPath(config, section, subdir):
     return os.path.join(config.get('settings', 'workdir'), subdir, qname)
 
 
-def sanitize_json(file):
-    file_isjson = file + '.isjson'
-    file_isnotjson = file + '.isnotjson'
-    isjson = open(file_isjson, 'w')
-    isnotjson = open(file_isnotjson, 'w')
-    for line in open(file).readlines():
-        if line.startswith('{'):
-            isjson.write(line)
+def splitJsonLines(lines, write_json, notjson_path):
+    """Pass lines that look like json to write_json, the rest to notjson_path
+
+    notjson_path is only created if there are lines to write to it.
+
+    Parameters
+    ----------
+    lines : iterable of bytes
+    write_json : callable
+        Called with each json line as it is read
+    notjson_path : str
+
+    Returns
+    -------
+    int
+        Number of lines that were not json
+    """
+    isnotjson = None
+    count = 0
+    try:
+        for line in lines:
+            if line.startswith(b'{'):
+                write_json(line)
+            else:
+                if isnotjson is None:
+                    isnotjson = open(notjson_path, 'wb')
+                isnotjson.write(line)
+                count += 1
+    finally:
+        if isnotjson is not None:
+            isnotjson.close()
+    return count
+
+
+class HostSlots(object):
+    """Limit the number of concurrent ssh sessions per lab host
+
+    A limit of None allows any number of sessions.
+    """
+    def __init__(self, limit=None):
+        if limit is not None and limit < 1:
+            raise ValueError('Expected a limit of at least 1 session per host, got {}'.format(limit))
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.limit)
+            return self._slots[host]
+
+    def run(self, host, fn, *args):
+        if self.limit is None:
+            return fn(*args)
+        with self._semaphore(host):
+            return fn(*args)
+
+
+def splitQueries(queries_file, outdir, shards):
+    """Split a query file into contiguous shards
+
+    Contiguous shards keep the original query order when their
+    results are concatenated back together.
+
+    Returns
+    -------
+    list of str
+        Paths of the shard files, in query order. Shards that would be
+        empty are not created.
+    """
+    with open(queries_file) as f:
+        lines = f.readlines()
+    shard_size = max(1, -(-len(lines) // shards))
+    paths = []
+    for i, start in enumerate(range(0, len(lines), shard_size)):
+        path = os.path.join(outdir, 'queries.shard%d' % (i))
+        with open(path, 'w') as f:
+            f.writelines(lines[start:start + shard_size])
+        paths.append(path)
+    return paths
+
+
+def mergeFiles(paths, out_path):
+    """Concatenate paths into out_path, removing them. Missing paths are skipped"""
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return
+    with open(out_path, 'wb') as out:
+        for path in paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            os.remove(path)
+
+
+def sshCommand(host, cmdline):
+    return ['ssh', host, cmdline]
+
+
+def runPipeline(queries_file, host, cmdline, write_json, notjson_path):
+    """Run queries on a lab host
+
+    Output is split as it arrives from the remote command, json results
+    are passed to write_json and anything else goes to notjson_path.
+    """
+    args = sshCommand(host, cmdline)
+    print("RUNNING cat %s | %s" % (queries_file, ' '.join(pipes.quote(arg) for arg in args)))
+    with open(queries_file, 'rb') as queries:
+        p = subprocess.Popen(args, stdin=queries, stdout=subprocess.PIPE)
+    complete = False
+    try:
+        splitJsonLines(p.stdout, write_json, notjson_path)
+        complete = True
+    finally:
+        if not complete and p.poll() is None:
+            p.kill()
+        p.stdout.close()
+        returncode = p.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+_RESULT_CACHE_LOCK = threading.Lock()
+_QUERY_PREFIX = re.compile(br'\{\s*"query"\s*:\s*')
+_JSON_DECODER = json.JSONDecoder()
+
+
+def parseResultQuery(line, prefix_bytes=4096, errors=False):
+    """Read the query of a json result line
+
+    Lab results start with their query, which is decoded from the
+    first prefix_bytes of the line without parsing the whole result.
+    Lines that are not results return None, as do results holding an
+    error unless errors is True, so failures are never cached.
+
+    Returns
+    -------
+    str or None
+    """
+    match = _QUERY_PREFIX.match(line)
+    if match is not None and (errors or b'"error"' not in line):
+        try:
+            prefix = line[match.end():match.end() + prefix_bytes].decode('utf8')
+            query = _JSON_DECODER.raw_decode(prefix)[0]
+        except ValueError:
+            # Truncated inside the query, or not json after all
+            pass
+        else:
+            if isinstance(query, str):
+                return query
+    try:
+        result = json.loads(line.decode('utf8'))
+    except ValueError:
+        return None
+    if not isinstance(result, dict) or ('error' in result and not errors):
+        return None
+    query = result.get('query')
+    return query if isinstance(query, str) else None
+
+
+class ResultCache(object):
+    """Content addressed store of per query search results
+
+    Results are stored per combination of search command, decoded search
+    config and lab host. Changing any of them only affects the queries run
+    with the new combination, while renaming a test section or adding
+    queries reuses everything already run. The store is an append only
+    file of lines holding the json encoded query, a tab, and the result.
+    Results holding an error are not stored, the query is run again next
+    time. They are only kept in memory so writing the results of this run
+    still has a line for every query.
+
+    Offsets of the latest result per query are saved next to the store,
+    a new instance only scans what was appended after the last save.
+    Saving rewrites the store once most of it holds superseded results.
+    All access to the store is serialized with flock, so relevancyRunner
+    processes sharing a workdir can use it concurrently.
+
+    Parameters
+    ----------
+    cache_dir : str
+    cmdline : str
+        Search command, without the --options argument
+    search_config : object
+        Decoded search config, or None
+    host : str
+    """
+    # Rewrite the store when less than this fraction of it is live
+    COMPACT_RATIO = 0.5
+
+    def __init__(self, cache_dir, cmdline, search_config, host):
+        key = json.dumps([cmdline, search_config, host], sort_keys=True)
+        base = os.path.join(cache_dir, hashlib.sha1(key.encode('utf8')).hexdigest())
+        self.path = base + '.jsonl'
+        self.index_path = base + '.index'
+        self._offsets = {}
+        self._entries = 0
+        self._inode = None
+        self._writer = None
+        self._errors = {}
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                pass  # created by a concurrent run
+        self._lock_file = open(base + '.lock', 'ab')
+        with self._locked():
+            self._load_index()
+
+    @contextmanager
+    def _locked(self):
+        # The thread lock covers threads sharing this instance, flock
+        # covers other instances and processes.
+        with _RESULT_CACHE_LOCK:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _read_saved_index(self, inode):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if index.get('inode') != inode:
+            # The store was rewritten or replaced since
+            return None
+        return index
+
+    def _load_index(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        open(self.path, 'ab').close()
+        self._inode = os.stat(self.path).st_ino
+        index = self._read_saved_index(self._inode)
+        if index is None:
+            self._offsets, self._entries, end = {}, 0, 0
         else:
-            isnotjson.write(line)
-    isjson.close()
-    isnotjson.close()
-    shutil.move(file_isjson, file)
-    if os.path.getsize(file_isnotjson) == 0:
-        os.remove(file_isnotjson)
+            self._offsets, self._entries, end = index['offsets'], index['entries'], index['size']
+        with open(self.path, 'r+b') as f:
+            if end > os.fstat(f.fileno()).st_size:
+                self._offsets, self._entries, end = {}, 0, 0
+            f.seek(end)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Interrupted mid-write, drop the partial entry
+                    f.truncate(end)
+                    break
+                query = line.split(b'\t', 1)[0]
+                self._offsets[json.loads(query.decode('utf8'))] = end
+                self._entries += 1
+                end += len(line)
+
+    def _check_store(self):
+        """Reload the index if another instance rewrote the store"""
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            inode = None
+        if inode != self._inode:
+            self._load_index()
+
+    def __contains__(self, query):
+        return query in self._offsets
+
+    def add_line(self, line):
+        """Store a single result line, keyed by its query
+
+        Safe to call from several threads at once, each line is appended
+        to the store as a whole.
+
+        Returns
+        -------
+        bool
+            True if the line was stored
+        """
+        if not line.endswith(b'\n'):
+            line += b'\n'
+        query = parseResultQuery(line)
+        if query is None:
+            query = parseResultQuery(line, errors=True)
+            if query is not None:
+                with _RESULT_CACHE_LOCK:
+                    self._errors[query] = line
+            return False
+        entry = json.dumps(query).encode('utf8') + b'\t' + line
+        with self._locked():
+            self._check_store()
+            self._errors.pop(query, None)
+            if self._writer is None:
+                self._writer = open(self.path, 'ab')
+            self._writer.seek(0, os.SEEK_END)
+            self._offsets[query] = self._writer.tell()
+            self._entries += 1
+            self._writer.write(entry)
+            # Must reach the store before another process appends
+            self._writer.flush()
+        return True
+
+    def add(self, results_file):
+        """Store the results of a run, keyed by their query
+
+        Returns
+        -------
+        int
+            Number of results stored
+        """
+        with open(results_file, 'rb') as f_in:
+            return sum(self.add_line(line) for line in f_in)
+
+    def _compact(self):
+        tmp_path = self.path + '.tmp'
+        offsets = {}
+        with open(self.path, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+            for query, offset in sorted(self._offsets.items(), key=lambda x: x[1]):
+                f_in.seek(offset)
+                offsets[query] = f_out.tell()
+                f_out.write(f_in.readline())
+        # Never leave an index pointing into the replaced store
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        os.rename(tmp_path, self.path)
+        self._offsets = offsets
+        self._entries = len(offsets)
+        self._inode = os.stat(self.path).st_ino
+
+    def save(self):
+        """Save the index, compacting the store if mostly superseded"""
+        with self._locked():
+            # Pick up entries appended by other instances since loading
+            self._load_index()
+            if len(self._offsets) < self._entries * self.COMPACT_RATIO:
+                self._compact()
+            index = {
+                'inode': self._inode,
+                'size': os.stat(self.path).st_size,
+                'entries': self._entries,
+                'offsets': self._offsets,
+            }
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.rename(tmp_path, self.index_path)
 
+    def write(self, queries, out_path):
+        """Write the cached results of queries, in order, to out_path
 
-def runSearch(config, section, allow_reuse=True):
+        Queries that failed since this instance was created are written
+        with their error, keeping the lines of two runs aligned.
+
+        Returns
+        -------
+        int
+            Number of queries without a result or error
+        """
+        missing = 0
+        with self._locked():
+            self._check_store()
+            # An open store stays readable even if later rewritten
+            f_in = open(self.path, 'rb')
+        with f_in, open(out_path, 'wb') as f_out:
+            for query in queries:
+                if query in self._errors:
+                    f_out.write(self._errors[query])
+                    continue
+                if query not in self._offsets:
+                    missing += 1
+                    continue
+                f_in.seek(self._offsets[query])
+                f_out.write(f_in.readline().split(b'\t', 1)[1])
+        return missing
+
+
+def readQueries(queries_file):
+    with io.open(queries_file, encoding='utf8') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+def runQueries(queries_file, host, cmdline, write_json, notjson_path, shards=1, host_slots=None):
+    """Run a query file against a lab host, optionally split into shards
+
+    Shards run concurrently, write_json is called from all of them and
+    receives results in no particular order.
+    """
+    if host_slots is None:
+        host_slots = HostSlots()
+    if shards <= 1:
+        host_slots.run(host, runPipeline, queries_file, host, cmdline, write_json, notjson_path)
+        return
+    outdir = os.path.dirname(notjson_path)
+    shard_queries = splitQueries(queries_file, outdir, shards)
+    shard_notjson = [os.path.join(outdir, 'isnotjson.shard%d' % (i)) for i in range(len(shard_queries))]
+    with ThreadPoolExecutor(max_workers=len(shard_queries) or 1) as executor:
+        futures = [executor.submit(host_slots.run, host, runPipeline, q, host, cmdline, write_json, n)
+                   for q, n in zip(shard_queries, shard_notjson)]
+        for future in futures:
+            future.result()
+    mergeFiles(shard_notjson, notjson_path)
+    for path in shard_queries:
+        os.remove(path)
+
+
+def runSearch(config, section, allow_reuse=True, shards=1, host_slots=None):
+    """Run the queries of a config section against its lab host
+
+    Results of individual queries are cached under workdir/result_cache,
+    only queries without a result for the current searchCommand, config
+    and labHost are sent to the lab host.
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    section : str
+    allow_reuse : bool
+        Use cached results of previous runs. When False every query is
+        run again, and the cache refreshed with the new results.
+    shards : int
+        Number of parallel ssh sessions to split the queries across.
+        Results are merged back in the original query order.
+    host_slots : HostSlots, optional
+        Shared limit on concurrent sessions per lab host
+
+    Returns
+    -------
+    str
+        Path to the results file
+    """
     qdir = getSafeWorkPath(config, section, 'queries')
     cmdline = config.get(section, 'searchCommand')
+    host = config.get(section, 'labHost')
+    queries_file = config.get(section, 'queries')
 
     results_file = qdir + '/results'
-    if os.path.isfile(results_file) and allow_reuse:
-        print("REUSING: %s" % results_file)
-        return results_file
     refreshDir(qdir)
+    search_config = None
     if config.has_option(section, 'config'):
         try:
             # validate json
-            json.loads(config.get(section, 'config'))
+            search_config = json.loads(config.get(section, 'config'))
             search_options = config.get(section, 'config')
         except ValueError:
             # config wasn't valid json, maybe it was a file containing json
             with open(config.get(section, 'config')) as f:
                 search_options = f.read()
+            try:
+                search_config = json.loads(search_options)
+            except ValueError:
+                # Passed through to the search command as is
+                search_config = search_options
         with open(qdir + '/config.json', 'w') as f:
             f.write(search_options)  # archive search config
         search_options = "B64://" + base64.b64encode(search_options.encode('utf8')).decode('ascii')
+    cache = ResultCache(
+        os.path.join(config.get('settings', 'workdir'), 'result_cache'),
+        cmdline, search_config, host)
+    if search_config is not None:
         cmdline += " --options " + search_options
-    runCommand("cat %s | ssh %s %s > %s" % (config.get(section, 'queries'),
-                                            config.get(section, 'labHost'),
-                                            pipes.quote(cmdline),
-                                            results_file))
-    shutil.copyfile(config.get(section, 'queries'), qdir + '/queries')  # archive queries
-    # sanitize json
-    sanitize_json(results_file)
+
+    queries = readQueries(queries_file)
+    to_run = []
+    seen = set()
+    for query in queries:
+        if query not in seen and not (allow_reuse and query in cache):
+            to_run.append(query)
+        seen.add(query)
+    if to_run:
+        print("RUNNING %d of %d queries, the rest are cached" % (len(to_run), len(seen)))
+        run_queries = qdir + '/queries.run'
+        with io.open(run_queries, 'w', encoding='utf8') as f:
+            f.writelines(query + '\n' for query in to_run)
+        # Results go straight into the cache as they arrive
+        runQueries(run_queries, host, cmdline, cache.add_line, results_file + '.isnotjson',
+                   shards, host_slots)
+        cache.save()
+        os.remove(run_queries)
+    else:
+        print("REUSING: cached results for all %d queries" % (len(seen)))
+    missing = cache.write(queries, results_file)
+    if missing:
+        print("WARNING: %d queries did not return a result" % (missing))
+    shutil.copyfile(queries_file, qdir + '/queries')  # archive queries
     return results_file
 
 
+def runSearches(config, sections, allow_reuse=True, shards=1, max_per_host=None):
+    """Run the queries of several config sections concurrently
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+    sections : list of str
+    allow_reuse : bool
+    shards : int
+        Number of parallel ssh sessions per section
+    max_per_host : int, optional
+        Maximum concurrent ssh sessions against any single lab host,
+        shared by all sections and shards.
+
+    Returns
+    -------
+    list of str
+        Path to the results file of each section, in the order given
+    """
+    host_slots = HostSlots(max_per_host)
+    with ThreadPoolExecutor(max_workers=len(sections) or 1) as executor:
+        futures = [executor.submit(runSearch, config, section, allow_reuse, shards, host_slots)
+                   for section in sections]
+        return [future.result() for future in futures]
+
+
 def checkSettings(config, section, settings):
     for s in settings:
         if not config.has_option(section, s):
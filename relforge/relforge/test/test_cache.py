@@ -0,0 +1,137 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from relforge.cache import QueryCache, column_kind
+import relforge.query
+from relforge.test.test_query import local_popen, make_query
+from relforge.query import CachedQuery
+
+
+ROWS = [
+    (u'foo', 1, 0.5),
+    (u'bär', 2, 1.0),
+    (u'', 3, 2.5),
+]
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return QueryCache(str(tmpdir.join('cache')))
+
+
+def test_roundtrip(cache):
+    key = cache.key('SELECT 1')
+    assert cache.get(key) is None
+    assert cache.put(key, ROWS)
+    columns = cache.get(key)
+    assert columns[0] == [u'foo', u'bär', u'']
+    assert isinstance(columns[1], np.memmap)
+    assert columns[1].dtype == np.int64
+    assert columns[2].dtype == np.float64
+    assert list(zip(columns[0], columns[1].tolist(), columns[2].tolist())) == ROWS
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+
+
+def test_empty_rows(cache):
+    key = cache.key('SELECT 1')
+    assert cache.put(key, [])
+    assert cache.get(key) == []
+
+
+@pytest.mark.parametrize('column,expected', [
+    ([1, 2], 'int64'),
+    ([1, 2.5], 'float64'),
+    (['a', u'b'], 'str'),
+    (['a', 1], None),
+    (['a', None], None),
+    (['a\0b'], None),
+])
+def test_column_kind(column, expected):
+    assert expected == column_kind(column)
+
+
+def test_schema_version_change_invalidates(cache):
+    cache.put(cache.key('SELECT 1'), ROWS)
+    new_cache = QueryCache(cache.cache_dir)
+    new_cache.SCHEMA_VERSION = cache.SCHEMA_VERSION + 1
+    assert new_cache.get(new_cache.key('SELECT 1')) is None
+    new_cache.evict()
+    assert os.listdir(cache.cache_dir) == []
+
+
+def test_evict_expired(cache):
+    cache.put(cache.key('SELECT 1'), ROWS)
+    cache.max_age = 0.
+    time.sleep(0.01)
+    cache.evict()
+    assert cache.get(cache.key('SELECT 1')) is None
+
+
+def test_get_expired(cache):
+    cache.max_age = 0.01
+    key = cache.key('SELECT 1')
+    cache.put(key, ROWS)
+    assert cache.get(key) is not None
+    time.sleep(0.1)
+    # Expired entries are not served even without a put evicting them
+    assert cache.get(key) is None
+    assert os.listdir(cache.cache_dir) == []
+    assert cache.stats['misses'] == 1
+
+
+def test_evict_least_recently_used(cache):
+    for i in range(3):
+        cache.put(cache.key('SELECT {}'.format(i)), ROWS)
+        # mtime resolution can be coarse, ensure ordering
+        path = os.path.join(cache.cache_dir, cache.key('SELECT {}'.format(i)), QueryCache.META_FILE)
+        os.utime(path, (i, i))
+    entry_size = max(size for _, _, _, size in cache._entries())
+    cache.max_bytes = entry_size * 2
+    cache.evict()
+    assert cache.get(cache.key('SELECT 0')) is None
+    assert cache.get(cache.key('SELECT 1')) is not None
+    assert cache.get(cache.key('SELECT 2')) is not None
+
+
+def test_cached_query_fetch(mocker, tmpdir):
+    mocker.patch.object(
+        relforge.query, 'execute_remote',
+        return_value=(b'some useless text', b'', 0))
+    query_args = dict(
+        columns=['z', 'y', 'x'],
+        test_settings={'workDir': str(tmpdir)},
+        servers=[{
+            'host': 'pytesthost',
+            'dummy': {
+                'results': ROWS,
+            }
+        }])
+    assert ROWS == make_query(CachedQuery, **query_args).fetch()
+    assert os.path.isdir(str(tmpdir.join('cache')))
+
+    # Second query must come from cache
+    query = make_query(CachedQuery, **dict(query_args, servers=[{'host': 'pytesthost', 'dummy': {}}]))
+    assert ROWS == query.fetch()
+    df = query.to_df()
+    assert df.columns.tolist() == ['z', 'y', 'x']
+    assert df['z'].tolist() == [row[0] for row in ROWS]
+    assert query.cache.stats['hits'] == 2
+
+
+def test_cached_query_to_df_stream(mocker, tmpdir):
+    mocker.patch.object(relforge.query, '_remote_popen', local_popen('cat > /dev/null; echo ok'))
+    query_args = dict(
+        columns=['z', 'y', 'x'],
+        test_settings={'workDir': str(tmpdir)},
+        servers=[{'host': 'pytesthost', 'dummy': {'results': ROWS}}])
+    df = make_query(CachedQuery, **query_args).to_df(stream=True, chunk_size=2)
+    assert df['y'].tolist() == [row[1] for row in ROWS]
+
+    query = make_query(CachedQuery, **dict(query_args, servers=[{'host': 'pytesthost', 'dummy': {}}]))
+    df = query.to_df(stream=True, chunk_size=2)
+    assert df['z'].tolist() == [row[0] for row in ROWS]
+    assert query.cache.stats['hits'] == 1
@@ -0,0 +1,28 @@
+import pytest
+
+from relforge.parallel import map_ordered
+
+
+def square(x):
+    return x * x
+
+
+@pytest.mark.parametrize('workers', [0, 1, 3])
+def test_map_ordered(workers):
+    assert list(map_ordered(square, range(20), workers)) == [x * x for x in range(20)]
+    assert list(map_ordered(square, [], workers)) == []
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_map_ordered_bounds_reads(workers):
+    read = []
+
+    def items():
+        for x in range(20):
+            read.append(x)
+            yield x
+
+    results = map_ordered(square, items(), workers)
+    assert next(results) == 0
+    assert len(read) == (2 * workers if workers > 1 else 1)
+    assert list(results) == [x * x for x in range(1, 20)]
@@ -1,7 +1,9 @@
 import pandas as pd
+import numpy as np
 import pytest
 import relforge.query
-from relforge.query import CachedQuery, CliCommand, CliSequence, MySql, Query
+from relforge.query import CachedQuery, CliCommand, CliSequence, Hive, MySql, Query
+import subprocess
 import tempfile
 import yaml
 
@@ -121,3 +123,103 @@ def test_to_df(mocker):
     assert isinstance(df, pd.DataFrame)
     assert df.columns.tolist() == ['z', 'y', 'x']
     assert len(df) == 2
+
+
+BEELINE_OUTPUT = [
+    '0: jdbc:hive2://pytesthost:10000> SELECT x, y FROM ...',
+    'x\ty',
+    'a\tb',
+    '\0c\td\0\t1',
+    'NULL\t2',
+    'e\t3',
+    '0: jdbc:hive2://pytesthost:10000> ',
+]
+
+
+def test_hive_parse_stream_matches_parse():
+    provider = Hive({})
+    expected = list(provider.parse(list(BEELINE_OUTPUT)))
+    assert expected == [['a', 'b'], ['c\td', '1'], ['e', '3']]
+    assert expected == list(provider.parse_stream(iter(BEELINE_OUTPUT)))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 100])
+def test_hive_parse_frames_matches_parse(chunk_size):
+    provider = Hive({})
+    expected = list(provider.parse(list(BEELINE_OUTPUT)))
+    # Trailing blank lines shouldn't produce empty frames
+    output = BEELINE_OUTPUT[:-1] + ['', ''] + BEELINE_OUTPUT[-1:]
+    assert expected == list(provider.parse(list(output)))
+    for frames in [
+        provider.parse_frames(list(BEELINE_OUTPUT), chunk_size),
+        provider.parse_frames(list(output), chunk_size),
+        provider.parse_stream_frames(iter(BEELINE_OUTPUT), chunk_size),
+    ]:
+        rows = [row for df in frames for row in df.values.tolist()]
+        assert expected == rows
+
+
+def test_hive_decode_tsv2():
+    lines = ['\0a\tb\0\tc\t\0d\te\0', 'NULL\tx\ty', '"quoted"\t\0x\ty\0\tz', 'e\tf\t']
+    df = Hive({}).decode_tsv2('\n'.join(lines))
+    assert df.values.tolist() == [
+        list(Hive({}).parse_tsv2_line(line)) for line in lines if 'NULL\t' not in line]
+
+
+def local_popen(script):
+    def fn(remote_host, cli_command):
+        return subprocess.Popen(['sh', '-c', script],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    return fn
+
+
+def make_hive_query(**kwargs):
+    return make_query(
+        provider='hive',
+        servers=[{'host': 'pytesthost', 'hive': {}}],
+        **kwargs)
+
+
+def test_fetch_stream(mocker):
+    mocker.patch.object(relforge.query, '_remote_popen', local_popen(
+        'cat > /dev/null; printf "%s"' % '\n'.join(BEELINE_OUTPUT).replace('\0', '\\0')))
+    query = make_hive_query()
+    rows = list(query.fetch_stream())
+    assert rows == [['a', 'b'], ['c\td', '1'], ['e', '3']]
+    assert query.progress.rows == 3
+    assert query.progress.lines == len(BEELINE_OUTPUT)
+    assert query.progress.summary['bytes'] > 0
+
+
+def test_fetch_stream_failed_command(mocker):
+    mocker.patch.object(relforge.query, '_remote_popen', local_popen(
+        'cat > /dev/null; echo oops >&2; exit 3'))
+    with pytest.raises(RuntimeError):
+        list(make_hive_query().fetch_stream())
+
+
+def test_to_df_stream(mocker):
+    mocker.patch.object(relforge.query, '_remote_popen', local_popen(
+        'cat > /dev/null; printf "%s"' % '\n'.join(BEELINE_OUTPUT).replace('\0', '\\0')))
+    df = make_hive_query(
+        columns=['name', 'value'],
+        types={'name': 'category', 'value': 'str'},
+    ).to_df(stream=True, chunk_size=2)
+    assert df['name'].tolist() == ['a', 'c\td', 'e']
+    assert df['name'].dtype.name == 'category'
+    assert df['value'].tolist() == ['b', '1', '3']
+
+
+def test_hive_to_df_types(mocker):
+    output = BEELINE_OUTPUT[:2] + ['a\t4'] + BEELINE_OUTPUT[3:]
+    mocker.patch.object(
+        relforge.query, 'execute_remote',
+        return_value=('\n'.join(output).encode('utf8'), b'', 0))
+    df = make_hive_query(
+        columns=['name', 'value'],
+        types={'value': 'int64'},
+    ).to_df(chunk_size=2)
+    assert df['name'].tolist() == ['a', 'c\td', 'e']
+    assert df['value'].tolist() == [4, 1, 3]
+    assert df['value'].dtype == np.int64
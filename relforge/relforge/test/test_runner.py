@@ -0,0 +1,267 @@
+from configparser import ConfigParser
+import json
+import os
+import threading
+import time
+
+import pytest
+import subprocess
+
+import relforge.runner
+
+
+QUERIES = ['query %d\n' % (i) for i in range(10)]
+
+
+@pytest.fixture
+def config(tmpdir):
+    queries = tmpdir.join('queries')
+    queries.write(''.join(QUERIES))
+    config = ConfigParser()
+    config.add_section('settings')
+    config.set('settings', 'workdir', str(tmpdir.join('work')))
+    for section in ['test1', 'test2']:
+        config.add_section(section)
+        config.set(section, 'name', section)
+        config.set(section, 'queries', str(queries))
+        config.set(section, 'labHost', 'pytesthost')
+        config.set(section, 'searchCommand', 'search')
+    return config
+
+
+class FakePipeline(object):
+    """Answer each query with a json line, tracking concurrent sessions
+
+    When a barrier is set every session waits on it, forcing that many
+    sessions to overlap. Queries in fail are answered with an error.
+    """
+    def __init__(self):
+        self.barrier = None
+        self.fail = set()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.calls = 0
+        self.queries = []
+
+    def __call__(self, queries_file, host, cmdline, write_json, notjson_path):
+        with self.lock:
+            self.active += 1
+            self.calls += 1
+            self.max_active = max(self.max_active, self.active)
+        if self.barrier is not None:
+            self.barrier.wait()
+        time.sleep(0.05)
+        with open(notjson_path, 'w') as f:
+            f.write('some junk\n')
+        with open(queries_file) as f_in:
+            for line in f_in:
+                self.queries.append(line.strip())
+                result = {'query': line.strip()}
+                if line.strip() in self.fail:
+                    result['error'] = 'timeout'
+                write_json(json.dumps(result).encode('utf8') + b'\n')
+        with self.lock:
+            self.active -= 1
+
+
+@pytest.fixture
+def pipeline(mocker):
+    pipeline = FakePipeline()
+    mocker.patch.object(relforge.runner, 'runPipeline', pipeline)
+    return pipeline
+
+
+def read_queries(results_file):
+    with open(results_file) as f:
+        return [json.loads(line)['query'] + '\n' for line in f]
+
+
+@pytest.mark.parametrize('shards', [1, 3, 10, 20])
+def test_sharded_search_keeps_query_order(config, pipeline, shards):
+    results_file = relforge.runner.runSearch(config, 'test1', shards=shards)
+    assert read_queries(results_file) == QUERIES
+    assert pipeline.calls == min(shards, len(QUERIES))
+    with open(results_file + '.isnotjson') as f:
+        assert f.read() == 'some junk\n' * pipeline.calls
+    # Results only pass through the cache, nothing else is left behind
+    assert sorted(os.listdir(os.path.dirname(results_file))) == ['queries', 'results', 'results.isnotjson']
+
+
+def test_run_searches_concurrently(config, pipeline):
+    # Raises BrokenBarrierError unless all four sessions run at once
+    pipeline.barrier = threading.Barrier(4, timeout=10)
+    res1, res2 = relforge.runner.runSearches(config, ['test1', 'test2'], shards=2)
+    assert res1 != res2
+    assert read_queries(res1) == QUERIES
+    assert read_queries(res2) == QUERIES
+    assert pipeline.max_active == 4
+
+
+def test_run_searches_max_per_host(config, pipeline):
+    relforge.runner.runSearches(config, ['test1', 'test2'], shards=2, max_per_host=1)
+    assert pipeline.calls == 4
+    assert pipeline.max_active == 1
+
+
+@pytest.mark.parametrize('limit', [0, -1])
+def test_host_slots_rejects_limit(limit):
+    with pytest.raises(ValueError):
+        relforge.runner.HostSlots(limit)
+
+
+def test_search_reuses_cached_queries(config, pipeline, tmpdir):
+    relforge.runner.runSearch(config, 'test1')
+    assert len(pipeline.queries) == len(QUERIES)
+
+    # Renaming the section and adding a query only runs the new query
+    tmpdir.join('queries').write(''.join(['new query\n'] + QUERIES))
+    config.set('test1', 'name', 'renamed')
+    pipeline.queries = []
+    results_file = relforge.runner.runSearch(config, 'test1')
+    assert pipeline.queries == ['new query']
+    assert read_queries(results_file) == ['new query\n'] + QUERIES
+
+    # A different search config runs everything again
+    config.set('test1', 'config', '{"wgCirrusSearchFoo": true}')
+    pipeline.queries = []
+    relforge.runner.runSearch(config, 'test1')
+    assert len(pipeline.queries) == len(QUERIES) + 1
+
+    pipeline.queries = []
+    relforge.runner.runSearch(config, 'test1', allow_reuse=False)
+    assert len(pipeline.queries) == len(QUERIES) + 1
+
+
+def test_search_keeps_failed_queries_aligned(config, pipeline):
+    pipeline.fail = {'query 3'}
+    results_file = relforge.runner.runSearch(config, 'test1', shards=3)
+    assert read_queries(results_file) == QUERIES
+    with open(results_file) as f:
+        assert [('error' in json.loads(line)) for line in f] == [i == 3 for i in range(len(QUERIES))]
+
+    # Failures are not cached, only the failed query runs again
+    pipeline.fail = set()
+    pipeline.queries = []
+    results_file = relforge.runner.runSearch(config, 'test1')
+    assert pipeline.queries == ['query 3']
+    with open(results_file) as f:
+        assert not any('error' in json.loads(line) for line in f)
+
+
+def make_cache(tmpdir):
+    return relforge.runner.ResultCache(str(tmpdir.join('cache')), 'search', None, 'pytesthost')
+
+
+def test_result_cache_drops_partial_entry(tmpdir):
+    results = tmpdir.join('results')
+    results.write('{"query": "a"}\n{"query": "b"}\n')
+    cache = make_cache(tmpdir)
+    assert cache.add(str(results)) == 2
+    with open(cache.path, 'ab') as f:
+        f.write(b'"c"\t{"query": "c"')
+    cache = make_cache(tmpdir)
+    assert 'b' in cache
+    assert 'c' not in cache
+    assert cache.write(['b', 'c', 'a'], str(tmpdir.join('out'))) == 1
+    assert tmpdir.join('out').read() == '{"query": "b"}\n{"query": "a"}\n'
+
+
+@pytest.mark.parametrize('line,expected', [
+    (b'{"query":"a","rows":[]}\n', 'a'),
+    (b'{"query": "b \\"c\\""}\n', 'b "c"'),
+    (b'{"rows": [], "query": "d"}\n', 'd'),
+    (b'{"query":"e","error":"timeout"}\n', None),
+    (b'{"query":1}\n', None),
+    (b'{"query":"f\n', None),
+])
+def test_parse_result_query(line, expected):
+    assert relforge.runner.parseResultQuery(line) == expected
+    assert relforge.runner.parseResultQuery(line, prefix_bytes=2) == expected
+
+
+@pytest.mark.parametrize('prefix_bytes', [4096, 2])
+def test_parse_result_query_errors(prefix_bytes):
+    line = b'{"query":"e","error":"timeout"}\n'
+    assert relforge.runner.parseResultQuery(line, prefix_bytes, errors=True) == 'e'
+    assert relforge.runner.parseResultQuery(b'{"query":1,"error":"x"}\n', prefix_bytes, errors=True) is None
+
+
+def test_result_cache_skips_errors(tmpdir):
+    results = tmpdir.join('results')
+    results.write('{"query": "a"}\n{"query": "b", "error": "timeout"}\n')
+    cache = make_cache(tmpdir)
+    assert cache.add(str(results)) == 1
+    assert 'a' in cache
+    assert 'b' not in cache
+    # The error is still written for this run
+    assert cache.write(['b', 'a'], str(tmpdir.join('out'))) == 0
+    assert tmpdir.join('out').read() == '{"query": "b", "error": "timeout"}\n{"query": "a"}\n'
+    assert make_cache(tmpdir).write(['b', 'a'], str(tmpdir.join('out'))) == 1
+
+
+def test_result_cache_compacts_superseded(tmpdir):
+    results = tmpdir.join('results')
+    results.write('{"query": "a", "n": 1}\n{"query": "b", "n": 1}\n')
+    cache = make_cache(tmpdir)
+    cache.add(str(results))
+    results.write('{"query": "a", "n": 2}\n')
+    for _ in range(3):
+        cache.add(str(results))
+    cache.save()
+    with open(cache.path) as f:
+        assert len(f.readlines()) == 2
+    cache = make_cache(tmpdir)
+    cache.write(['a', 'b'], str(tmpdir.join('out')))
+    assert tmpdir.join('out').read() == '{"query": "a", "n": 2}\n{"query": "b", "n": 1}\n'
+
+
+def test_result_cache_loads_appends_after_save(tmpdir):
+    results = tmpdir.join('results')
+    results.write('{"query": "a"}\n')
+    cache = make_cache(tmpdir)
+    cache.add(str(results))
+    cache.save()
+    # Appended by another instance, but never saved
+    results.write('{"query": "b"}\n')
+    make_cache(tmpdir).add(str(results))
+    cache = make_cache(tmpdir)
+    assert 'a' in cache
+    assert 'b' in cache
+    assert cache.write(['b', 'a'], str(tmpdir.join('out'))) == 0
+    assert tmpdir.join('out').read() == '{"query": "b"}\n{"query": "a"}\n'
+
+
+def test_result_cache_reloads_rewritten_store(tmpdir):
+    results = tmpdir.join('results')
+    results.write('{"query": "a"}\n{"query": "b"}\n')
+    stale = make_cache(tmpdir)
+    stale.add(str(results))
+    results.write('{"query": "a"}\n')
+    cache = make_cache(tmpdir)
+    for _ in range(3):
+        cache.add(str(results))
+    cache.save()
+    # Offsets held by stale point into the store before it was compacted
+    assert stale.write(['b', 'a'], str(tmpdir.join('out'))) == 0
+    assert tmpdir.join('out').read() == '{"query": "b"}\n{"query": "a"}\n'
+
+
+def test_run_pipeline_splits_output(mocker, config, tmpdir):
+    mocker.patch.object(relforge.runner, 'sshCommand', lambda host, cmdline: [
+        'sh', '-c', 'while read q; do echo "{\\"query\\": \\"$q\\"}"; echo "warning: $q"; done'])
+    results = []
+    notjson_path = str(tmpdir.join('results.isnotjson'))
+    relforge.runner.runPipeline(str(tmpdir.join('queries')), 'pytesthost', 'search', results.append, notjson_path)
+    assert [json.loads(line)['query'] + '\n' for line in results] == QUERIES
+    with open(notjson_path) as f:
+        assert f.read() == ''.join('warning: ' + q for q in QUERIES)
+
+
+def test_run_pipeline_failure(mocker, config, tmpdir):
+    mocker.patch.object(relforge.runner, 'sshCommand', lambda host, cmdline: [
+        'sh', '-c', 'cat > /dev/null; exit 3'])
+    notjson_path = str(tmpdir.join('results.isnotjson'))
+    with pytest.raises(subprocess.CalledProcessError):
+        relforge.runner.runPipeline(str(tmpdir.join('queries')), 'pytesthost', 'search', [].append, notjson_path)
+    assert not tmpdir.join('results.isnotjson').exists()
@@ -2,6 +2,7 @@ from setuptools import setup
 
 requirements = [
     'elasticsearch>=5.0.0,<6.0.0',
+    'numpy',
     'pandas',
     'pyyaml',
 ]
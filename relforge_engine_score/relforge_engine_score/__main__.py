@@ -23,7 +23,7 @@ import tempfile
 
 import relforge.runner
 
-from relforge_engine_score.scores import init_scorer, load_results
+from relforge_engine_score.scorers import init_scorer, load_results, stream_engine_score
 
 
 LOG = logging.getLogger(__name__)
@@ -38,7 +38,7 @@ def genSettings(config):
     return get
 
 
-def score_for_config(config_path, verbose):
+def score_for_config(config_path, verbose, backend, stream, workers):
     logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
 
     config = ConfigParser.ConfigParser()
@@ -49,7 +49,7 @@ def score_for_config(config_path, verbose):
     relforge.runner.checkSettings(config, 'test1', [
                                   'name', 'labHost', 'searchCommand'])
     settings = genSettings(config)
-    scorer = init_scorer(settings)
+    scorer = init_scorer(settings, backend, workers)
 
     # Write out a list of queries for the runner
     queries_temp = tempfile.mkstemp('_engine_score_queries')
@@ -61,10 +61,13 @@ def score_for_config(config_path, verbose):
         print('Running queries')
         results_dir = relforge.runner.runSearch(config, 'test1')
         with open(results_dir) as f:
-            results = load_results(f)
-
-        print('Calculating engine score')
-        engine_score = scorer.engine_score(results)
+            if stream:
+                print('Calculating engine score')
+                engine_score = stream_engine_score(scorer, f)
+            else:
+                results = load_results(f)
+                print('Calculating engine score')
+                engine_score = scorer.engine_score(results)
     finally:
         os.remove(queries_temp[1])
 
@@ -80,6 +83,15 @@ def parse_arguments(argv):
     parser.add_argument(
         '-v', '--verbose', dest='verbose', action='store_true',
         help='Increase output verbosity')
+    parser.add_argument(
+        '-b', '--backend', dest='backend', choices=['python', 'numpy'], default='python',
+        help='Implementation used to calculate scores, default is python')
+    parser.add_argument(
+        '-s', '--stream', dest='stream', action='store_true',
+        help='Score results line by line instead of loading them all into memory')
+    parser.add_argument(
+        '-j', '--workers', dest='workers', type=int, default=1,
+        help='Number of processes used to evaluate multiple scorers concurrently, default is 1')
     parser.set_defaults(verbose=False)
     return parser.parse_args()
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# benchmark.py - Compare engine scoring backends on synthetic data
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+# http://www.gnu.org/copyleft/gpl.html
+
+"""Time the python and numpy scoring backends against each other
+
+Usage:
+
+    python -m relforge_engine_score.benchmark --queries 1000000
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from relforge_engine_score import scorers, vectorized
+
+try:
+    xrange(1)
+except NameError:
+    xrange = range
+
+
+def make_results(R, num_queries, num_hits=20, num_docs=None):
+    """Generate a load_results style dict of random search results"""
+    if num_docs is None:
+        num_docs = num_queries * 10
+    results = {}
+    for i in xrange(num_queries):
+        hits = []
+        for _ in xrange(R.randint(0, num_hits)):
+            doc_id = R.randint(0, num_docs)
+            hits.append({'docId': str(doc_id), 'title': 'Title %d' % (doc_id)})
+        results['query %d' % (i)] = hits
+    return results
+
+
+def make_relevance_rows(R, results, max_grade=3, graded_frac=0.5):
+    """Generate (query, title, score) rows grading a portion of results"""
+    rows = []
+    for query, hits in results.items():
+        for hit in hits:
+            if R.random() < graded_frac:
+                rows.append((query, hit['title'], float(R.randint(0, max_grade))))
+    return rows
+
+
+def make_session_rows(R, results, num_sessions, max_queries=3, max_clicks=3):
+    """Generate (sessionId, clicked docId, query) rows over results"""
+    queries = list(results.keys())
+    rows = []
+    for i in xrange(num_sessions):
+        session_id = 'session %d' % (i)
+        session_queries = R.sample(queries, R.randint(1, max_queries))
+        candidates = [hit['docId'] for q in session_queries for hit in results[q]]
+        for query in session_queries:
+            rows.append((session_id, 'NULL', query))
+        for _ in xrange(min(len(candidates), R.randint(0, max_clicks))):
+            rows.append((session_id, R.choice(candidates), 'NULL'))
+    return rows
+
+
+def time_scorer(label, scorer, results):
+    start = time.time()
+    score = scorer.engine_score(results)
+    took = time.time() - start
+    print('%-24s %8.2fs' % (label, took))
+    return score, took
+
+
+def compare(name, python_scorer, numpy_scorer, results, skip_python):
+    numpy_score, numpy_took = time_scorer(name + ' (numpy)', numpy_scorer, results)
+    if skip_python:
+        return
+    python_score, python_took = time_scorer(name + ' (python)', python_scorer, results)
+    max_err = max(abs(a.score - b.score) for a, b in zip(python_score.scores, numpy_score.scores))
+    print('%-24s %8.1fx speedup, max abs difference %.3g' % (
+        '', python_took / numpy_took, max_err))
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark engine scoring backends', prog=sys.argv[0])
+    parser.add_argument(
+        '-q', '--queries', dest='num_queries', type=int, default=1000000,
+        help='Number of synthetic queries to score, default is 1000000')
+    parser.add_argument(
+        '-s', '--sessions', dest='num_sessions', type=int, default=None,
+        help='Number of synthetic PaulScore sessions, default is same as queries')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=0, help='Random seed')
+    parser.add_argument(
+        '--skip-python', dest='skip_python', action='store_true',
+        help='Only time the numpy backend')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    R = random.Random(args.seed)
+    num_sessions = args.num_sessions or args.num_queries
+    ks = list(range(1, 21))
+    factors = [0.9, 0.7, 0.5, 0.1]
+
+    print('Generating %d queries and %d sessions' % (args.num_queries, num_sessions))
+    results = make_results(R, args.num_queries)
+    relevance = make_relevance_rows(R, results)
+    sessions = make_session_rows(R, results, num_sessions)
+
+    options = {'k': ks, 'max_relevance_scale': 3}
+    compare('nDCG@[1..20]', scorers.nDCG(relevance, options),
+            vectorized.VectorizednDCG(relevance, options), results, args.skip_python)
+    compare('ERR@[1..20]', scorers.ERR(relevance, options),
+            vectorized.VectorizedERR(relevance, options), results, args.skip_python)
+    options = {'factor': factors}
+    compare('PaulScore', scorers.PaulScore(sessions, options),
+            vectorized.VectorizedPaulScore(sessions, options), results, args.skip_python)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
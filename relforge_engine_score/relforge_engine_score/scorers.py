@@ -20,6 +20,7 @@ import itertools
 import json
 import logging
 import math
+import multiprocessing
 import operator
 import random
 
@@ -34,7 +35,7 @@ except NameError:
 LOG = logging.getLogger(__name__)
 
 
-def init_scorer(settings):
+def init_scorer(settings, backend='python', workers=1):
     scoring_algos = {
         'PaulScore': PaulScore,
         'nDCG': nDCG,
@@ -42,32 +43,50 @@ def init_scorer(settings):
         'MRR': MRR_AC,
         'MPC': MPC,
     }
+    if backend == 'numpy':
+        # Algorithms without a vectorized implementation
+        # fall back to the pure python version.
+        from relforge_engine_score import vectorized
+        scoring_algos.update({
+            'PaulScore': vectorized.VectorizedPaulScore,
+            'nDCG': vectorized.VectorizednDCG,
+            'ERR': vectorized.VectorizedERR,
+        })
+    elif backend != 'python':
+        raise ValueError('Unknown scoring backend: {}'.format(backend))
 
     query = CachedQuery(settings)
-    query_data = query.fetch()
+    # Parse the query data a single time and share the same rows
+    # with every scorer.
+    query_data = list(query.fetch())
     scoring_configs = query.scoring_config
     if type(scoring_configs) != list:
         scoring_configs = [scoring_configs]
 
     scorers = []
-    iters = itertools.tee(query_data, len(scoring_configs))
-    for config, query_data_iter in zip(scoring_configs, iters):
+    for config in scoring_configs:
         algo = config['algorithm']
         print('Initializing engine scorer: %s' % (algo))
         scoring_class = scoring_algos[algo]
-        scorer = scoring_class(query_data_iter, config['options'])
+        scorer = scoring_class(query_data, config['options'])
         scorer.report()
         scorers.append(scorer)
 
     if len(scorers) > 1:
-        return MultiScorer(scorers)
+        return MultiScorer(scorers, workers)
     else:
         return scorers[0]
 
 
-def load_results(json_lines):
-    # Load the results
-    results = {}
+def iterate_results(json_lines):
+    """Decode result lines one at a time
+
+    Yields
+    ------
+    query : str
+    hits : list of dict
+        The docId and title of each hit in rank order
+    """
     for line in json_lines:
         decoded = json.loads(line)
         hits = []
@@ -85,16 +104,62 @@ def load_results(json_lines):
                     'docId': docId,
                     'title': hit['title'],
                 })
-        if decoded['query'] in results:
-            raise Exception('Duplicate result sets for {}'.format(decoded['query']))
-        results[decoded['query']] = hits
+        yield decoded['query'], hits
+
+
+def load_results(json_lines):
+    # Load the results
+    results = {}
+    for query, hits in iterate_results(json_lines):
+        if query in results:
+            raise Exception('Duplicate result sets for {}'.format(query))
+        results[query] = hits
     LOG.debug('Loaded %d results', len(results))
     return results
 
 
+def stream_engine_score(scorer, json_lines):
+    """Score results as they are read, without loading them all
+
+    Each query is handed to the scorer as its result line is decoded and
+    then discarded, so memory use is bounded by the data the scorer was
+    initialized with rather than by the size of the results.
+    """
+    seen = set()
+    scorer.start_stream()
+    for query, hits in iterate_results(json_lines):
+        if query in seen:
+            raise Exception('Duplicate result sets for {}'.format(query))
+        seen.add(query)
+        scorer.add_result(query, hits)
+    LOG.debug('Streamed %d results', len(seen))
+    return scorer.finish_stream()
+
+
+# State handed to forked MultiScorer workers. Children inherit this through
+# copy-on-write memory, so neither the scorers nor the results are pickled.
+_FORKED_STATE = {}
+
+
+def _forked_engine_score(i):
+    return _FORKED_STATE['scorers'][i].engine_score(_FORKED_STATE['results'])
+
+
+def _fork_context():
+    try:
+        return multiprocessing.get_context('fork')
+    except AttributeError:
+        # py 2.x always forks
+        return multiprocessing
+    except ValueError:
+        # platform without fork
+        return None
+
+
 class MultiScorer(object):
-    def __init__(self, scorers):
+    def __init__(self, scorers, workers=1):
         self.scorers = scorers
+        self.workers = workers
         self.queries = set([q for s in scorers for q in s.queries])
 
     def name(self):
@@ -104,16 +169,47 @@ class MultiScorer(object):
         for scorer in self.scorers:
             scorer.report()
 
-    def engine_score(self, results):
+    def _merge_scores(self, scorer_scores):
         scores = []
-        for scorer in self.scorers:
-            score = scorer.engine_score(results)
+        for score in scorer_scores:
             if type(score) == EngineScoreSet:
                 scores = scores + score.scores
             else:
                 scores.append(score)
         return EngineScoreSet(scores)
 
+    def _parallel_engine_score(self, results, context):
+        _FORKED_STATE.update(scorers=self.scorers, results=results)
+        try:
+            pool = context.Pool(min(self.workers, len(self.scorers)))
+            try:
+                # Start the slowest scorers, those with the most queries, first
+                order = sorted(range(len(self.scorers)), key=lambda i: -len(self.scorers[i].queries))
+                scores = dict(zip(order, pool.map(_forked_engine_score, order, chunksize=1)))
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _FORKED_STATE.clear()
+        return [scores[i] for i in range(len(self.scorers))]
+
+    def engine_score(self, results):
+        context = _fork_context()
+        if self.workers > 1 and len(self.scorers) > 1 and context is not None:
+            return self._merge_scores(self._parallel_engine_score(results, context))
+        return self._merge_scores(scorer.engine_score(results) for scorer in self.scorers)
+
+    def start_stream(self):
+        for scorer in self.scorers:
+            scorer.start_stream()
+
+    def add_result(self, query, hits):
+        for scorer in self.scorers:
+            scorer.add_result(query, hits)
+
+    def finish_stream(self):
+        return self._merge_scores(scorer.finish_stream() for scorer in self.scorers)
+
 
 class MRR_AC(object):
     """Mean Reciprocal Rank for Auto Complete"""
@@ -168,6 +264,37 @@ class MRR_AC(object):
                 N += 1
         return EngineScore(self.name(), score / N)
 
+    def start_stream(self):
+        # Flatten clicks and index them by every prefix that
+        # contributes to their score.
+        self._stream_clicks = [(query, str(page_id))
+                               for query, page_ids in self._queries.items()
+                               for page_id in page_ids]
+        self._stream_prefix_clicks = defaultdict(list)
+        for i, (query, _) in enumerate(self._stream_clicks):
+            for j in range(len(query)):
+                self._stream_prefix_clicks[query[:j + 1]].append(i)
+        self._stream_click_scores = [0.] * len(self._stream_clicks)
+        self._stream_seen = set()
+
+    def add_result(self, query, hits):
+        if query not in self._stream_prefix_clicks:
+            return
+        self._stream_seen.add(query)
+        result_list = {hit['docId']: i for i, hit in enumerate(hits, 1)}
+        for i in self._stream_prefix_clicks[query]:
+            j = result_list.get(self._stream_clicks[i][1])
+            if j is not None:
+                self._stream_click_scores[i] += 1. / j
+
+    def finish_stream(self):
+        for prefix in self._stream_prefix_clicks:
+            if prefix not in self._stream_seen:
+                raise Exception('Missing results for prefix {}'.format(prefix))
+        score = sum(click_score / len(query) for (query, _), click_score
+                    in zip(self._stream_clicks, self._stream_click_scores))
+        return EngineScore(self.name(), score / len(self._stream_clicks))
+
 
 def calc_mpc(queries):
     votes = defaultdict(Counter)
@@ -239,6 +366,16 @@ class MPC(object):
                 N += 1
         return EngineScore(self.name(), score / N)
 
+    # The model is built from the train set, search results are not used.
+    def start_stream(self):
+        pass
+
+    def add_result(self, query, hits):
+        pass
+
+    def finish_stream(self):
+        return self.engine_score({})
+
 
 # Discounted Cumulative Gain
 class DCG(object):
@@ -263,19 +400,21 @@ class DCG(object):
             return 0
         return self._relevance[query][title]
 
+    def _query_score(self, k, query, hits):
+        dcg = 0
+        for i in xrange(0, min(k, len(hits))):
+            top = math.pow(2, self._relevance_score(query, hits[i])) - 1
+            # Note this is i+2, rather than i+1, because the i+1 algo starts
+            # is 1 indexed, and we are 0 indexed. log base 2 of 1 is 0 and
+            # we would have a div by zero problem otherwise
+            dcg += top / math.log(i+2, 2)
+        return dcg
+
     # Returns the average DCG of the results
     def engine_score(self, results):
         self.dcgs = {}
         for query in results:
-            hits = results[query]
-            dcg = 0
-            for i in xrange(0, min(self.k, len(hits))):
-                top = math.pow(2, self._relevance_score(query, hits[i])) - 1
-                # Note this is i+2, rather than i+1, because the i+1 algo starts
-                # is 1 indexed, and we are 0 indexed. log base 2 of 1 is 0 and
-                # we would have a div by zero problem otherwise
-                dcg += top / math.log(i+2, 2)
-            self.dcgs[query] = dcg
+            self.dcgs[query] = self._query_score(self.k, query, results[query])
         return EngineScore(self.name(), sum(self.dcgs.values()) / len(results))
 
 
@@ -289,19 +428,22 @@ class IDCG(DCG):
     def name(self):
         return "IDCG@%d" % (self.k)
 
+    def _ideal_hits(self, query):
+        # Build up something that looks like the hits search returns
+        ideal_hits = []
+        for title in self._relevance[query]:
+            ideal_hits.append({'title': title})
+
+        # Sort them into the ideal order and slice to match
+        sorter = functools.partial(self._relevance_score, query)
+        return sorted(ideal_hits, key=sorter, reverse=True)
+
     # The results argument is unused here, as this is the ideal and unrelated
     # to the actual search results returned
     def engine_score(self, results):
         ideal_results = {}
         for query in self._relevance:
-            # Build up something that looks like the hits search returns
-            ideal_hits = []
-            for title in self._relevance[query]:
-                ideal_hits.append({'title': title})
-
-            # Sort them into the ideal order and slice to match
-            sorter = functools.partial(self._relevance_score, query)
-            ideal_results[query] = sorted(ideal_hits, key=sorter, reverse=True)
+            ideal_results[query] = self._ideal_hits(query)
 
         # Run DCG against the ideal ordered results
         return EngineScore(self.name(), super(IDCG, self).engine_score(ideal_results))
@@ -363,6 +505,32 @@ class nDCG(object):
             scores.append(EngineScore(self.name(k), sum(ndcgs) / len(ndcgs)))
         return EngineScoreSet(scores)
 
+    def start_stream(self):
+        self._stream_ndcgs = [0.] * len(self.k)
+        self._stream_count = 0
+        self._stream_errors = 0
+
+    def add_result(self, query, hits):
+        if query not in self.idcg._relevance:
+            LOG.debug("failed to find query (%s) in scores", query)
+            self._stream_errors += 1
+            return
+        ideal_hits = self.idcg._ideal_hits(query)
+        for i, k in enumerate(self.k):
+            idcg = self.idcg._query_score(k, query, ideal_hits)
+            if idcg > 0:
+                self._stream_ndcgs[i] += self.dcg._query_score(k, query, hits) / idcg
+        self._stream_count += 1
+
+    def finish_stream(self):
+        scores = []
+        for k, total in zip(self.k, self._stream_ndcgs):
+            if self._stream_errors > 0:
+                print("Expected %d queries, but %d were missing" % (
+                    self._stream_count + self._stream_errors, self._stream_errors))
+            scores.append(EngineScore(self.name(k), total / self._stream_count))
+        return EngineScoreSet(scores)
+
 
 # http://olivier.chapelle.cc/pub/err.pdf
 # http://don-metzler.net/presentations/err_cikm09.pdf
@@ -424,6 +592,20 @@ class ERR(DCG):
             scores.append(EngineScore(self.name(k), total_err / len(results)))
         return EngineScoreSet(scores)
 
+    def start_stream(self):
+        self._stream_errs = [0.] * len(self.k)
+        self._stream_count = 0
+
+    def add_result(self, query, hits):
+        for i, k in enumerate(self.k):
+            self._stream_errs[i] += self._query_score(k, query, hits)
+        self._stream_count += 1
+
+    def finish_stream(self):
+        return EngineScoreSet([
+            EngineScore(self.name(k), total_err / self._stream_count)
+            for k, total_err in zip(self.k, self._stream_errs)])
+
 
 # Formula from talk given by Paul Nelson at ElasticON 2016
 class PaulScore:
@@ -460,6 +642,14 @@ class PaulScore:
             }
         return sessions
 
+    def _hits_score(self, factor, clicks, hits, histogram):
+        score = 0.
+        for hit, pos in zip(hits, itertools.count()):
+            if hit['docId'] in clicks:
+                score += factor ** pos
+                histogram.add(pos)
+        return score
+
     def _query_score(self, factor, sessionId, query):
         try:
             hits = self.results[query]
@@ -467,12 +657,7 @@ class PaulScore:
             LOG.debug("missing query? oops...")
             return 0.
         clicks = self._sessions[sessionId]['clicks']
-        score = 0.
-        for hit, pos in zip(hits, itertools.count()):
-            if hit['docId'] in clicks:
-                score += factor ** pos
-                self.histogram.add(pos)
-        return score
+        return self._hits_score(factor, clicks, hits, self.histogram)
 
     def _session_score(self, factor, sessionId):
         queries = self._sessions[sessionId]['queries']
@@ -494,6 +679,38 @@ class PaulScore:
             scores.append(EngineScore(self.name(factor), score, self.histogram))
         return EngineScoreSet(scores)
 
+    def start_stream(self):
+        self._stream_query_sessions = defaultdict(list)
+        for sessionId, session in self._sessions.items():
+            for query in session['queries']:
+                self._stream_query_sessions[query].append(sessionId)
+        # Sum of query scores per session, one per factor. Queries that
+        # never arrive contribute 0, same as a missing query.
+        self._stream_session_scores = {
+            sessionId: [0.] * len(self.factors) for sessionId in self._sessions}
+        self._stream_histograms = [Histogram() for _ in self.factors]
+
+    def add_result(self, query, hits):
+        for sessionId in self._stream_query_sessions.get(query, []):
+            clicks = self._sessions[sessionId]['clicks']
+            session_scores = self._stream_session_scores[sessionId]
+            for i, factor in enumerate(self.factors):
+                session_scores[i] += self._hits_score(
+                    factor, clicks, hits, self._stream_histograms[i])
+
+    def finish_stream(self):
+        scores = []
+        for i, factor in enumerate(self.factors):
+            score = 0.
+            for sessionId, session in self._sessions.items():
+                if len(session['queries']) == 0:
+                    LOG.debug("session has no queries...")
+                    continue
+                score += self._stream_session_scores[sessionId][i] / len(session['queries'])
+            scores.append(EngineScore(
+                self.name(factor), score / len(self._sessions), self._stream_histograms[i]))
+        return EngineScoreSet(scores)
+
 
 class Histogram:
     def __init__(self):
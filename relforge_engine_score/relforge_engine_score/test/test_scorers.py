@@ -0,0 +1,92 @@
+import json
+import random
+
+import pytest
+
+from relforge_engine_score import scorers
+from relforge_engine_score.benchmark import make_relevance_rows, make_results, make_session_rows
+
+
+@pytest.fixture
+def results():
+    return make_results(random.Random(0), 200, num_docs=500)
+
+
+def to_json_lines(results):
+    for query, hits in results.items():
+        yield json.dumps({
+            'query': query,
+            'totalHits': len(hits),
+            'rows': hits,
+        })
+
+
+def assert_same_scores(expected, result):
+    if isinstance(expected, scorers.EngineScore):
+        expected = scorers.EngineScoreSet([expected])
+        result = scorers.EngineScoreSet([result])
+    assert [s.name for s in expected.scores] == [s.name for s in result.scores]
+    for a, b in zip(expected.scores, result.scores):
+        assert a.score == pytest.approx(b.score)
+        if a.histogram is not None:
+            assert a.histogram.data == b.histogram.data
+
+
+def test_load_results_roundtrip(results):
+    assert results == scorers.load_results(to_json_lines(results))
+
+
+def test_stream_rejects_duplicates(results):
+    scorer = scorers.ERR([], {'k': 3, 'max_relevance_scale': 3})
+    lines = list(to_json_lines(results))
+    with pytest.raises(Exception):
+        scorers.stream_engine_score(scorer, lines + lines[:1])
+
+
+def make_ndcg(results):
+    rows = make_relevance_rows(random.Random(1), results)
+    # Leave some queries without any relevance data
+    rows = [row for row in rows if not row[0].endswith('7')]
+    return scorers.nDCG(rows, {'k': [1, 3, 5, 10, 20]})
+
+
+def make_err(results):
+    rows = make_relevance_rows(random.Random(1), results)
+    return scorers.ERR(rows, {'k': [1, 3, 5, 10, 20], 'max_relevance_scale': 3})
+
+
+def make_paulscore(results):
+    rows = make_session_rows(random.Random(1), results, 300)
+    rows.append(('missing', 'NULL', 'not a query'))
+    rows.append(('missing', '1', 'NULL'))
+    return scorers.PaulScore(rows, {'factor': [0.9, 0.7, 0.5, 0.1]})
+
+
+def make_mrr(results):
+    # Every prefix of the queries must have results
+    queries = list(results.keys())[:10]
+    for query in queries:
+        for i in range(len(query)):
+            prefix = query[:i + 1]
+            if prefix not in results:
+                results[prefix] = results[query][:i]
+    rows = [(query, hit['docId']) for query in queries for hit in results[query][:2]]
+    return scorers.MRR_AC(rows, {})
+
+
+def make_multi(results):
+    return scorers.MultiScorer([make_ndcg(results), make_err(results), make_paulscore(results)])
+
+
+@pytest.mark.parametrize('make_scorer', [make_ndcg, make_err, make_paulscore, make_mrr, make_multi])
+def test_stream_engine_score(results, make_scorer):
+    scorer = make_scorer(results)
+    expected = scorer.engine_score(results)
+    result = scorers.stream_engine_score(scorer, to_json_lines(results))
+    assert_same_scores(expected, result)
+
+
+def test_parallel_multi_scorer(results):
+    serial = make_multi(results)
+    parallel = scorers.MultiScorer(serial.scorers, workers=3)
+    assert_same_scores(serial.engine_score(results), parallel.engine_score(results))
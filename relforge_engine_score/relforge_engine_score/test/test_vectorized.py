@@ -0,0 +1,62 @@
+import random
+
+import numpy as np
+import pytest
+
+from relforge_engine_score import scorers, vectorized
+from relforge_engine_score.benchmark import make_relevance_rows, make_results, make_session_rows
+
+
+@pytest.fixture
+def results():
+    return make_results(random.Random(0), 200, num_docs=500)
+
+
+def assert_same_scores(expected, result):
+    assert [s.name for s in expected.scores] == [s.name for s in result.scores]
+    for a, b in zip(expected.scores, result.scores):
+        assert a.score == pytest.approx(b.score)
+
+
+def test_pack_rows():
+    packed = vectorized.pack_rows([[1, 2, 3], [], [4]], 2, fill=-1, dtype=np.int64)
+    assert packed.tolist() == [[1, 2], [-1, -1], [4, -1]]
+
+
+def test_dcg_at_k_beyond_width():
+    dcg = vectorized.dcg_at_k(np.asarray([[1., 0.]]), [0, 1, 5])
+    assert dcg.tolist() == [[0., 1., 1.]]
+
+
+@pytest.mark.parametrize('k', [1, [1, 3, 5, 10, 20], [25]])
+def test_ndcg(results, k):
+    rows = make_relevance_rows(random.Random(1), results)
+    # Leave some queries without any relevance data
+    rows = [row for row in rows if not row[0].endswith('7')]
+    options = {'k': k}
+    expected = scorers.nDCG(rows, options).engine_score(results)
+    result = vectorized.VectorizednDCG(rows, options).engine_score(results)
+    assert_same_scores(expected, result)
+
+
+@pytest.mark.parametrize('k', [1, [1, 3, 5, 10, 20], [25]])
+def test_err(results, k):
+    rows = make_relevance_rows(random.Random(1), results)
+    options = {'k': k, 'max_relevance_scale': 3}
+    expected = scorers.ERR(rows, options).engine_score(results)
+    result = vectorized.VectorizedERR(rows, options).engine_score(results)
+    assert_same_scores(expected, result)
+
+
+@pytest.mark.parametrize('factor', [0.7, [0.9, 0.7, 0.5, 0.1]])
+def test_paulscore(results, factor):
+    rows = make_session_rows(random.Random(1), results, 300)
+    # sessions with clicks on queries that have no results
+    rows.append(('missing', 'NULL', 'not a query'))
+    rows.append(('missing', '1', 'NULL'))
+    options = {'factor': factor}
+    expected = scorers.PaulScore(rows, options).engine_score(results)
+    result = vectorized.VectorizedPaulScore(rows, options).engine_score(results)
+    assert_same_scores(expected, result)
+    for a, b in zip(expected.scores, result.scores):
+        assert a.histogram.data == b.histogram.data
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# vectorized.py - numpy backend for engine scoring
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+# http://www.gnu.org/copyleft/gpl.html
+
+"""Vectorized implementations of the engine scorers
+
+The scorers here share construction, naming and reporting with their pure
+python counterparts in relforge_engine_score.scorers, but replace the per
+query and per hit loops of engine_score with a single pass over dense
+(queries x k) matrices. Results and relevance grades are packed once per
+call, after which every k value (or PaulScore factor) is evaluated from the
+same cumulative arrays.
+"""
+
+import itertools
+
+import numpy as np
+
+from relforge_engine_score.scorers import \
+    nDCG, ERR, PaulScore, EngineScore, EngineScoreSet, Histogram
+
+
+def pack_rows(rows, width, fill=0, dtype=np.float64):
+    """Pack variable length rows into a dense matrix
+
+    Parameters
+    ----------
+    rows : list of list
+    width : int
+        Rows longer than width are truncated.
+    fill : scalar
+        Value for positions past the end of a row.
+    dtype : numpy dtype
+
+    Returns
+    -------
+    np.ndarray
+        Matrix of shape (len(rows), width)
+    """
+    packed = np.full((len(rows), width), fill, dtype=dtype)
+    lengths = np.fromiter((min(len(row), width) for row in rows),
+                          dtype=np.intp, count=len(rows))
+    values = np.fromiter(
+        itertools.chain.from_iterable(row[:width] for row in rows),
+        dtype=dtype, count=int(lengths.sum()))
+    # Boolean assignment fills in row-major order, matching the
+    # order values were chained together.
+    packed[np.arange(width) < lengths[:, None]] = values
+    return packed
+
+
+def cumulative_at_k(cumulative, ks):
+    """Select cumulative values at each k
+
+    Parameters
+    ----------
+    cumulative : np.ndarray
+        Matrix of shape (n, width) holding running sums along axis 1
+    ks : list of int
+
+    Returns
+    -------
+    np.ndarray
+        Matrix of shape (n, len(ks)). Values for k larger than width
+        are the total over the full row, k of 0 selects nothing.
+    """
+    n, width = cumulative.shape
+    # Leading zero column lets k=0, and empty matrices, fall out naturally
+    padded = np.hstack((np.zeros((n, 1)), cumulative))
+    return padded[:, np.minimum(ks, width)]
+
+
+def dcg_at_k(grades, ks):
+    """Discounted cumulative gain of each row of grades at each k
+
+    Parameters
+    ----------
+    grades : np.ndarray
+        Matrix of shape (n, width) of relevance grades in rank order.
+        Padding must be 0.
+    ks : list of int
+
+    Returns
+    -------
+    np.ndarray
+        Matrix of shape (n, len(ks))
+    """
+    gain = np.power(2., grades) - 1
+    # i + 2 rather than i + 1, positions are 0 indexed
+    discount = 1. / np.log2(np.arange(grades.shape[1]) + 2)
+    return cumulative_at_k(np.cumsum(gain * discount, axis=1), ks)
+
+
+def err_at_k(grades, ks, max_rel):
+    """Expected reciprocal rank of each row of grades at each k
+
+    Parameters
+    ----------
+    grades : np.ndarray
+        Matrix of shape (n, width) of relevance grades in rank order.
+        Padding must be 0.
+    ks : list of int
+    max_rel : float
+        Gain of the maximum relevance grade
+
+    Returns
+    -------
+    np.ndarray
+        Matrix of shape (n, len(ks))
+    """
+    n, width = grades.shape
+    prob_rel = (np.power(2., grades) - 1) / max_rel
+    # Probability the user is still looking when reaching each position
+    prob_reach = np.hstack((
+        np.ones((n, 1)),
+        np.cumprod(1 - prob_rel, axis=1)[:, :-1]))
+    rank = np.arange(1, width + 1)
+    return cumulative_at_k(np.cumsum(prob_reach * prob_rel / rank, axis=1), ks)
+
+
+class VectorizednDCG(nDCG):
+    def _grades(self, results, max_k):
+        relevance = self.dcg._relevance
+        empty = {}
+        return pack_rows([
+            [relevance.get(query, empty).get(hit['title'], 0) for hit in results[query][:max_k]]
+            for query in results], max_k)
+
+    def _ideal_grades(self, queries, max_k):
+        relevance = self.dcg._relevance
+        return pack_rows([
+            sorted(relevance[query].values(), reverse=True)[:max_k]
+            for query in queries], max_k)
+
+    def engine_score(self, results):
+        max_k = max(self.k)
+        dcgs = dcg_at_k(self._grades(results, max_k), self.k)
+        known = np.fromiter((query in self.dcg._relevance for query in results),
+                            dtype=bool, count=len(results))
+        known_queries = [query for query in results if query in self.dcg._relevance]
+        idcgs = dcg_at_k(self._ideal_grades(known_queries, max_k), self.k)
+        ndcgs = np.divide(dcgs[known], idcgs, out=np.zeros_like(idcgs), where=idcgs > 0)
+        errors = len(results) - len(known_queries)
+
+        scores = []
+        for i, k in enumerate(self.k):
+            if errors > 0:
+                print("Expected %d queries, but %d were missing" % (len(results), errors))
+            scores.append(EngineScore(self.name(k), ndcgs[:, i].sum() / len(ndcgs)))
+        return EngineScoreSet(scores)
+
+
+class VectorizedERR(ERR):
+    def _grades(self, results, max_k):
+        relevance = self._relevance
+        empty = {}
+        return pack_rows([
+            [relevance.get(query, empty).get(hit['title'], 0) for hit in results[query][:max_k]]
+            for query in results], max_k)
+
+    def engine_score(self, results):
+        errs = err_at_k(self._grades(results, max(self.k)), self.k, self.max_rel)
+        total_errs = errs.sum(axis=0)
+        return EngineScoreSet([
+            EngineScore(self.name(k), total_errs[i] / len(results))
+            for i, k in enumerate(self.k)])
+
+
+class VectorizedPaulScore(PaulScore):
+    def __init__(self, rows, options):
+        super(VectorizedPaulScore, self).__init__(rows, options)
+        # Clicked docIds are the only ones that can score, every other
+        # docId in the results collapses to -1 when packed.
+        self._doc_ids = {}
+        pair_session = []
+        self._pair_queries = []
+        click_session = []
+        click_doc = []
+        self._session_num_queries = np.zeros(len(self._sessions))
+        for i, session in enumerate(self._sessions.values()):
+            for click in session['clicks']:
+                click_session.append(i)
+                click_doc.append(self._doc_ids.setdefault(click, len(self._doc_ids)))
+            for query in session['queries']:
+                pair_session.append(i)
+                self._pair_queries.append(query)
+            self._session_num_queries[i] = len(session['queries'])
+        self._pair_session = np.asarray(pair_session, dtype=np.int64)
+        self._click_keys = self._session_doc_key(
+            np.asarray(click_session, dtype=np.int64),
+            np.asarray(click_doc, dtype=np.int64))
+
+    def _session_doc_key(self, session_idx, doc_idx):
+        return session_idx * len(self._doc_ids) + doc_idx
+
+    def _pack_results(self, results):
+        """Pack results into a (queries + 1, width) matrix of clicked doc ids
+
+        The final row is empty and used for queries missing from results.
+        """
+        width = max([len(hits) for hits in results.values()] + [0])
+        doc_ids = self._doc_ids
+        rows = [[doc_ids.get(hit['docId'], -1) for hit in hits] for hits in results.values()]
+        rows.append([])
+        row_idx = {query: i for i, query in enumerate(results)}
+        missing = len(rows) - 1
+        pair_rows = np.fromiter((row_idx.get(query, missing) for query in self._pair_queries),
+                                dtype=np.int64, count=len(self._pair_queries))
+        return pack_rows(rows, width, fill=-1, dtype=np.int64), pair_rows
+
+    def engine_score(self, results):
+        self.results = results
+        packed, pair_rows = self._pack_results(results)
+        # (pairs x width) matrix of docs shown for each (session, query) pair
+        pair_docs = packed[pair_rows]
+        clicked = (pair_docs >= 0) & np.isin(
+            self._session_doc_key(self._pair_session[:, None], pair_docs),
+            self._click_keys)
+
+        factors = np.asarray(self.factors, dtype=np.float64)
+        position_weights = np.power(factors[:, None], np.arange(clicked.shape[1]))
+        # (pairs x factors) score of each query within its session
+        pair_scores = np.dot(clicked.astype(np.float64), position_weights.T)
+
+        positions, counts = np.unique(np.nonzero(clicked)[1], return_counts=True)
+        scores = []
+        for i, factor in enumerate(self.factors):
+            session_scores = np.bincount(
+                self._pair_session, weights=pair_scores[:, i],
+                minlength=len(self._sessions))
+            session_scores = np.divide(
+                session_scores, self._session_num_queries,
+                out=np.zeros_like(session_scores),
+                where=self._session_num_queries > 0)
+            self.histogram = Histogram()
+            self.histogram.data = {int(pos): int(count) for pos, count in zip(positions, counts)}
+            score = session_scores.sum() / len(self._sessions)
+            scores.append(EngineScore(self.name(factor), score, self.histogram))
+        return EngineScoreSet(scores)
@@ -2,9 +2,11 @@ from setuptools import setup
 
 requirements = [
     'relforge',
+    'numpy',
 ]
 
 test_requirements = [
+    'pytest',
 ]
 
 setup(
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# compare.py - diff and report on two relevance lab query runs in one pass
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+# http://www.gnu.org/copyleft/gpl.html
+
+# Produces the same diffs/ pages as jsondiff.py and report.html as
+# relcomp.py, but reads both results files once and decodes each line
+# once, sharing the decoded results between the diff pages and the
+# metrics.
+
+import argparse
+import os
+import sys
+from functools import partial
+
+from relforge.parallel import map_ordered
+from relforge_relevance import jsondiff, relcomp
+
+
+def compare_chunk(chunk, options):
+    """Diff and measure a chunk of line pairs
+
+    chunk is a tuple of (index of the first pair, list of (baseline line,
+    delta line), printnum, seed), as read by relcomp.iterate_chunks.
+    options are the jsondiff options. Returns (metrics, errors, pages)
+    for merging into the totals.
+    """
+    index, line_pairs, printnum, seed = chunk
+    metrics = relcomp.make_metrics(printnum, seed)
+    errors = relcomp.make_errors(seed)
+    pages = []
+    for aline, bline in line_pairs:
+        index += 1
+        aresults = jsondiff.parse_line(aline)
+        bresults = jsondiff.parse_line(bline)
+        # Metrics first, rendering the diff modifies the results
+        pair = relcomp.ResultPair(relcomp.Result.from_json(aresults), relcomp.Result.from_json(bresults))
+        relcomp.measure_pair(pair, index, metrics, errors)
+        pages.append(jsondiff.diff_results(aresults, bresults, options))
+    return metrics, errors, pages
+
+
+def make_options(file1, file2, bytitle=False, bwiki='', dwiki='', bexplain='', dexplain='',
+                 changed_only=False, compare_scores=False):
+    """Build jsondiff options for comparing two results files"""
+    return {
+        'key': 'title' if bytitle else 'docId',
+        'file1': file1,
+        'file2': file2,
+        'bwiki': bwiki,
+        'dwiki': dwiki,
+        'bexplain': bexplain,
+        'dexplain': dexplain,
+        'changed_only': changed_only,
+        'compare_scores': compare_scores,
+    }
+
+
+def compare(file1, file2, target_dir, options, printnum=20, workers=1, chunk_size=1000,
+            seed=0, archive=False):
+    """Write diff pages and the metrics report comparing two query runs
+
+    Output matches running jsondiff.py with target_dir/diffs as its output
+    directory, followed by relcomp.py with target_dir. options are the
+    jsondiff options, see jsondiff.diff_results.
+
+    Returns:
+        number of query pairs compared
+    """
+    diffs_dir = os.path.join(target_dir, relcomp.diff_dir)
+    if not os.path.exists(diffs_dir):
+        os.makedirs(diffs_dir)
+
+    metrics = relcomp.make_metrics(printnum, seed)
+    errors = relcomp.make_errors(seed)
+    writer = jsondiff.DiffWriter(diffs_dir, archive)
+
+    chunks = relcomp.iterate_chunks(file1, file2, printnum, seed, chunk_size)
+    try:
+        for chunk_metrics, chunk_errors, pages in map_ordered(partial(compare_chunk, options=options), chunks, workers):
+            for m, chunk_m in zip(metrics, chunk_metrics):
+                m.merge(chunk_m)
+            errors.merge(chunk_errors)
+            for page in pages:
+                writer.add(page)
+    finally:
+        writer.close()
+
+    relcomp.init_target(target_dir)
+    relcomp.print_report(writer.diff_count, file1, file2, metrics, errors)
+    return writer.diff_count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate diffs and a report comparing two relevance lab query runs',
+        prog=sys.argv[0])
+    parser.add_argument('file', nargs=2, help='files to compare')
+    parser.add_argument('-d', '--dir', dest='dir', default='./comp/',
+                        help='output directory, default is ./comp/')
+    parser.add_argument('-p', '--printnum', dest='printnum', type=int, default=20,
+                        help='number of samples per metric, default is 20')
+    parser.add_argument('-t', '--bytitle', dest='bytitle', action='store_true', default=False,
+                        help='use title rather than docId to match results in diffs')
+    parser.add_argument('-w', '--baseWiki', dest='bwiki', default='',
+                        help='URL for baseline wiki')
+    parser.add_argument('-W', '--deltaWiki', dest='dwiki', default='',
+                        help='URL for delta wiki')
+    parser.add_argument('-e', '--baseExplain', dest='bexplain', default='',
+                        help='explain URL for baseline wiki')
+    parser.add_argument('-E', '--deltaExplain', dest='dexplain', default='',
+                        help='explain URL for delta wiki')
+    parser.add_argument('-c', '--changed-only', dest='changed_only', action='store_true', default=False,
+                        help='skip diff pages for query pairs with the same ranked results')
+    parser.add_argument('-s', '--compare-scores', dest='compare_scores', action='store_true', default=False,
+                        help='with --changed-only, also require the same scores to skip a pair')
+    parser.add_argument('-a', '--archive', dest='archive', action='store_true', default=False,
+                        help='write all diff pages into a single indexed archive file')
+    parser.add_argument('-j', '--workers', dest='workers', type=int, default=1,
+                        help='number of worker processes, default is 1')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=1000,
+                        help='query pairs per work unit, default is 1000')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='seed for choosing random examples, default is 0')
+    args = parser.parse_args()
+
+    (file1, file2) = args.file
+    options = make_options(file1, file2, bytitle=args.bytitle, bwiki=args.bwiki, dwiki=args.dwiki,
+                           bexplain=args.bexplain, dexplain=args.dexplain,
+                           changed_only=args.changed_only, compare_scores=args.compare_scores)
+    compare(file1, file2, args.dir, options, printnum=args.printnum, workers=args.workers,
+            chunk_size=args.chunk_size, seed=args.seed, archive=args.archive)
+
+
+if __name__ == '__main__':
+    main()
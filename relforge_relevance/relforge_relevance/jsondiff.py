@@ -30,12 +30,15 @@
 
 import argparse
 import difflib
+import hashlib
 import json
 import os
 import sys
-from itertools import zip_longest
+from collections import namedtuple
+from itertools import islice, zip_longest
 import urllib
 import urllib.parse
+from relforge.parallel import map_ordered
 from relforge_relevance.utils import asciify
 
 
@@ -56,6 +59,39 @@ def extract_ids(results, key):
     return retval
 
 
+def get_result_score(result):
+    if 'score' in result:
+        return result['score']
+    if result.get('explanation'):
+        return get_main_score(result['explanation'])
+    return None
+
+
+def result_digest(results, key, scores=False):
+    """Hash the ranked list of ids, and optionally scores, of a result set
+
+    Errors are included in the hash, but equal digests of failed queries
+    don't mean they are unchanged, see results_changed.
+    """
+    rows = results.get('rows', [])
+    if scores:
+        ranked = [[result.get(key), get_result_score(result)] for result in rows]
+    else:
+        ranked = [result.get(key) for result in rows]
+    return hashlib.sha1(json.dumps([results.get('error'), ranked]).encode('utf-8')).digest()
+
+
+def results_changed(aresults, bresults, key, scores=False):
+    """Check if two result sets differ in their ranked ids (and scores)
+
+    Failed queries are always considered changed, even when both sides
+    carry the same error, so failures always get a diff page.
+    """
+    if 'error' in aresults or 'error' in bresults:
+        return True
+    return result_digest(aresults, key, scores) != result_digest(bresults, key, scores)
+
+
 def munge_explanation(results):
     if 'rows' not in results:
         return {}
@@ -105,19 +141,23 @@ def has_phrase_rescore(exp):
     return is_ph == 'secondaryWeight'
 
 
+def make_ranks(pageids):
+    """Map each id to its 1-based rank, keeping the first if repeated"""
+    ranks = {}
+    for rank, id in enumerate(pageids, start=1):
+        if id not in ranks:
+            ranks[id] = rank
+    return ranks
+
+
 def make_map(apageids, bpageids):
     amap = {}
     bmap = {}
-    union = list(set(apageids) | set(bpageids))
-    for id in union:
-        if id in apageids:
-            aindex = apageids.index(id) + 1
-        else:
-            aindex = 0
-        if id in bpageids:
-            bindex = bpageids.index(id) + 1
-        else:
-            bindex = 0
+    aranks = make_ranks(apageids)
+    branks = make_ranks(bpageids)
+    for id in set(aranks) | set(branks):
+        aindex = aranks.get(id, 0)
+        bindex = branks.get(id, 0)
         amap[aindex] = bindex
         bmap[bindex] = aindex  # don't care if 0 gets overwritten
     return amap, bmap
@@ -126,9 +166,11 @@ def make_map(apageids, bpageids):
 def add_diffs(aresults, bresults, key):
     if 'rows' in aresults and 'rows' in bresults:
         arows = aresults['rows']
-        brows = bresults['rows']
+        bmatches = {}
+        for x in bresults['rows']:
+            bmatches.setdefault(x[key], x)
         for aresult in arows:
-            bresult = next((x for x in brows if aresult[key] == x[key]), None)
+            bresult = bmatches.get(aresult[key])
             if bresult:
                 for item in aresult.keys():
                     if item in bresult:
@@ -445,6 +487,211 @@ function alignAllDivs() {
 '''
 
 
+def parse_line(line):
+    """Decode a line of search results, treating blank lines as empty results"""
+    line = line.strip(' \t\n')
+    if line == '':
+        line = '{}'
+    return json.loads(line)
+
+
+def diff_page(aline, bline, options):
+    """Render the HTML diff page of a pair of result lines, see diff_results"""
+    return diff_results(parse_line(aline), parse_line(bline), options)
+
+
+def diff_results(aresults, bresults, options):
+    """Render the HTML diff page of a pair of decoded results
+
+    options is a dict with the key used to match results, the names of
+    the compared files and the wiki and explain urls for each of them.
+    When options['changed_only'] is set None is returned for pairs with
+    the same ranked ids (and scores, with options['compare_scores']).
+    The results are modified while rendering.
+    """
+    key = options['key']
+
+    if options.get('changed_only'):
+        compare_scores = options.get('compare_scores', False)
+        if not results_changed(aresults, bresults, key, compare_scores):
+            return None
+
+    # munge lucene explanation
+    munge_explanation(aresults)
+    munge_explanation(bresults)
+
+    apageids = extract_ids(aresults, key)
+    bpageids = extract_ids(bresults, key)
+
+    s = difflib.SequenceMatcher(None, apageids, bpageids)
+
+    amap, bmap = make_map(apageids, bpageids)
+
+    add_diffs(aresults, bresults, key)
+
+    return ''.join([
+        html_head(s),
+        html_results(aresults, amap, options['file1'], key, wiki_url=options['bwiki'],
+                     explain_url=options['bexplain'], baseline=True),
+        html_results(bresults, bmap, options['file2'], key, wiki_url=options['dwiki'],
+                     explain_url=options['dexplain'], baseline=False),
+        html_foot(),
+    ])
+
+
+def diff_chunk(chunk):
+    """Render a list of (baseline line, delta line) pairs into a list of pages
+
+    Pages of unchanged pairs are None, see diff_page.
+    """
+    line_pairs, options = chunk
+    return [diff_page(aline, bline, options) for aline, bline in line_pairs]
+
+
+def iterate_pages(file1, file2, options, workers=1, chunk_size=100):
+    """Render diff pages (or None for skipped pairs) of two result files, in input order
+
+    With workers > 1 chunks of line pairs are rendered by a pool of
+    worker processes, with a bounded number of chunks in flight.
+    """
+    with open(file1) as a, open(file2) as b:
+        line_pairs = zip_longest(a, b, fillvalue='{}')
+        chunks = iter(lambda: (list(islice(line_pairs, chunk_size)), options), ([], options))
+        for pages in map_ordered(diff_chunk, chunks, workers):
+            for page in pages:
+                yield page
+
+
+ARCHIVE_FILE = 'diffs.archive'
+DIFF_INDEX_FILE = 'diffs.index'
+WRITE_BUFFER_SIZE = 1 << 20
+
+DiffIndexEntry = namedtuple('DiffIndexEntry', ['changed', 'offset', 'length'])
+
+
+class PageWriter(object):
+    """Write each diff page to its own diff<n>.html file"""
+
+    def __init__(self, target_dir):
+        self.target_dir = target_dir
+        # An archive left by an earlier run would hide the new pages
+        archive_path = os.path.join(target_dir, ARCHIVE_FILE)
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+
+    def write(self, diff_count, page):
+        """Write a page, returning the offset and length of its bytes"""
+        data = page.encode('utf-8')
+        path = os.path.join(self.target_dir, 'diff' + repr(diff_count) + '.html')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return 0, len(data)
+
+    def close(self):
+        pass
+
+
+class ArchiveWriter(object):
+    """Write all diff pages, utf-8 encoded, one after the other into ARCHIVE_FILE"""
+
+    def __init__(self, target_dir):
+        self.archive = open(os.path.join(target_dir, ARCHIVE_FILE), 'wb',
+                            buffering=WRITE_BUFFER_SIZE)
+        self.offset = 0
+
+    def write(self, diff_count, page):
+        """Write a page, returning the offset and length of its bytes"""
+        data = page.encode('utf-8')
+        offset = self.offset
+        self.archive.write(data)
+        self.offset += len(data)
+        return offset, len(data)
+
+    def close(self):
+        self.archive.close()
+
+
+def read_diff_index(target_dir):
+    """Load the index of a jsondiff output directory
+
+    DIFF_INDEX_FILE holds a tab separated line of diff number, changed flag,
+    byte offset and byte length for each query pair. Pairs that were skipped
+    as unchanged have no page.
+
+    Returns:
+        dict from diff number to DiffIndexEntry
+    """
+    index = {}
+    with open(os.path.join(target_dir, DIFF_INDEX_FILE)) as f:
+        for line in f:
+            diff_count, changed, offset, length = line.rstrip('\n').split('\t')
+            index[int(diff_count)] = DiffIndexEntry(changed == '1', int(offset), int(length))
+    return index
+
+
+def pages_archived(target_dir):
+    """Check if the diff pages of a jsondiff output directory were archived
+
+    Archived pages are only available through read_archived_page, there
+    are no diff<n>.html files to link to.
+    """
+    return os.path.exists(os.path.join(target_dir, ARCHIVE_FILE))
+
+
+def read_archived_page(target_dir, diff_count, index=None):
+    """Read a single diff page back out of an archive, None if it was skipped"""
+    if index is None:
+        index = read_diff_index(target_dir)
+    entry = index[diff_count]
+    if not entry.changed:
+        return None
+    with open(os.path.join(target_dir, ARCHIVE_FILE), 'rb') as f:
+        f.seek(entry.offset)
+        return f.read(entry.length).decode('utf-8')
+
+
+class DiffWriter(object):
+    """Write numbered diff pages along with their index
+
+    Pages are written to their own files, or a single archive. None
+    pages are recorded as unchanged in the index, see read_diff_index.
+    """
+
+    def __init__(self, target_dir, archive=False):
+        self.writer = ArchiveWriter(target_dir) if archive else PageWriter(target_dir)
+        self.index = open(os.path.join(target_dir, DIFF_INDEX_FILE), 'w')
+        self.diff_count = 0
+        self.page_count = 0
+
+    def add(self, page):
+        self.diff_count += 1
+        if page is None:
+            self.index.write('{}\t0\t0\t0\n'.format(self.diff_count))
+            return
+        self.page_count += 1
+        offset, length = self.writer.write(self.diff_count, page)
+        self.index.write('{}\t1\t{}\t{}\n'.format(self.diff_count, offset, length))
+
+    def close(self):
+        self.writer.close()
+        self.index.close()
+
+
+def write_diffs(file1, file2, target_dir, options, workers=1, chunk_size=100, archive=False):
+    """Write diff pages for all line pairs of two result files, along with their index
+
+    Returns:
+        tuple of the number of query pairs and the number of pages written
+    """
+    writer = DiffWriter(target_dir, archive)
+    try:
+        for page in iterate_pages(file1, file2, options, workers, chunk_size):
+            writer.add(page)
+    finally:
+        writer.close()
+    return writer.diff_count, writer.page_count
+
+
 def main():
     parser = argparse.ArgumentParser(description='line-by-line diff of JSON blobs',
                                      prog=sys.argv[0])
@@ -461,6 +708,17 @@ def main():
                         help="explain URL for baseline wiki")
     parser.add_argument("-E", "--deltaExplain", dest="dexplain", default='',
                         help="explain URL for delta wiki")
+    parser.add_argument("-j", "--workers", dest="workers", type=int, default=1,
+                        help="number of worker processes rendering pages, default is 1")
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=100,
+                        help="query pairs rendered per work unit, default is 100")
+    parser.add_argument("-a", "--archive", dest="archive", action='store_true', default=False,
+                        help="write all pages into a single indexed archive file, "
+                             "rather than one file per page")
+    parser.add_argument("-c", "--changed-only", dest="changed_only", action='store_true', default=False,
+                        help="skip query pairs with the same ranked results")
+    parser.add_argument("-s", "--compare-scores", dest="compare_scores", action='store_true', default=False,
+                        help="with --changed-only, also require the same scores to skip a pair")
     args = parser.parse_args()
 
     key = 'docId'
@@ -470,46 +728,22 @@ def main():
     (file1, file2) = args.file
     target_dir = args.dir + '/'
 
-    diff_count = 0
-
     if not os.path.exists(target_dir):
         os.makedirs(os.path.dirname(target_dir))
 
-    with open(file1) as a, open(file2) as b:
-        for aline, bline in zip_longest(a, b, fillvalue='{}'):
-            aline = aline.strip(' \t\n')
-            bline = bline.strip(' \t\n')
-            if aline == '':
-                aline = '{}'
-            if bline == '':
-                bline = '{}'
-            diff_count += 1
-            diff_file = open(target_dir + 'diff' + repr(diff_count) + '.html', 'w')
-
-            aresults = json.loads(aline)
-            bresults = json.loads(bline)
-
-            # munge lucene explanation
-            munge_explanation(aresults)
-            munge_explanation(bresults)
-
-            apageids = extract_ids(aresults, key)
-            bpageids = extract_ids(bresults, key)
-
-            s = difflib.SequenceMatcher(None, apageids, bpageids)
-
-            amap, bmap = make_map(apageids, bpageids)
-
-            add_diffs(aresults, bresults, key)
-
-            diff_file.writelines(html_head(s))
-            diff_file.writelines(html_results(aresults, amap, file1, key, wiki_url=args.bwiki,
-                                              explain_url=args.bexplain, baseline=True))
-            diff_file.writelines(html_results(bresults, bmap, file2, key, wiki_url=args.dwiki,
-                                              explain_url=args.dexplain, baseline=False))
-            diff_file.writelines(html_foot())
-
-            diff_file.close()
+    options = {
+        'key': key,
+        'file1': file1,
+        'file2': file2,
+        'bwiki': args.bwiki,
+        'dwiki': args.dwiki,
+        'bexplain': args.bexplain,
+        'dexplain': args.dexplain,
+        'changed_only': args.changed_only,
+        'compare_scores': args.compare_scores,
+    }
+    write_diffs(file1, file2, target_dir, options, workers=args.workers,
+                chunk_size=args.chunk_size, archive=args.archive)
 
 
 if __name__ == "__main__":
@@ -24,23 +24,322 @@
 from __future__ import division
 
 import argparse
+import heapq
 import json
+import math
 import matplotlib.pyplot as plt
 import matplotlib.ticker as tick
-import numpy
 import os
 import sys
 import textwrap
 
 from abc import ABCMeta, abstractmethod
-from itertools import zip_longest
-from random import shuffle
+from collections import namedtuple
+from itertools import islice, zip_longest
 
+from relforge.parallel import map_ordered
+from relforge_relevance.jsondiff import DIFF_INDEX_FILE, pages_archived, read_diff_index
 from relforge_relevance.utils import asciify
 
 target_path = ""
 image_dir = "images/"
 image_path = ""
+diff_dir = "diffs/"
+# diff numbers that have a page, or None to assume all of them do
+diff_pages = None
+
+
+def load_diff_pages(path):
+    """Find the diff pages written by jsondiff, if it left an index
+
+    Archived pages have no file to link to, so none are returned.
+    """
+    if not os.path.exists(os.path.join(path, DIFF_INDEX_FILE)):
+        return None
+    if pages_archived(path):
+        return set()
+    return set(n for n, entry in read_diff_index(path).items() if entry.changed)
+
+
+def diff_link(index, text):
+    """Link text to the diff page of a query pair, if that page exists"""
+    if diff_pages is not None and index not in diff_pages:
+        return text
+    return u"<a href='{}diff{}.html'>{}</a>".format(diff_dir, index, text)
+
+
+class Result(namedtuple('Result', ['query', 'total_hits', 'doc_ids', 'empty', 'error'])):
+    """Compact record of the parts of a search result the metrics look at
+
+    Attributes:
+        query: the query string, or "" if not present
+        total_hits: totalHits of the result, 0 if not present
+        doc_ids: tuple of result docIds, in rank order
+        empty: True if the result was an empty json object
+        error: True if the result reported an error
+    """
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, line):
+        line = line.strip(" \t\n")
+        if line == "":
+            line = "{}"
+        return cls.from_json(json.loads(line))
+
+    @classmethod
+    def from_json(cls, x):
+        return cls(x.get("query", ""), x.get("totalHits", 0),
+                   tuple([r["docId"] for r in x.get("rows", ())]),
+                   len(x) == 0, "error" in x)
+
+
+class ResultPair(object):
+    """A baseline and delta result being compared
+
+    Comparisons of the top N results are computed once per N and shared by
+    all metrics measuring the pair, e.g. the sorted and unsorted variants
+    of TopNDiff.
+    """
+    __slots__ = ('baseline', 'delta', '_topn')
+
+    def __init__(self, baseline, delta):
+        self.baseline = baseline
+        self.delta = delta
+        self._topn = {}
+
+    def reversed(self):
+        return ResultPair(self.delta, self.baseline)
+
+    def topn(self, n):
+        """Compare the top n docIds of baseline and delta
+
+        Returns:
+            (number of distinct baseline ids, number of distinct delta ids,
+             number of ids in both, True if both lists are identical)
+        """
+        stats = self._topn.get(n)
+        if stats is not None:
+            return stats
+        x_ids = self.baseline.doc_ids[:n]
+        y_ids = self.delta.doc_ids[:n]
+        if x_ids == y_ids:
+            size = len(set(x_ids))
+            stats = (size, size, size, True)
+        else:
+            x_ids = set(x_ids)
+            y_ids = set(y_ids)
+            stats = (len(x_ids), len(y_ids), len(x_ids & y_ids), False)
+        self._topn[n] = stats
+        return stats
+
+
+def mix_index(index, seed=0):
+    """Deterministically map an index to a pseudo-random 64 bit key (splitmix64)"""
+    mask = 0xFFFFFFFFFFFFFFFF
+    z = (index + seed * 0x632BE59BD9B4E019 + 0x9E3779B97F4A7C15) & mask
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask
+    return z ^ (z >> 31)
+
+
+class Reservoir(object):
+    """Fixed size sample of examples, along with an exact count of all examples
+
+    Each example gets a key derived from its index and the seed, and the
+    examples with the smallest keys are kept. The sample therefore only
+    depends on which indexes were added, not the order they were added in,
+    so reservoirs filled by separate workers can be merged, and reports
+    are reproducible for a given seed.
+
+    Attributes:
+        size: maximum number of examples kept
+        seed: seed of the example keys
+        ordered: keep the first examples by index, rather than a random sample
+        count: total number of examples added
+    """
+
+    def __init__(self, size, seed=0, ordered=False):
+        self.size = size
+        self.seed = seed
+        self.ordered = ordered
+        self.count = 0
+        # max heap of kept examples, as (-key, index, example)
+        self._heap = []
+
+    def __len__(self):
+        return self.count
+
+    def _push(self, key, index, example):
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, (-key, index, example))
+        elif self._heap and key < -self._heap[0][0]:
+            heapq.heapreplace(self._heap, (-key, index, example))
+
+    def add(self, index, example):
+        self.count += 1
+        if self.size > 0:
+            self._push(index if self.ordered else mix_index(index, self.seed), index, example)
+
+    def merge(self, other):
+        self.count += other.count
+        for neg_key, index, example in other._heap:
+            self._push(-neg_key, index, example)
+
+    def examples(self):
+        """List of [index, example]
+
+        All examples in index order if none were dropped, otherwise the
+        sample in random (or index, if ordered) order.
+        """
+        if self.count <= self.size:
+            kept = sorted(self._heap, key=lambda x: x[1])
+        else:
+            kept = sorted(self._heap, reverse=True)
+        return [[index, example] for _, index, example in kept]
+
+
+class ValueSketch(object):
+    """Mergeable summary of a stream of numbers, for charts and statistics
+
+    Count, mean, standard deviation, min and max are exact. Each distinct
+    value is counted exactly until there are more than max_exact of them,
+    after which values are collapsed into logarithmic buckets that keep
+    quantiles and histograms within a relative accuracy of alpha (as in
+    DDSketch). Memory is bounded by max_exact, or the number of buckets
+    needed to span the range of values, regardless of the stream length.
+    """
+
+    def __init__(self, alpha=0.01, max_exact=2048):
+        self.alpha = alpha
+        self.max_exact = max_exact
+        self.count = 0
+        self.mean = 0.
+        self._m2 = 0.
+        self._min = None
+        self._max = None
+        # value -> count, until collapsed into _buckets
+        self._exact = {}
+        # (sign, log bucket index) -> count
+        self._buckets = None
+        self._log_gamma = math.log((1 + alpha) / (1 - alpha))
+
+    @property
+    def min(self):
+        return float('nan') if self._min is None else self._min
+
+    @property
+    def max(self):
+        return float('nan') if self._max is None else self._max
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / self.count) if self.count else float('nan')
+
+    def _bucket_key(self, value):
+        if value == 0:
+            return (0, 0)
+        return (1 if value > 0 else -1, int(math.ceil(math.log(abs(value)) / self._log_gamma)))
+
+    def _bucket_value(self, key):
+        sign, index = key
+        gamma = math.exp(self._log_gamma)
+        return sign * 2 * math.exp(index * self._log_gamma) / (gamma + 1)
+
+    def _collapse(self):
+        self._buckets = {}
+        for value, count in self._exact.items():
+            self._add_to_buckets(value, count)
+        self._exact = None
+
+    def _add_to_buckets(self, value, count):
+        key = self._bucket_key(value)
+        self._buckets[key] = self._buckets.get(key, 0) + count
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self._min is None or value < self._min:
+            self._min = value
+        if self._max is None or value > self._max:
+            self._max = value
+
+        if self._exact is not None:
+            self._exact[value] = self._exact.get(value, 0) + 1
+            if len(self._exact) > self.max_exact:
+                self._collapse()
+        else:
+            self._add_to_buckets(value, 1)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self._min = other._min if self._min is None else min(self._min, other._min)
+        self._max = other._max if self._max is None else max(self._max, other._max)
+
+        if self._exact is not None and other._exact is not None:
+            for value, value_count in other._exact.items():
+                self._exact[value] = self._exact.get(value, 0) + value_count
+            if len(self._exact) > self.max_exact:
+                self._collapse()
+            return
+        if self._exact is not None:
+            self._collapse()
+        if other._exact is not None:
+            for value, value_count in other._exact.items():
+                self._add_to_buckets(value, value_count)
+        else:
+            for key, value_count in other._buckets.items():
+                self._buckets[key] = self._buckets.get(key, 0) + value_count
+
+    def values(self):
+        """Sorted list of (value, count). Values are approximate once collapsed."""
+        if self._exact is not None:
+            return sorted(self._exact.items())
+        return sorted((self._bucket_value(key), count) for key, count in self._buckets.items())
+
+    def quantile(self, q):
+        """Value at quantile q, interpolated between neighbours like numpy.percentile"""
+        if self.count == 0:
+            return float('nan')
+        rank = q * (self.count - 1)
+        lower = int(math.floor(rank))
+        upper = int(math.ceil(rank))
+        lower_value = upper_value = None
+        seen = 0
+        for value, count in self.values():
+            seen += count
+            if lower_value is None and seen > lower:
+                lower_value = value
+            if seen > upper:
+                upper_value = value
+                break
+        return lower_value + (upper_value - lower_value) * (rank - lower)
+
+
+class Magnitude(object):
+    """Sketches of how much changed per query pair, as a count and as a
+       fraction of the baseline total.
+    """
+
+    def __init__(self):
+        self.num_changed = ValueSketch()
+        self.pct_changed = ValueSketch()
+
+    def add(self, total, changed):
+        self.num_changed.add(changed)
+        self.pct_changed.add(changed / total if total != 0 else changed)
+
+    def merge(self, other):
+        self.num_changed.merge(other.num_changed)
+        self.pct_changed.merge(other.pct_changed)
 
 
 class Metric(object):
@@ -52,11 +351,14 @@ class Metric(object):
         total_queries: number of queries processed by this metric
         baseline_count: number of queries in the baseline satisfying the metric
         delta_count: number of queries in the delta satisfying the metric
-        b2d_diff: examples of metric present in baseline, absent in delta
-        d2b_diff: examples of metric present in delta, absent in baseline (unsymmetric)
+        b2d_diff: Reservoir of examples of metric present in baseline, absent in delta
+        d2b_diff: Reservoir of examples of metric present in delta, absent in
+            baseline (unsymmetric)
         symmetric: boolean indicating whether metric is symmetric
         printnum: max number of examples to print
-        printset: "random" or "ordered"--determines the order of examples printed
+        printset: "random" or "ordered"--determines which examples are printed,
+            a seeded random sample or the first ones
+        seed: seed of the random example sample
         raw_count: should output be raw_count rather than percent
         symbols: mnemonic symbols; [0] used for b2d or symmetric, [1] used for d2b
 
@@ -73,21 +375,23 @@ class Metric(object):
 
     def __init__(self, name, symmetric=False, raw_count=False,
                  printset="random", printnum=20,
-                 symbols=["&Delta;", "&Delta;"]):
+                 symbols=["&Delta;", "&Delta;"], seed=0):
         self.name = name
         self.symmetric = symmetric
         self.printset = printset
         self.printnum = printnum
         self.symbols = symbols
-        self.b2d_diff = []
-        self.d2b_diff = []
+        self.seed = seed
+        ordered = printset != "random"
+        self.b2d_diff = Reservoir(printnum, seed, ordered)
+        self.d2b_diff = Reservoir(printnum, seed, ordered)
         self.raw_count = raw_count
         self.total_queries = 0
         self.baseline_count = 0
         self.delta_count = 0
 
-    def measure(self, baseline, delta, index):
-        """Compares baseline json object to delta json object and
+    def measure(self, pair, index):
+        """Compares the baseline and delta results of a ResultPair and
            determines whether the metric criteria are met, then does
            appropriate bookkeeping. index serves as an id for the pair
            being compared.
@@ -97,30 +401,40 @@ class Metric(object):
         baseline_is = False  # does baseline qualify?
         delta_is = False     # does delta qualify?
 
-        if self.has_condition(baseline, delta, is_baseline=True):
+        if self.has_condition(pair, is_baseline=True):
             baseline_is = True
             self.baseline_count += 1
 
-        if not self.symmetric and self.has_condition(delta, baseline):
+        if not self.symmetric and self.has_condition(pair.reversed()):
             delta_is = True
             self.delta_count += 1
 
         if baseline_is and not delta_is:
-            self.add_diff(baseline, delta, index)
+            self.add_diff(pair, index)
 
         if not self.symmetric and not baseline_is and delta_is:
-            self.add_diff(baseline, delta, index, delta=True)
+            self.add_diff(pair, index, delta=True)
 
-    def add_diff(self, b, d, index, delta=False):
+    def add_diff(self, pair, index, delta=False):
         """Add example diff to b2d_diff (delta=False) or d2b_diff (delta=True)
         """
 
-        query_string = make_query_string(b, d)
+        query_string = make_query_string(pair.baseline, pair.delta)
 
         if delta:
-            self.d2b_diff.append([index, query_string])
+            self.d2b_diff.add(index, query_string)
         else:
-            self.b2d_diff.append([index, query_string])
+            self.b2d_diff.add(index, query_string)
+
+    def merge(self, other):
+        """Add in the counts and examples of another instance of this
+           metric that measured later query pairs.
+        """
+        self.total_queries += other.total_queries
+        self.baseline_count += other.baseline_count
+        self.delta_count += other.delta_count
+        self.b2d_diff.merge(other.b2d_diff)
+        self.d2b_diff.merge(other.d2b_diff)
 
     def results(self, what="diff"):
         """Returns a string with the metric results
@@ -157,16 +471,10 @@ class Metric(object):
             ret_string = "<b>{}</b>\n".format(self.name)
             ret_string += toggle_string()
             printed = 0
-            if self.printset == "random":
-                # shuffle, unless all will be printed, then don't bother
-                if (len(self.b2d_diff) > self.printnum):
-                    shuffle(self.b2d_diff)
-                if (len(self.d2b_diff) > self.printnum):
-                    shuffle(self.d2b_diff)
-            for ex in self.b2d_diff:
+            for ex in self.b2d_diff.examples():
                 ret_string += \
-                    u"&nbsp;&nbsp;{} <a href='diffs/diff{}.html'>{}</a><br>\n".format(
-                        self.symbols[0], ex[0], ex[1]
+                    u"&nbsp;&nbsp;{} {}<br>\n".format(
+                        self.symbols[0], diff_link(ex[0], ex[1])
                         )
                 printed += 1
                 if printed >= self.printnum:
@@ -174,10 +482,10 @@ class Metric(object):
             if not self.symmetric:
                 ret_string += "<br>\n"
                 printed = 0
-                for ex in self.d2b_diff:
+                for ex in self.d2b_diff.examples():
                     ret_string += \
-                        u"&nbsp;&nbsp;{} <a href='diffs/diff{}.html'>{}</a><br>\n".format(
-                            self.symbols[1], ex[0], ex[1]
+                        u"&nbsp;&nbsp;{} {}<br>\n".format(
+                            self.symbols[1], diff_link(ex[0], ex[1])
                             )
                     printed += 1
                     if printed >= self.printnum:
@@ -188,9 +496,10 @@ class Metric(object):
         return ""
 
     @abstractmethod
-    def has_condition(self, x, y, is_baseline):
-        """Return true or false on whether the condition of the metric is satisfied.
-           Can also gather other statistics for more complex metrics here.
+    def has_condition(self, pair, is_baseline):
+        """Return true or false on whether the condition of the metric is satisfied
+           by pair.baseline, compared to pair.delta. Can also gather other statistics
+           for more complex metrics here.
         """
         pass
 
@@ -200,21 +509,17 @@ class HitsWithinRange(Metric):
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, name, max, min=0, printnum=20):
+    def __init__(self, name, max, min=0, printnum=20, seed=0):
         super(HitsWithinRange, self).__init__(name,
                                               symbols=["&darr;", "&uarr;"],
-                                              printnum=printnum)
+                                              printnum=printnum, seed=seed)
         self.max = max
         self.min = min
 
-    def has_condition(self, x, y, is_baseline=False):
+    def has_condition(self, pair, is_baseline=False):
         """Simple check: is min <= totalHits <= max?
         """
-        if "totalHits" in x:
-            x_hits = x["totalHits"]
-        else:
-            x_hits = 0  # empty JSON mean no hits
-
+        x_hits = pair.baseline.total_hits
         return x_hits >= self.min and x_hits <= self.max
 
 
@@ -225,14 +530,14 @@ class TopNDiff(Metric):
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, topN=5, sorted=False, showstats=False, printnum=20):
+    def __init__(self, topN=5, sorted=False, showstats=False, printnum=20, seed=0):
         sortstr = "Sorted" if sorted else "Unsorted"
         self.sorted = sorted
         self.topN = topN
-        self.magnitude = []
+        self.magnitude = Magnitude()
         self.showstats = showstats
         super(TopNDiff, self).__init__("Top {} {} Results Differ".format(topN, sortstr),
-                                       symmetric=True, printnum=printnum)
+                                       symmetric=True, printnum=printnum, seed=seed)
 
     def results(self, what="diff"):
         global image_path
@@ -243,47 +548,27 @@ class TopNDiff(Metric):
                                       bins=self.topN)
         return ret_string
 
-    def has_condition(self, x, y, is_baseline=False):
-        if "totalHits" in x:
-            x_hits = x["totalHits"]
-        else:
-            x_hits = 0
-        if "totalHits" in y:
-            y_hits = y["totalHits"]
-        else:
-            y_hits = 0
-
-        if x_hits == 0 and y_hits == 0:
+    def has_condition(self, pair, is_baseline=False):
+        if pair.baseline.total_hits == 0 and pair.delta.total_hits == 0:
             if not self.sorted and self.showstats:
-                self.magnitude.append([0, 0])
+                self.magnitude.add(0, 0)
             return 0  # no hits means no diff
 
-        if "rows" not in x:
-            x["rows"] = list()
-        if "rows" not in y:
-            y["rows"] = list()
-        x_ids = [r["docId"] for r in x["rows"][0:self.topN]]
-        y_ids = [r["docId"] for r in y["rows"][0:self.topN]]
-
+        x_size, y_size, overlap, same_order = pair.topn(self.topN)
         if self.sorted:
-            if len(x_ids) != len(y_ids):
-                return 1
-            if x_ids == y_ids:
-                return 0
-        else:
-            x_ids = set(x_ids)
-            y_ids = set(y_ids)
-            if self.showstats:
-                intersection = x_ids.intersection(y_ids)
-                edit_dist = max(len(x_ids), len(y_ids)) - len(intersection)
-                self.magnitude.append([len(x_ids), edit_dist])
-            if len(x_ids) != len(y_ids):
-                return 1
-            if x_ids == y_ids:
-                return 0
+            return 0 if same_order else 1
 
+        if self.showstats:
+            edit_dist = max(x_size, y_size) - overlap
+            self.magnitude.add(x_size, edit_dist)
+        if x_size == y_size == overlap:
+            return 0
         return 1
 
+    def merge(self, other):
+        super(TopNDiff, self).merge(other)
+        self.magnitude.merge(other.magnitude)
+
 
 class QueryCount(Metric):
     """A count of queries in this query set. Also includes stats on TotalHits per query."""
@@ -292,21 +577,19 @@ class QueryCount(Metric):
 
     def __init__(self, resultscount=True):
         self.resultscount = resultscount
-        self.magnitude = []
+        self.magnitude = Magnitude()
         super(QueryCount, self).__init__("Query Count", raw_count=True, printnum=0)
 
-    def has_condition(self, x, y, is_baseline=False):
+    def has_condition(self, pair, is_baseline=False):
         if self.resultscount and is_baseline:
-            if "totalHits" in x:
-                x_hits = x["totalHits"]
-            else:
-                x_hits = 0
-            if "totalHits" in y:
-                y_hits = y["totalHits"]
-            else:
-                y_hits = 0
-            self.magnitude.append([x_hits, y_hits-x_hits])
-        return not len(x) == 0
+            x_hits = pair.baseline.total_hits
+            y_hits = pair.delta.total_hits
+            self.magnitude.add(x_hits, y_hits-x_hits)
+        return not pair.baseline.empty
+
+    def merge(self, other):
+        super(QueryCount, self).merge(other)
+        self.magnitude.merge(other.magnitude)
 
     def results(self, what="diff"):
         global image_path
@@ -318,17 +601,10 @@ class QueryCount(Metric):
 
 
 def make_query_string(x, y):
-    query_string = x_query = y_query = ""
-
-    if "query" in x:
-        x_query = x["query"]
-    if "query" in y:
-        y_query = y["query"]
-
-    if x_query == y_query:
-        query_string = x_query
+    if x.query == y.query:
+        query_string = x.query
     else:
-        query_string = u"{} / {}".format(x_query, y_query)
+        query_string = u"{} / {}".format(x.query, y.query)
 
     if query_string == "":
         query_string = "[no-query-string]"
@@ -338,6 +614,7 @@ def make_query_string(x, y):
 
 def print_report(diff_count, file1, file2, myMetrics, errors):
     global target_path
+    toggle_string.num = 0
     report_file = open(target_path + "report.html", "w")
     report_file.write(textwrap.dedent("""\
         <script>
@@ -368,16 +645,9 @@ def print_report(diff_count, file1, file2, myMetrics, errors):
         report_file.write("<br>\n<font color=red><b>QUERY PAIRS WITH ERRORS " +
                           "{}</b></font>\n".format(len(errors)))
         report_file.write(toggle_string())
-        printed = 0
-        keylist = errors.keys()
-        shuffle(keylist)
-        for e in keylist:
+        for e, query_string in errors.examples():
             report_file.write("&nbsp;&nbsp; <font color=red>ERROR</font> " +
-                              "<a href='diffs/diff{}.html'>{}</a><br>\n".
-                              format(e, asciify(errors[e])))
-            printed += 1
-            if printed >= 50:
-                break
+                              "{}<br>\n".format(diff_link(e, asciify(query_string))))
         report_file.write("</span>\n")
 
     report_file.write(textwrap.dedent("""\
@@ -425,11 +695,14 @@ toggle_string.num = 0
 
 
 def make_hist(data, file, title="", xlab="", ylab="", bins=20, yformat="", xformat=""):
+    """Plot a histogram of a list of (value, count)"""
     plt.clf()
+    values = [x[0] for x in data]
+    weights = [x[1] for x in data]
     if bins:
-        plt.hist(data, bins)
+        plt.hist(values, bins, weights=weights)
     else:
-        plt.hist(data)
+        plt.hist(values, weights=weights)
     if title:
         plt.title(title)
     if xlab:
@@ -451,37 +724,38 @@ def make_hist(data, file, title="", xlab="", ylab="", bins=20, yformat="", xform
     fig.savefig(file)
 
 
-def make_charts(data, file_prefix, label, lessThan1000=False, bins=20):
+def make_charts(magnitude, file_prefix, label, lessThan1000=False, bins=20):
     ret_string = ""
-    num_changed = [x[1] for x in data]
-    pct_changed = [x[1]/x[0] if x[0] != 0 else x[1] for x in data]
+    num_changed = magnitude.num_changed
+    pct_changed = magnitude.pct_changed
+    num_values = num_changed.values()
     indent = "&nbsp;&nbsp; &nbsp;&nbsp; "
     file_num0 = "{}_num0.png".format(file_prefix)
     file_num = "{}_num.png".format(file_prefix)
     file_pct = "{}_pct.png".format(file_prefix)
-    make_hist(num_changed, image_path + file_num0, bins=bins,
+    make_hist(num_values, image_path + file_num0, bins=bins,
               xlab="Number {} Changed".format(label), ylab="Frequency",
               title="All queries, by number of changed {}".format(label))
-    make_hist([x for x in num_changed if x != 0], image_path + file_num, bins=bins,
+    make_hist([x for x in num_values if x[0] != 0], image_path + file_num, bins=bins,
               xlab="Number {} Changed".format(label), ylab="Frequency",
               title="Changed queries, by number of changed {}".format(label))
-    make_hist([x for x in pct_changed if x != 0], image_path + file_pct, bins=bins,
+    make_hist([x for x in pct_changed.values() if x[0] != 0], image_path + file_pct, bins=bins,
               xlab="Percent {} Changed".format(label), ylab="Frequency", xformat="pct",
               title="Changed queries, by percent of changed {}".format(label))
     ret_string += indent + "Num {} Changed: &mu;: ".format(label) +\
         "{:0.2f}; &sigma;: {:0.2f}; median: {:0.2f}; range: [{:0.0f}, {:0.0f}]<br>\n".format(
-        numpy.mean(num_changed), numpy.std(num_changed), numpy.median(num_changed),
-        numpy.amin(num_changed), numpy.amax(num_changed))
+        num_changed.mean, num_changed.std, num_changed.quantile(0.5),
+        num_changed.min, num_changed.max)
     ret_string += indent + "Pct {} Changed: &mu;: ".format(label) +\
         "{:0.1f}%; &sigma;: {:0.1f}%; median: {:0.1f}%; range: [{:0.2f}%, {:0.2f}%]<br>\n".format(
-        numpy.mean(pct_changed)*100, numpy.std(pct_changed)*100, numpy.median(pct_changed)*100,
-        numpy.amin(pct_changed)*100, numpy.amax(pct_changed)*100)
+        pct_changed.mean*100, pct_changed.std*100, pct_changed.quantile(0.5)*100,
+        pct_changed.min*100, pct_changed.max*100)
     ret_string += indent + "Charts " + toggle_string() + "<br>\n" +\
         indent + "<a href='{0}'><img src='{0}' height=125></a>".format(image_dir + file_num0) +\
         indent + "<a href='{0}'><img src='{0}' height=125></a>".format(image_dir + file_num)
     if (lessThan1000):
         file_within100 = "{}_within100.png".format(file_prefix)
-        make_hist([x for x in num_changed if abs(x) < 1000 and x != 0],
+        make_hist([x for x in num_values if abs(x[0]) < 1000 and x[0] != 0],
                   image_path + file_within100, bins=100,
                   xlab="Number {} Changed".format(label), ylab="Frequency",
                   title="Changed queries, changed by < 1000, by number of changed {}".format(label))
@@ -493,6 +767,103 @@ def make_charts(data, file_prefix, label, lessThan1000=False, bins=20):
     return ret_string
 
 
+def make_metrics(printnum=20, seed=0):
+    # TODO: make this configurable from the .ini file
+    return [
+        QueryCount(),
+        HitsWithinRange("Zero Results Rate", 0, 0, printnum=printnum, seed=seed),
+        HitsWithinRange("Poorly Performing Percentage", 2, 0, printnum=printnum, seed=seed),
+        TopNDiff(1, sorted=False, printnum=printnum, showstats=True, seed=seed),
+        TopNDiff(3, sorted=True, printnum=printnum, seed=seed),
+        TopNDiff(3, sorted=False, printnum=printnum, showstats=True, seed=seed),
+        TopNDiff(5, sorted=True, printnum=printnum, seed=seed),
+        TopNDiff(5, sorted=False, printnum=printnum, showstats=True, seed=seed),
+        TopNDiff(20, sorted=True, printnum=printnum, seed=seed),
+        TopNDiff(20, sorted=False, printnum=printnum, showstats=True, seed=seed)
+        ]
+
+
+def make_errors(seed=0):
+    """Reservoir of query pairs with errors, keeping examples to report"""
+    return Reservoir(50, seed)
+
+
+def measure_chunk(chunk):
+    """Measure a fresh set of metrics over a chunk of line pairs
+
+    chunk is a tuple of (index of the first pair, list of (baseline line,
+    delta line), printnum, seed). Returns (metrics, errors, number of
+    pairs) for merging into the totals.
+    """
+    index, line_pairs, printnum, seed = chunk
+    metrics = make_metrics(printnum, seed)
+    errors = make_errors(seed)
+    for aline, bline in line_pairs:
+        index += 1
+        measure_pair(ResultPair(Result.parse(aline), Result.parse(bline)), index, metrics, errors)
+    return metrics, errors, len(line_pairs)
+
+
+def measure_pair(pair, index, metrics, errors):
+    """Measure all metrics over a query pair, or record it as an error"""
+    if pair.baseline.error or pair.delta.error:
+        errors.add(index, make_query_string(pair.baseline, pair.delta))
+        return
+
+    for m in metrics:
+        m.measure(pair, index)
+
+
+def iterate_chunks(file1, file2, printnum, seed, chunk_size):
+    with open(file1) as a, open(file2) as b:
+        line_pairs = zip_longest(a, b, fillvalue="{}")
+        index = 0
+        while True:
+            chunk = list(islice(line_pairs, chunk_size))
+            if not chunk:
+                break
+            yield index, chunk, printnum, seed
+            index += len(chunk)
+
+
+def compare_files(file1, file2, printnum=20, workers=1, chunk_size=10000, seed=0):
+    """Measure all metrics over two relevance lab query runs
+
+    Line pairs are measured in chunks, by a pool of worker processes if
+    workers > 1, and the per chunk metrics merged in input order. Results
+    do not depend on workers or chunk_size.
+
+    Returns:
+        (number of query pairs, metrics, Reservoir of (pair index, query
+         string) of pairs with errors)
+    """
+    metrics = make_metrics(printnum, seed)
+    errors = make_errors(seed)
+    diff_count = 0
+    chunks = iterate_chunks(file1, file2, printnum, seed, chunk_size)
+    for chunk_metrics, chunk_errors, num_pairs in map_ordered(measure_chunk, chunks, workers):
+        diff_count += num_pairs
+        for m, chunk_m in zip(metrics, chunk_metrics):
+            m.merge(chunk_m)
+        errors.merge(chunk_errors)
+    return diff_count, metrics, errors
+
+
+def init_target(target_dir):
+    """Create the report output directory, and find the diff pages in it"""
+    global target_path
+    global image_path
+    global diff_pages
+    target_path = target_dir + "/"
+    image_path = target_path + image_dir
+    diff_pages = load_diff_pages(target_path + diff_dir)
+
+    if not os.path.exists(target_path):
+        os.makedirs(os.path.dirname(target_path))
+    if not os.path.exists(image_path):
+        os.makedirs(os.path.dirname(image_path))
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Generate a report comparing two relevance lab query runs",
@@ -503,58 +874,21 @@ def main():
                         help="output directory, default is ./comp/")
     parser.add_argument("-p", "--printnum", dest="printnum", default=20,
                         help="number of samples per metric, default is 20")
+    parser.add_argument("-j", "--workers", dest="workers", type=int, default=1,
+                        help="number of worker processes measuring metrics, default is 1")
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=10000,
+                        help="query pairs measured per work unit, default is 10000")
+    parser.add_argument("--seed", dest="seed", type=int, default=0,
+                        help="seed for choosing random examples, default is 0")
     args = parser.parse_args()
 
     (file1, file2) = args.file
-    global target_path
-    global image_path
-    target_path = args.dir + "/"
-    image_path = target_path + image_dir
+    init_target(args.dir)
     printnum = int(args.printnum)
 
-    if not os.path.exists(target_path):
-        os.makedirs(os.path.dirname(target_path))
-    if not os.path.exists(image_path):
-        os.makedirs(os.path.dirname(image_path))
-
-    diff_count = 0
-    errors = {}
-
-    # set up metrics
-    # TODO: make this configurable from the .ini file
-    myMetrics = [
-        QueryCount(),
-        HitsWithinRange("Zero Results Rate", 0, 0, printnum=printnum),
-        HitsWithinRange("Poorly Performing Percentage", 2, 0, printnum=printnum),
-        TopNDiff(1, sorted=False, printnum=printnum, showstats=True),
-        TopNDiff(3, sorted=True, printnum=printnum),
-        TopNDiff(3, sorted=False, printnum=printnum, showstats=True),
-        TopNDiff(5, sorted=True, printnum=printnum),
-        TopNDiff(5, sorted=False, printnum=printnum, showstats=True),
-        TopNDiff(20, sorted=True, printnum=printnum),
-        TopNDiff(20, sorted=False, printnum=printnum, showstats=True)
-        ]
-
-    with open(file1) as a, open(file2) as b:
-        for tuple in zip_longest(a, b, fillvalue="{}"):
-            (aline, bline) = tuple
-            aline = aline.strip(" \t\n")
-            bline = bline.strip(" \t\n")
-            if aline == "":
-                aline = "{}"
-            if bline == "":
-                bline = "{}"
-            ajson = json.loads(aline)
-            bjson = json.loads(bline)
-
-            diff_count += 1
-
-            if 'error' in ajson or 'error' in bjson:
-                errors[diff_count] = make_query_string(ajson, bjson)
-                continue
-
-            for m in myMetrics:
-                m.measure(ajson, bjson, diff_count)
+    diff_count, myMetrics, errors = compare_files(
+        file1, file2, printnum, workers=args.workers, chunk_size=args.chunk_size,
+        seed=args.seed)
 
     print_report(diff_count, file1, file2, myMetrics, errors)
 
@@ -21,6 +21,8 @@ from configparser import ConfigParser
 import relforge.runner
 import shutil
 
+from relforge_relevance import compare
+
 
 def distributeGlobalSettings(config, globals, sections, settings):
     # if settings are missing from sections, copy from globals
@@ -30,18 +32,48 @@ def distributeGlobalSettings(config, globals, sections, settings):
                 config.set(sec, set, config.get(globals, set))
 
 
+def at_least_one(raw_val):
+    val = int(raw_val)
+    if val >= 1:
+        return val
+    raise ValueError('Expected {} to be at least 1'.format(val))
+
+
 def main():
     parser = argparse.ArgumentParser(description='Run relevance lab queries', prog=sys.argv[0])
     parser.add_argument('-c', '--config', dest='config', help='Configuration file name',
                         required=True)
+    parser.add_argument('-p', '--parallel', dest='parallel', action='store_true',
+                        help='Run the test1 and test2 queries concurrently')
+    parser.add_argument('-s', '--shards', dest='shards', type=int, default=1,
+                        help='Split each query set across this many parallel ssh sessions, default is 1')
+    parser.add_argument('--max-per-host', dest='max_per_host', type=at_least_one, default=None,
+                        help='Limit concurrent ssh sessions against a single lab host')
+    parser.add_argument('-i', '--in-process', dest='in_process', action='store_true',
+                        help='Generate diffs and the report in process, reading each results file once, ' +
+                             'rather than running the configured jsonDiffTool and metricTool')
+    parser.add_argument('-j', '--workers', dest='workers', type=int, default=1,
+                        help='Worker processes generating in process diffs and report, default is 1')
+    parser.add_argument('--changed-only', dest='changed_only', action='store_true',
+                        help='With --in-process, skip diff pages for query pairs with the same ranked results')
+    parser.add_argument('--compare-scores', dest='compare_scores', action='store_true',
+                        help='With --changed-only, also require the same scores to skip a pair')
+    parser.add_argument('--archive', dest='archive', action='store_true',
+                        help='With --in-process, write all diff pages into a single indexed archive file')
     args = parser.parse_args()
+    if not args.in_process and (args.changed_only or args.compare_scores or args.archive):
+        parser.error('--changed-only, --compare-scores and --archive require --in-process')
 
     config = ConfigParser()
     config.readfp(open(args.config))
     distributeGlobalSettings(config, 'settings', ['test1', 'test2'],
                              ['queries', 'labHost', 'searchCommand', 'config',
                               'wikiUrl', 'explainUrl', 'allowReuse'])
-    relforge.runner.checkSettings(config, 'settings', ['workDir', 'jsonDiffTool', 'metricTool'])
+    if args.in_process:
+        relforge.runner.checkSettings(config, 'settings', ['workDir'])
+        relforge.runner.defaults(config, 'settings', {'printNum': '20'})
+    else:
+        relforge.runner.checkSettings(config, 'settings', ['workDir', 'jsonDiffTool', 'metricTool'])
     relforge.runner.checkSettings(config, 'test1', ['name', 'queries', 'labHost', 'searchCommand'])
     relforge.runner.checkSettings(config, 'test2', ['name', 'queries', 'labHost', 'searchCommand'])
     # The string 'true' is intentional, configparser option values must be strings.
@@ -49,8 +81,13 @@ def main():
     relforge.runner.defaults(config, 'test1', {'wikiUrl': '', 'explainUrl': '', 'allowReuse': 'true'})
     relforge.runner.defaults(config, 'test2', {'wikiUrl': '', 'explainUrl': '', 'allowReuse': 'true'})
 
-    res1 = relforge.runner.runSearch(config, 'test1')
-    res2 = relforge.runner.runSearch(config, 'test2')
+    if args.parallel:
+        res1, res2 = relforge.runner.runSearches(
+            config, ['test1', 'test2'], shards=args.shards, max_per_host=args.max_per_host)
+    else:
+        host_slots = relforge.runner.HostSlots(args.max_per_host)
+        res1 = relforge.runner.runSearch(config, 'test1', shards=args.shards, host_slots=host_slots)
+        res2 = relforge.runner.runSearch(config, 'test2', shards=args.shards, host_slots=host_slots)
     comparisonDir = "%s/comparisons/%s_%s" % (
             config.get('settings', 'workDir'),
             relforge.runner.getSafeName(config.get('test1', 'name')),
@@ -58,6 +95,17 @@ def main():
     relforge.runner.refreshDir(comparisonDir)
     shutil.copyfile(args.config, comparisonDir + "/config.ini")  # archive comparison config
 
+    if args.in_process:
+        options = compare.make_options(
+            res1, res2,
+            bwiki=config.get('test1', 'wikiUrl'), dwiki=config.get('test2', 'wikiUrl'),
+            bexplain=config.get('test1', 'explainUrl'), dexplain=config.get('test2', 'explainUrl'),
+            changed_only=args.changed_only, compare_scores=args.compare_scores)
+        compare.compare(res1, res2, comparisonDir, options,
+                        printnum=config.getint('settings', 'printNum'), workers=args.workers,
+                        archive=args.archive)
+        return
+
     relforge.runner.runCommand("%s %s -w %s -W %s -e '%s' -E '%s' %s %s" % (
         config.get('settings', 'jsonDiffTool'),
         comparisonDir + "/diffs",
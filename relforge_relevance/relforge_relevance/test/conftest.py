@@ -0,0 +1,12 @@
+import pytest
+
+from relforge_relevance.test.test_relcomp import BASELINE, DELTA
+
+
+@pytest.fixture
+def files(tmpdir):
+    baseline = tmpdir.join('baseline')
+    baseline.write('\n'.join(BASELINE) + '\n')
+    delta = tmpdir.join('delta')
+    delta.write('\n'.join(DELTA) + '\n')
+    return str(baseline), str(delta)
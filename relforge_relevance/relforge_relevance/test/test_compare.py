@@ -0,0 +1,44 @@
+import pytest
+
+from relforge_relevance import compare, jsondiff, relcomp
+from relforge_relevance.test.test_relcomp import BASELINE, DELTA
+
+
+def run_tools(file1, file2, target_dir, options, printnum):
+    """Generate the comparison the way the separate jsondiff and relcomp tools do"""
+    target_dir.mkdir('diffs')
+    jsondiff.write_diffs(file1, file2, str(target_dir.join('diffs')), options)
+    relcomp.init_target(str(target_dir))
+    diff_count, metrics, errors = relcomp.compare_files(file1, file2, printnum, chunk_size=2)
+    relcomp.print_report(diff_count, file1, file2, metrics, errors)
+
+
+@pytest.mark.parametrize('workers,changed_only', [(1, False), (2, False), (1, True)])
+def test_compare_matches_tools(files, tmpdir, workers, changed_only):
+    options = compare.make_options(files[0], files[1], changed_only=changed_only)
+    expect_dir = tmpdir.mkdir('tools')
+    run_tools(files[0], files[1], expect_dir, options, 3)
+
+    out = tmpdir.join('compare')
+    diff_count = compare.compare(files[0], files[1], str(out), options, printnum=3,
+                                 workers=workers, chunk_size=2)
+    assert diff_count == max(len(BASELINE), len(DELTA))
+
+    expect = expect_dir.join('diffs')
+    names = sorted(x.basename for x in expect.listdir())
+    assert sorted(x.basename for x in out.join('diffs').listdir()) == names
+    for name in names:
+        assert out.join('diffs', name).read() == expect.join(name).read()
+    report = out.join('report.html').read().replace(str(out), str(expect_dir))
+    assert report == expect_dir.join('report.html').read()
+
+
+def test_main_options(files, tmpdir, monkeypatch):
+    calls = []
+    monkeypatch.setattr(compare, 'compare', lambda *args, **kwargs: calls.append((args, kwargs)))
+    monkeypatch.setattr('sys.argv', ['compare.py', '-c', '-s', '-a', '-d', str(tmpdir), files[0], files[1]])
+    compare.main()
+    (args, kwargs), = calls
+    assert args[3]['changed_only']
+    assert args[3]['compare_scores']
+    assert kwargs['archive']
@@ -0,0 +1,142 @@
+import json
+
+import pytest
+
+from relforge_relevance import jsondiff
+
+
+def make_result(query, doc_ids):
+    return json.dumps({
+        'query': query,
+        'totalHits': len(doc_ids),
+        'rows': [{'docId': doc_id, 'title': 'Title %d' % (doc_id), 'score': 1.0 / (i + 1)}
+                 for i, doc_id in enumerate(doc_ids)],
+    })
+
+
+BASELINE = [
+    make_result('same', [1, 2, 3]),
+    make_result('reordered', [1, 2, 3, 4]),
+    make_result('replaced', [1, 2, 3]),
+    '{}',
+]
+
+DELTA = [
+    make_result('same', [1, 2, 3]),
+    make_result('reordered', [4, 2, 1, 3]),
+    make_result('replaced', [1, 5, 3]),
+    make_result('found', [7]),
+    make_result('extra', [8]),
+]
+
+OPTIONS = {
+    'key': 'docId',
+    'file1': 'baseline',
+    'file2': 'delta',
+    'bwiki': '',
+    'dwiki': '',
+    'bexplain': '',
+    'dexplain': '',
+}
+
+
+@pytest.fixture
+def files(tmpdir):
+    file1 = tmpdir.join('baseline')
+    file1.write('\n'.join(BASELINE) + '\n')
+    file2 = tmpdir.join('delta')
+    file2.write('\n'.join(DELTA) + '\n')
+    return str(file1), str(file2)
+
+
+def old_make_map(apageids, bpageids):
+    amap = {}
+    bmap = {}
+    for id in set(apageids) | set(bpageids):
+        aindex = apageids.index(id) + 1 if id in apageids else 0
+        bindex = bpageids.index(id) + 1 if id in bpageids else 0
+        amap[aindex] = bindex
+        bmap[bindex] = aindex
+    return amap, bmap
+
+
+@pytest.mark.parametrize('apageids,bpageids', [
+    ([1, 2, 3], [1, 2, 3]),
+    ([1, 2, 3], [3, 2, 1]),
+    ([1, 2, 3], [4, 5]),
+    ([1, 2, 1], [2]),
+    ([], [1]),
+])
+def test_make_map(apageids, bpageids):
+    amap, bmap = jsondiff.make_map(apageids, bpageids)
+    expect_amap, expect_bmap = old_make_map(apageids, bpageids)
+    assert amap == expect_amap
+    # position 0 holds an arbitrary unmatched id
+    assert {k: v for k, v in bmap.items() if k} == {k: v for k, v in expect_bmap.items() if k}
+
+
+def test_add_diffs_matches_first_result():
+    aresults = {'rows': [{'docId': 1, 'title': 'a b'}]}
+    bresults = {'rows': [{'docId': 1, 'title': 'a c'}, {'docId': 1, 'title': 'a b'}]}
+    jsondiff.add_diffs(aresults, bresults, 'docId')
+    assert aresults['rows'][0]['title'] != 'a b'
+    assert bresults['rows'][0]['title'] != 'a c'
+    assert bresults['rows'][1]['title'] == 'a b'
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_write_diffs(files, tmpdir, workers):
+    serial = list(jsondiff.iterate_pages(files[0], files[1], OPTIONS))
+    assert len(serial) == len(DELTA)
+    out = tmpdir.mkdir('diffs')
+    assert jsondiff.write_diffs(files[0], files[1], str(out), OPTIONS,
+                                workers=workers, chunk_size=2) == (len(DELTA), len(DELTA))
+    for i, page in enumerate(serial):
+        assert out.join('diff%d.html' % (i + 1)).read() == page
+    index = jsondiff.read_diff_index(str(out))
+    assert all(entry.changed for entry in index.values())
+
+
+def test_write_diffs_archive(files, tmpdir):
+    serial = list(jsondiff.iterate_pages(files[0], files[1], OPTIONS))
+    out = tmpdir.mkdir('diffs')
+    jsondiff.write_diffs(files[0], files[1], str(out), OPTIONS, archive=True)
+    assert sorted(x.basename for x in out.listdir()) == [jsondiff.ARCHIVE_FILE, jsondiff.DIFF_INDEX_FILE]
+    index = jsondiff.read_diff_index(str(out))
+    assert sorted(index.keys()) == list(range(1, len(DELTA) + 1))
+    for i, page in enumerate(serial):
+        assert jsondiff.read_archived_page(str(out), i + 1, index) == page
+
+
+@pytest.mark.parametrize('archive', [False, True])
+def test_write_diffs_changed_only(files, tmpdir, archive):
+    serial = list(jsondiff.iterate_pages(files[0], files[1], OPTIONS))
+    out = tmpdir.mkdir('diffs')
+    options = dict(OPTIONS, changed_only=True)
+    assert jsondiff.write_diffs(files[0], files[1], str(out), options, archive=archive) == (len(DELTA), len(DELTA) - 1)
+    index = jsondiff.read_diff_index(str(out))
+    assert [n for n, entry in sorted(index.items()) if not entry.changed] == [1]
+    assert not out.join('diff1.html').exists()
+    if archive:
+        assert jsondiff.read_archived_page(str(out), 1, index) is None
+        assert jsondiff.read_archived_page(str(out), 2, index) == serial[1]
+    else:
+        assert out.join('diff2.html').read() == serial[1]
+
+
+def test_result_digest_scores():
+    aresults = json.loads(make_result('q', [1, 2]))
+    bresults = json.loads(make_result('q', [1, 2]))
+    bresults['rows'][1]['score'] = 0.1
+    assert jsondiff.result_digest(aresults, 'docId') == jsondiff.result_digest(bresults, 'docId')
+    assert jsondiff.result_digest(aresults, 'docId', True) != jsondiff.result_digest(bresults, 'docId', True)
+    bresults['error'] = 'timeout'
+    assert jsondiff.result_digest(aresults, 'docId') != jsondiff.result_digest(bresults, 'docId')
+
+
+def test_same_error_is_changed():
+    aresults = {'query': 'q', 'error': 'timeout'}
+    bresults = {'query': 'q', 'error': 'timeout'}
+    assert jsondiff.result_digest(aresults, 'docId') == jsondiff.result_digest(bresults, 'docId')
+    assert jsondiff.results_changed(aresults, bresults, 'docId')
+    assert jsondiff.diff_results(aresults, bresults, dict(OPTIONS, changed_only=True)) is not None
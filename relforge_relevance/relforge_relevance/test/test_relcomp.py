@@ -0,0 +1,205 @@
+import json
+import random
+
+import numpy as np
+
+import pytest
+
+from relforge_relevance import jsondiff, relcomp
+
+
+def make_result(query, doc_ids, total_hits=None):
+    return json.dumps({
+        'query': query,
+        'totalHits': len(doc_ids) if total_hits is None else total_hits,
+        'rows': [{'docId': doc_id, 'title': 'Title %d' % (doc_id)} for doc_id in doc_ids],
+    })
+
+
+BASELINE = [
+    make_result('same', [1, 2, 3, 4, 5]),
+    make_result('reordered', [1, 2, 3, 4, 5]),
+    make_result('replaced', [1, 2, 3, 4, 5]),
+    make_result('lost', [1, 2], total_hits=2),
+    make_result('none', []),
+    '{}',
+    json.dumps({'query': 'broken', 'error': 'timeout'}),
+]
+
+DELTA = [
+    make_result('same', [1, 2, 3, 4, 5]),
+    make_result('reordered', [2, 1, 3, 5, 4]),
+    make_result('replaced', [1, 2, 6, 4, 5]),
+    make_result('lost', [], total_hits=0),
+    make_result('none', []),
+    make_result('found', [7]),
+]
+
+
+def test_parse_result():
+    result = relcomp.Result.parse(BASELINE[3] + '\n')
+    assert result == relcomp.Result('lost', 2, (1, 2), False, False)
+    assert relcomp.Result.parse('\n') == relcomp.Result('', 0, (), True, False)
+    assert relcomp.Result.parse(BASELINE[-1]).error
+
+
+@pytest.mark.parametrize('n,expected', [
+    (1, (1, 1, 1, True)),
+    (2, (2, 2, 1, False)),
+    (3, (3, 3, 2, False)),
+    (20, (4, 3, 2, False)),
+])
+def test_result_pair_topn(n, expected):
+    pair = relcomp.ResultPair(
+        relcomp.Result.parse(make_result('q', [1, 2, 3, 4])),
+        relcomp.Result.parse(make_result('q', [1, 3, 5, 1])))
+    assert expected == pair.topn(n)
+
+
+def metric(metrics, name):
+    return next(m for m in metrics if m.name == name)
+
+
+def test_compare_files(files):
+    diff_count, metrics, errors = relcomp.compare_files(*files)
+    assert diff_count == 7
+    assert errors.examples() == [[7, 'broken / ']]
+
+    zero = metric(metrics, 'Zero Results Rate')
+    assert (zero.baseline_count, zero.delta_count) == (2, 2)
+    assert zero.d2b_diff.examples() == [[4, 'lost']]
+    assert zero.b2d_diff.examples() == [[6, ' / found']]
+
+    unsorted = metric(metrics, 'Top 5 Unsorted Results Differ')
+    assert [ex[1] for ex in unsorted.b2d_diff.examples()] == ['replaced', 'lost', ' / found']
+    # (changed, total) of [5, 0], [5, 0], [5, 1], [2, 2], [0, 0], [0, 1]
+    assert unsorted.magnitude.num_changed.values() == [(0, 3), (1, 2), (2, 1)]
+    assert unsorted.magnitude.pct_changed.values() == [(0, 3), (0.2, 1), (1, 2)]
+    sorted_ = metric(metrics, 'Top 5 Sorted Results Differ')
+    assert [ex[1] for ex in sorted_.b2d_diff.examples()] == [
+        'reordered', 'replaced', 'lost', ' / found']
+
+
+@pytest.mark.parametrize('workers,chunk_size', [(1, 2), (2, 1), (3, 4)])
+def test_compare_files_chunked(files, workers, chunk_size):
+    expected_count, expected, expected_errors = relcomp.compare_files(*files)
+    diff_count, metrics, errors = relcomp.compare_files(
+        *files, workers=workers, chunk_size=chunk_size)
+    assert expected_count == diff_count
+    assert expected_errors.examples() == errors.examples()
+    for a, b in zip(expected, metrics):
+        assert (a.total_queries, a.baseline_count, a.delta_count) == \
+            (b.total_queries, b.baseline_count, b.delta_count)
+        assert a.b2d_diff.examples() == b.b2d_diff.examples()
+        assert a.d2b_diff.examples() == b.d2b_diff.examples()
+        if hasattr(a, 'magnitude'):
+            for sketch_a, sketch_b in [(a.magnitude.num_changed, b.magnitude.num_changed),
+                                       (a.magnitude.pct_changed, b.magnitude.pct_changed)]:
+                assert sketch_a.values() == sketch_b.values()
+                assert sketch_a.mean == pytest.approx(sketch_b.mean, nan_ok=True)
+                assert sketch_a.std == pytest.approx(sketch_b.std, nan_ok=True)
+
+
+def test_reservoir_keeps_all_in_order_when_small():
+    reservoir = relcomp.Reservoir(5)
+    for i in [3, 1, 2]:
+        reservoir.add(i, 'ex%d' % (i))
+    assert len(reservoir) == 3
+    assert reservoir.examples() == [[1, 'ex1'], [2, 'ex2'], [3, 'ex3']]
+
+
+@pytest.mark.parametrize('ordered', [False, True])
+def test_reservoir_merge_matches_single_pass(ordered):
+    single = relcomp.Reservoir(10, seed=7, ordered=ordered)
+    for i in range(1000):
+        single.add(i, str(i))
+    assert len(single) == 1000
+    assert len(single.examples()) == 10
+
+    merged = relcomp.Reservoir(10, seed=7, ordered=ordered)
+    for start in range(0, 1000, 300):
+        part = relcomp.Reservoir(10, seed=7, ordered=ordered)
+        for i in range(start, min(start + 300, 1000)):
+            part.add(i, str(i))
+        merged.merge(part)
+    assert len(merged) == 1000
+    assert single.examples() == merged.examples()
+    if ordered:
+        assert [ex[0] for ex in single.examples()] == list(range(10))
+
+
+def test_reservoir_seed_changes_sample():
+    samples = []
+    for seed in [0, 1]:
+        reservoir = relcomp.Reservoir(10, seed=seed)
+        for i in range(1000):
+            reservoir.add(i, str(i))
+        samples.append(reservoir.examples())
+    assert samples[0] != samples[1]
+
+
+def test_reservoir_size_zero():
+    reservoir = relcomp.Reservoir(0)
+    reservoir.add(1, 'ex')
+    assert len(reservoir) == 1
+    assert reservoir.examples() == []
+
+
+@pytest.mark.parametrize('max_exact', [2048, 10])
+def test_value_sketch(max_exact):
+    R = random.Random(0)
+    data = [R.randint(-50, 50) * R.random() for _ in range(1000)]
+    sketch = relcomp.ValueSketch(max_exact=max_exact)
+    merged = relcomp.ValueSketch(max_exact=max_exact)
+    for start in range(0, len(data), 300):
+        part = relcomp.ValueSketch(max_exact=max_exact)
+        for value in data[start:start + 300]:
+            sketch.add(value)
+            part.add(value)
+        merged.merge(part)
+
+    for s in [sketch, merged]:
+        assert s.count == len(data)
+        assert s.mean == pytest.approx(np.mean(data))
+        assert s.std == pytest.approx(np.std(data))
+        assert (s.min, s.max) == (min(data), max(data))
+        assert sum(count for _, count in s.values()) == len(data)
+        if max_exact > len(data):
+            assert s.quantile(0.5) == pytest.approx(np.median(data))
+            assert s.quantile(0.9) == pytest.approx(np.percentile(data, 90))
+        else:
+            assert len(s.values()) < len(data)
+            assert s.quantile(0.9) == pytest.approx(np.percentile(data, 90), rel=0.02)
+    assert sketch.values() == merged.values()
+
+
+def test_value_sketch_empty():
+    sketch = relcomp.ValueSketch()
+    assert np.isnan(sketch.quantile(0.5))
+    assert np.isnan(sketch.std)
+    assert np.isnan(sketch.min)
+
+
+def test_diff_link_only_to_written_pages(files, tmpdir, monkeypatch):
+    out = tmpdir.mkdir('diffs')
+    options = {'key': 'docId', 'file1': files[0], 'file2': files[1], 'bwiki': '', 'dwiki': '',
+               'bexplain': '', 'dexplain': '', 'changed_only': True}
+    jsondiff.write_diffs(files[0], files[1], str(out), options)
+    monkeypatch.setattr(relcomp, 'diff_pages', relcomp.load_diff_pages(str(out)))
+    assert relcomp.diff_link(1, 'same') == 'same'
+    assert relcomp.diff_link(2, 'reordered') == "<a href='diffs/diff2.html'>reordered</a>"
+    assert relcomp.load_diff_pages(str(tmpdir.join('missing'))) is None
+
+
+def test_diff_link_skips_archived_pages(files, tmpdir, monkeypatch):
+    out = tmpdir.mkdir('diffs')
+    options = {'key': 'docId', 'file1': files[0], 'file2': files[1], 'bwiki': '', 'dwiki': '',
+               'bexplain': '', 'dexplain': ''}
+    jsondiff.write_diffs(files[0], files[1], str(out), options, archive=True)
+    monkeypatch.setattr(relcomp, 'diff_pages', relcomp.load_diff_pages(str(out)))
+    assert relcomp.diff_link(2, 'reordered') == 'reordered'
+
+    # Writing pages again replaces the archive
+    jsondiff.write_diffs(files[0], files[1], str(out), options)
+    assert not jsondiff.pages_archived(str(out))
+    assert 2 in relcomp.load_diff_pages(str(out))
@@ -0,0 +1,18 @@
+import pytest
+
+from relforge_relevance import relevancyRunner
+
+
+@pytest.mark.parametrize('max_per_host', ['0', '-1', 'x'])
+def test_main_rejects_max_per_host(tmpdir, monkeypatch, max_per_host):
+    monkeypatch.setattr('sys.argv', [
+        'relevancyRunner.py', '-c', str(tmpdir.join('config.ini')), '--max-per-host', max_per_host])
+    with pytest.raises(SystemExit):
+        relevancyRunner.main()
+
+
+def test_at_least_one():
+    assert relevancyRunner.at_least_one('1') == 1
+    assert relevancyRunner.at_least_one('4') == 4
+    with pytest.raises(ValueError):
+        relevancyRunner.at_least_one('0')
@@ -7,6 +7,7 @@ requirements = [
 ]
 
 test_requirements = [
+    'pytest',
 ]
 
 setup(
@@ -1,10 +1,10 @@
 from collections import defaultdict
+from contextlib import contextmanager
 from functools import partial
 from glob import glob
 from gzip import GzipFile
 import hashlib
 import json
-from json.decoder import JSONDecodeError
 import logging
 import os
 import pickle
@@ -12,34 +12,35 @@ import pprint
 import time
 
 import numpy as np
-import pandas as pd
 import requests
-import tensorflow as tf
 from tqdm import tqdm
 
 from relforge.cli_utils import \
-    iterate_pickle, load_pkl, with_arg, bounded_float, positive_int, \
+    load_pkl, make_loader, with_arg, bounded_float, positive_int, \
     with_pkl_df, with_elasticsearch, with_sql_query, with_sql_vars,\
     DELETE_ON_ERROR, DELETE_ON_EXIT, generate_cli
+from relforge.parallel import map_ordered
 from relforge_wbsearchentities.explain_parser import \
     explain_parser_from_root, parse_hits, merge_explains
+from relforge_wbsearchentities.explain_parser.utils import tf
+from relforge_wbsearchentities.explain_store import \
+    ExplainStore, ExplainStoreWriter, convert_pickle, is_explain_store, iterate_explains
+from relforge_wbsearchentities.features import FeatureMatrix
+from relforge_wbsearchentities.fetch import FetchStats, explain_requests, fetch_hits, make_elasticsearch
+from relforge_wbsearchentities.queries import write_splits
 from relforge_wbsearchentities.tf_optimizer import \
-    HyperoptOptimizer, AutocompleteEvaluator, SensitivityAnalyzer, \
-    tf_run_all, EXAM_PROB
+    HyperbandOptimizer, HyperoptOptimizer, AutocompleteEvaluator, SensitivityAnalyzer, \
+    NumpyScoreSource, TfScoreSource, tf_run_all, EXAM_PROB
 
 
 log = logging.getLogger(__name__)
 WIKIDATA_API_URL = 'https://www.wikidata.org/w/api.php'
 
 
-def prefixes(string):
-    """Return all prefixes of provided string from shortest to longest"""
-    assert isinstance(string, str)
-    return (string[:i] for i in range(1, len(string) + 1))
-
-
 def read_tfrecord_dataset_args(args):
     """Helper to call read_tfrecord_dataset as with_arg loader"""
+    if args['dataset'] is None:
+        return args
     return dict(args, dataset=read_tfrecord_dataset(
         args['dataset'], args['equation'], args['batch_size']))
 
@@ -109,18 +110,44 @@ def load_source_df(in_path, resample=None, seed=0):
     return df
 
 
-def iterate_lucene_explains(paths):
-    if isinstance(paths, str):
-        paths = list(glob(paths))
-    with tqdm(desc='hits') as hits_pbar:
-        for one_path in tqdm(paths, 'paths'):
-            try:
-                for row, hits in iterate_pickle(one_path):
-                    yield row, hits
-                    hits_pbar.update(len(hits))
-            except:  # noqa: E722
-                log.error('Failed while reading %s', one_path)
-                raise
+class LuceneExplains(object):
+    """Iterable of (row, hits) pairs from explain stores, or pickles, matching a glob"""
+    def __init__(self, paths, where=None):
+        if isinstance(paths, str):
+            paths = list(glob(paths))
+        self.paths = paths
+        self.where = where
+
+    def filter(self, **where):
+        """Only iterate rows whose fields equal the provided values"""
+        return LuceneExplains(self.paths, dict(self.where or {}, **where))
+
+    def __iter__(self):
+        with tqdm(desc='hits') as hits_pbar:
+            for one_path in tqdm(self.paths, 'paths'):
+                try:
+                    for row, hits in iterate_explains(one_path, self.where):
+                        yield row, hits
+                        hits_pbar.update(len(hits))
+                except:  # noqa: E722
+                    log.error('Failed while reading %s', one_path)
+                    raise
+
+
+def int_at_least(min_val):
+    def fn(raw_val):
+        val = int(raw_val)
+        if val >= min_val:
+            return val
+        raise ValueError('Expected {} to be at least {}'.format(val, min_val))
+    return fn
+
+
+def positive_fraction(raw_val):
+    val = float(raw_val)
+    if 0 < val <= 1:
+        return val
+    raise ValueError('Expected {} to be greater than 0 and at most 1'.format(val))
 
 
 # Various CLI args re-used throughout. All args are responsible for converting
@@ -133,8 +160,9 @@ with_es_query = with_arg('--es-query', dest='es_query', type=load_pkl, required=
 with_equation = with_arg('-e', '--equation', dest='equation', type=load_pkl, required=True)
 with_source_dataset = with_arg('-s', '--source-dataset', dest='df_source', loader=load_source_df_args, required=True)
 with_lucene_explains = with_arg(
-    '-l', '--lucene-explain', dest='lucene_explains', type=iterate_lucene_explains, required=True)
-with_tfrecords = with_arg('-t', '--tfrecord', dest='dataset', loader=read_tfrecord_dataset_args, required=True)
+    '-l', '--lucene-explain', dest='lucene_explains', type=LuceneExplains, required=True)
+with_tfrecords = with_arg('-t', '--tfrecord', dest='dataset', loader=read_tfrecord_dataset_args, required=False)
+with_features = with_arg('--features', dest='features', type=FeatureMatrix.load, required=False)
 with_restarts = with_arg('--restarts', dest='restarts', type=positive_int, default=5)
 with_epochs = with_arg('--epochs', dest='epochs', type=positive_int, default=200)
 with_test_size = with_arg('--test-size', dest='test_size', type=bounded_float(0, 1), default=0.5)
@@ -142,6 +170,7 @@ with_top_k = with_arg('--top-k', dest='top_k', type=positive_int, default=len(EX
 with_language = with_arg('--language', dest='language', required=True)
 with_context = with_arg('--context', dest='context', required=True)
 with_train_report = with_arg('--train-report', dest='train_report', type=load_pkl)
+with_workers = with_arg('-j', '--workers', dest='workers', type=positive_int, default=1, required=False)
 
 
 # The main handler for registering and choosing commands from cli
@@ -151,7 +180,7 @@ main = generate_cli()
 @main.command(with_sql_query, with_sql_vars)
 def fetch_source(sql_query, out_path):
     """Load input dataset from sql query definition"""
-    df_raw = sql_query.to_df()
+    df_raw = sql_query.to_df(stream=True)
     # Drop groups that are too small.
     g = df_raw.groupby(['context', 'language'])
     df_filtered = df_raw[g['dt'].transform('size') > 1000]
@@ -167,36 +196,16 @@ def fetch_source(sql_query, out_path):
         pickle.dump(df_filtered, f, pickle.HIGHEST_PROTOCOL)
 
 
-@main.command(with_source_dataset, with_resample, with_batch_size(default=1000), with_seed)
-def expand_and_split_queries(df_source, out_path, resample, batch_size, seed):
+@main.command(with_source_dataset, with_resample, with_batch_size(default=1000), with_seed, with_workers)
+def expand_and_split_queries(df_source, out_path, resample, batch_size, seed, workers):
     """Converts a single input csv into many work pieces
 
     Expands searchterms from the source dataset into the full set of possible
     prefix queries. The set of queries is written out to individual files
     containing `batch_size` queries each.
     """
-    # Expand searchterm with all it's prefixes
-    # Not sure how to do this in pandas directly, flatMap doesn't seem to be a thing
-    all_prefixes = defaultdict(set)
-    for index, row in df_source.iterrows():
-        key = (row['context'], row['language'])
-        all_prefixes[key].update(prefixes(row['searchterm']))
-    df_prefix = pd.DataFrame(
-        (k + (p,) for k, prefixes in all_prefixes.items() for p in prefixes),
-        columns=('context', 'language', 'prefix'))
-
-    # Write results per (context,language)
-    df_grouped = df_prefix.groupby(['context', 'language'])
-    all_dfs = {g: df_grouped.get_group(g) for g in df_grouped.groups}
-    for (context, language), df_one in all_dfs.items():
-        log.info('Generating splits for (%s, %s) with %d searches to perform', context, language, len(df_one))
-        for i, start in enumerate(range(1, len(df_one), batch_size)):
-            batch_filename = 'query-{:04d}.{}_{}.pkl.gz'.format(i, context, language)
-            batch_out_path = os.path.join(out_path, batch_filename)
-            log.info('Writing query split %s', (batch_out_path))
-            df_batch = df_one.iloc[start:start+batch_size]
-            with GzipFile(batch_out_path, 'wb') as f:
-                pickle.dump(df_batch, f, pickle.HIGHEST_PROTOCOL)
+    num_splits = write_splits(out_path, df_source, batch_size, workers)
+    log.info('Wrote %d query splits from %d searches', num_splits, len(df_source))
 
 
 @main.command(
@@ -219,41 +228,35 @@ def fetch_wbsearchentities_query(out_path, context, language, api_url):
 
 
 @main.command(
-    with_pkl_df, with_es_query, with_batch_size(default=50), with_elasticsearch,
-    with_arg('-i', '--index', dest='index', default='wikidatawiki_content', required=False))
-def fetch_explain(df, out_path, es_query, batch_size, es, index):
-    """Retrieve explains for all queries"""
-    encoded_query = json.dumps(es_query['query'])
-    try:
-        encoded_rescore = json.dumps(es_query['rescore'])
-    except KeyError:
-        encoded_rescore = None
+    with_pkl_df, with_es_query, with_batch_size(default=50),
+    with_elasticsearch(loader=make_loader(make_elasticsearch, 'es', '?concurrency')),
+    with_arg('-i', '--index', dest='index', default='wikidatawiki_content', required=False),
+    with_arg('--concurrency', dest='concurrency', type=positive_int, default=1, required=False),
+    with_arg('--msearch-size', dest='msearch_size', type=positive_int, default=0, required=False),
+    with_arg('--max-retries', dest='max_retries', type=positive_int, default=5, required=False),
+    with_arg('--backoff', dest='backoff', type=float, default=0.5, required=False))
+def fetch_explain(df, out_path, es_query, batch_size, es, index, concurrency, msearch_size, max_retries, backoff):
+    """Retrieve explains for all queries
+
+    Up to concurrency requests are in flight at a time, each holding one
+    search or, with msearch_size, an _msearch of that many searches.
+    Requests rejected by an overloaded cluster are retried with backoff.
+    Explains are written in the order of the queries.
+    """
+    stats = FetchStats()
+    search_requests = explain_requests(df, es_query, batch_size)
+    with ExplainStoreWriter(out_path) as writer, tqdm(total=len(df), desc='queries') as pbar:
+        for row, hits in fetch_hits(es, index, search_requests, concurrency=concurrency, msearch_size=msearch_size,
+                                    max_retries=max_retries, backoff=backoff, stats=stats):
+            writer.add(row, hits)
+            pbar.update(1)
+    log.info('Fetched explains for %s: %s', os.path.basename(out_path), stats)
 
-    with GzipFile(out_path, 'wb') as f:
-        for _, row in df.iterrows():
-            # Template queries are deprecated as of 5.0.0, so lets do our
-            # own replacement i guess.
-            try:
-                templated_query = json.loads(
-                    encoded_query
-                    .replace('"{{query_string}}"', json.dumps(row['prefix']))
-                    .replace('"{{QUERY_STRING}}"', json.dumps(row['prefix'].upper())))
-            except JSONDecodeError:
-                log.warning('Invalid string, bad utf8? str:`{}` json:`{}`'.format(row['prefix'], encoded_query))
-                continue
-            local_query = {
-                'size': batch_size,
-                'query': templated_query,
-                'explain': True,
-                '_source': False,
-            }
-            if encoded_rescore is not None:
-                local_query['rescore'] = json.loads(
-                    encoded_rescore
-                    .replace('"{{query_string}}"', json.dumps(row['prefix']))
-                    .replace('"{{QUERY_STRING}}"', json.dumps(row['prefix'].upper())))
-            res = es.search(index=index, body=local_query)
-            pickle.dump((row, res['hits']['hits']), f, pickle.HIGHEST_PROTOCOL)
+
+@main.command(with_arg('-i', '--input', dest='in_path', required=True))
+def convert_explains(in_path, out_path):
+    """Convert explains pickled by earlier versions of fetch_explain into an explain store"""
+    convert_pickle(in_path, out_path)
 
 
 @main.command(with_lucene_explains, with_es_query)
@@ -308,27 +311,151 @@ def extract_features(row, page_id, explain):
     return feature
 
 
+def make_examples(parser, row, hits):
+    """Serialize the feature vectors of a query's hits as tf.train.Example"""
+    for page_id, explain in parse_hits(parser, hits):
+        example = tf.train.Example(
+            features=tf.train.Features(feature=extract_features(row, page_id, explain)))
+        yield example.SerializeToString()
+
+
 @main.command(with_lucene_explains, with_es_query, with_equation, with_context, with_language)
 def make_tfrecord(lucene_explains, out_path, es_query, equation, context, language):
-    # TODO: Should this instead do one pass that emits all the files? De-pickling
-    # is relatively expensive and we have ~100 pairs (although not all will be useful).
+    # See make_tfrecords for building all (context, language) pairs in a single pass.
     parser = explain_parser_from_root(es_query)
     writer = tf.python_io.TFRecordWriter(out_path)
 
-    for row, hits in lucene_explains:
-        if row['context'] != context or row['language'] != language:
-            continue
+    # Explain stores skip other rows without decoding their explains
+    for row, hits in lucene_explains.filter(context=context, language=language):
         if not hits:
             # Probably some sort of query error
             log.debug("No hits for prefix %s", row['prefix'])
             continue
-        for page_id, explain in parse_hits(parser, hits):
-            example = tf.train.Example(
-                features=tf.train.Features(feature=extract_features(row, page_id, explain)))
-            writer.write(example.SerializeToString())
+        for example in make_examples(parser, row, hits):
+            writer.write(example)
     writer.close()
 
 
+@main.command(with_lucene_explains, with_es_query, with_equation, with_context, with_language)
+def make_features(lucene_explains, out_path, es_query, equation, context, language):
+    """Build the feature matrix of a (context, language) pair
+
+    The numpy counterpart of make_tfrecord, used by the optimization
+    commands with --features in place of --tfrecord.
+    """
+    parser = explain_parser_from_root(es_query)
+    features = FeatureMatrix.from_lucene_explains(
+        parser, equation, lucene_explains.filter(context=context, language=language))
+    DELETE_ON_ERROR.append(out_path)
+    features.save(out_path)
+    log.info('Wrote features of %d hits to %s', len(features), os.path.basename(out_path))
+
+
+def variant_name(row):
+    """Name of a row's (context, language) pair, as used by the Makefile"""
+    return '{}_{}'.format(row['context'], row['language'])
+
+
+# explain parsers of the current process, by es query path
+_PARSERS = {}
+
+
+def _variant_parser(es_query_path):
+    if es_query_path not in _PARSERS:
+        _PARSERS[es_query_path] = explain_parser_from_root(load_pkl(es_query_path))
+    return _PARSERS[es_query_path]
+
+
+def make_examples_unit(unit):
+    """Serialize the examples of a range of explain rows, for all wanted pairs
+
+    Parameters
+    ----------
+    unit : tuple
+        Path of an explain store or pickle, the start and stop rows to read
+        (None for the whole file) and a dict from pair name to the path of
+        its es query. Rows of other pairs are skipped.
+
+    Returns
+    -------
+    dict
+        Map from pair name to list of serialized examples
+    """
+    path, start, stop, es_query_paths = unit
+
+    def wanted(row):
+        return variant_name(row) in es_query_paths
+
+    if start is None:
+        records = iterate_explains(path, where=wanted)
+    else:
+        records = ExplainStore(path).iterate(start, stop, where=wanted)
+    examples = defaultdict(list)
+    for row, hits in records:
+        if not hits:
+            # Probably some sort of query error
+            log.debug("No hits for prefix %s", row['prefix'])
+            continue
+        variant = variant_name(row)
+        parser = _variant_parser(es_query_paths[variant])
+        examples[variant].extend(make_examples(parser, row, hits))
+    return dict(examples)
+
+
+def make_examples_units(paths, es_query_paths, rows_per_unit):
+    """Divide explain files into work units for make_examples_unit
+
+    Explain stores are split into ranges of rows_per_unit rows, pickles
+    can only be read from the start and are a single unit each.
+    """
+    for path in paths:
+        if is_explain_store(path):
+            num_rows = len(ExplainStore(path))
+            for start in range(0, num_rows, rows_per_unit):
+                yield path, start, min(start + rows_per_unit, num_rows), es_query_paths
+        else:
+            yield path, None, None, es_query_paths
+
+
+@main.command(
+    with_lucene_explains, with_workers,
+    with_arg('--es-query-pattern', dest='es_query_pattern', required=True,
+             help='Path to the es query of each pair, with {} in place of the pair name'),
+    with_arg('--variants', dest='variants', type=str.split, required=True,
+             help='Space separated (context, language) pair names, such as "item_en item_de"'),
+    with_arg('--tfrecord-dir', dest='tfrecord_dir', required=True),
+    with_arg('--rows-per-unit', dest='rows_per_unit', type=int_at_least(1), default=1000, required=False))
+def make_tfrecords(lucene_explains, out_path, workers, es_query_pattern, variants, tfrecord_dir, rows_per_unit):
+    """Build the tfrecords of many (context, language) pairs in one pass over the explains
+
+    Writes <tfrecord_dir>/<pair>.tfrecord for each pair, as make_tfrecord
+    would, along with a json summary of the number of examples per pair
+    to out_path. Explains are parsed by a pool of worker processes, and
+    written in input order.
+    """
+    es_query_paths = {variant: es_query_pattern.format(variant) for variant in variants}
+    tfrecord_paths = {variant: os.path.join(tfrecord_dir, variant + '.tfrecord') for variant in variants}
+    DELETE_ON_ERROR.extend(tfrecord_paths.values())
+    writers = {variant: tf.python_io.TFRecordWriter(path) for variant, path in tfrecord_paths.items()}
+    counts = {variant: 0 for variant in variants}
+
+    def write(examples):
+        for variant, serialized in examples.items():
+            for example in serialized:
+                writers[variant].write(example)
+            counts[variant] += len(serialized)
+
+    units = tqdm(make_examples_units(lucene_explains.paths, es_query_paths, rows_per_unit), 'units')
+    for examples in map_ordered(make_examples_unit, units, workers):
+        write(examples)
+
+    for writer in writers.values():
+        writer.close()
+    with open(out_path, 'w') as f:
+        json.dump(counts, f)
+    log.info('Wrote %d examples for %d pairs', sum(counts.values()), len(counts))
+
+
 @main.command(
     with_tfrecords, with_equation, with_seed, with_context, with_language,
     with_batch_size(default=16*1024))
@@ -355,16 +482,47 @@ def debug_tfrecord(dataset, out_path, equation, seed, context, language, batch_s
     log.info('Checked %d records and found %d failures in %.4fs', score.shape[0], num_errors, took)
 
 
-def minimize(
-    dataset, out_path, df_source, equation, top_k, restarts, epochs,
-    test_size, context, language, seed, make_optimizer, **kwargs
-):
+@contextmanager
+def score_source(equation, dataset=None, features=None):
+    """Score hits of equation from tfrecords or a feature matrix
+
+    Parameters
+    ----------
+    equation : explain_parser.core.BaseExplain
+    dataset : tf.data.Dataset or None
+        As read by read_tfrecord_dataset, scored with tensorflow.
+    features : FeatureMatrix or None
+        As written by make_features, scored with a compiled equation.
+
+    Yields
+    ------
+    TfScoreSource or NumpyScoreSource
+    """
+    if (dataset is None) == (features is None):
+        raise ValueError('Exactly one of --tfrecord or --features must be provided')
+    if features is not None:
+        yield NumpyScoreSource(equation, features)
+        return
     iterator = dataset.make_initializable_iterator()
     next_batch = iterator.get_next()
     score_op = equation.to_tf(next_batch)
     variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        yield TfScoreSource(sess, iterator.initializer, score_op, next_batch, variables)
+
+
+def tunable_variables(source):
+    """Names of the variables of a score source to optimize"""
     # For now filter bm25 k1/b from tunables, deploying that is a pain
-    variables = [v for v in variables if not v.name.endswith('tfNorm/k1:0') and not v.name.endswith('tfNorm/b:0')]
+    return [name for name in source.variable_names
+            if not name.endswith('tfNorm/k1:0') and not name.endswith('tfNorm/b:0')]
+
+
+def minimize(
+    dataset, features, out_path, df_source, equation, top_k, restarts, epochs,
+    test_size, context, language, seed, make_optimizer, **kwargs
+):
 
     # Sort from oldest to newest. Train on oldest, test on newest
     cond = (df_source['context'] == context) & (df_source['language'] == language)
@@ -374,31 +532,26 @@ def minimize(
     df_train = df_source.iloc[:split_idx].copy()
     df_test = df_source.iloc[split_idx:].copy()
 
-    with tf.Session() as sess:
+    with score_source(equation, dataset, features) as source:
         evaluator = AutocompleteEvaluator(
-            tf_session=sess,
-            data_init_op=iterator.initializer,
-            score_op=score_op,
+            score_source=source,
             datasets={
                 'test': df_test,
                 'train': df_train,
             },
-            top_k=top_k,
-            variables_ops={var.name: var for var in variables})
+            top_k=top_k)
 
         optimizer = make_optimizer(
-            tf_session=sess,
             evaluator=evaluator,
-            variables=variables,
+            variables=tunable_variables(source),
             seed=seed,
             train_dataset='train',
             **kwargs)
 
-        sess.run(tf.global_variables_initializer())
-        evaluator.initialize(next_batch)
+        evaluator.initialize()
         agg_report = optimizer.minimize(restarts=restarts, epochs=epochs)
 
-    agg_report.run_parameters = {
+    agg_report.run_parameters = dict({
         'context': context,
         'language': language,
         'top_k': top_k,
@@ -406,7 +559,7 @@ def minimize(
         'epochs': epochs,
         'test_size': test_size,
         'seed': seed,
-    }
+    }, **kwargs)
     pprint.pprint(agg_report.summary)
 
     with GzipFile(out_path, 'wb') as f:
@@ -423,6 +576,7 @@ def with_minimizer(parser):
     """
     loaders = [dep(parser) for dep in [
         with_tfrecords,
+        with_features,
         with_resample,  # TODO: with_tfrecords needs deps too
         with_batch_size(default=16*1024),
         with_source_dataset,
@@ -440,7 +594,7 @@ def with_minimizer(parser):
         for loader in loaders:
             if loader is not None:
                 args = loader(args)
-        arg_names = ['dataset', 'out_path', 'df_source', 'equation',
+        arg_names = ['dataset', 'features', 'out_path', 'df_source', 'equation',
                      'top_k', 'restarts', 'epochs', 'test_size',
                      'context', 'language', 'seed']
         minimize_fn = partial(minimize, *[args[k] for k in arg_names])
@@ -449,26 +603,36 @@ def with_minimizer(parser):
     return fn
 
 
-@main.command(with_minimizer)
-def hyperopt(minimize, **kwargs):
-    minimize(HyperoptOptimizer)
+@main.command(
+    with_minimizer,
+    with_arg('--candidates-per-pass', dest='candidates_per_pass', type=int_at_least(1), default=1, required=False,
+             help='Number of tpe suggestions evaluated together in a single pass over the hits'))
+def hyperopt(minimize, candidates_per_pass, **kwargs):
+    minimize(HyperoptOptimizer, candidates_per_pass=candidates_per_pass)
+
+
+@main.command(
+    with_minimizer,
+    with_arg('--eta', dest='eta', type=int_at_least(2), default=3, required=False,
+             help='Share of candidates promoted to a subsample eta times larger after each round'),
+    with_arg('--min-fraction', dest='min_fraction', type=positive_fraction, default=1 / 27, required=False,
+             help='Share of the train search terms in the smallest subsample candidates start on'))
+def hyperband(minimize, eta, min_fraction, dataset, **kwargs):
+    # TfScoreSource scores every hit on each pass, subsamples would save nothing
+    if dataset is not None:
+        raise ValueError('hyperband requires --features, --tfrecord is not supported')
+    minimize(HyperbandOptimizer, eta=eta, min_fraction=min_fraction)
 
 
 @main.command(
-    with_tfrecords, with_resample, with_batch_size(default=16*1024), with_source_dataset,
+    with_tfrecords, with_features, with_resample, with_batch_size(default=16*1024), with_source_dataset,
     with_equation, with_top_k, with_test_size, with_context, with_language, with_seed,
     with_train_report,
 )
 def eval_model(
-    dataset, out_path, resample, batch_size, df_source, equation, top_k, test_size,
+    dataset, features, out_path, resample, batch_size, df_source, equation, top_k, test_size,
     context, language, seed, train_report,
 ):
-    iterator = dataset.make_initializable_iterator()
-    next_batch = iterator.get_next()
-    score_op = equation.to_tf(next_batch)
-    variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
-    variables_by_name = {var.name: var for var in variables}
-
     # Sort from oldest to newest. test on second half of data
     cond = (df_source['context'] == context) & (df_source['language'] == language)
     df_source = df_source[cond].sort_values('dt', ascending=True, inplace=False)
@@ -477,19 +641,15 @@ def eval_model(
     split_idx = int(len(df_source) * (1 - test_size))
     df_test = df_source.iloc[split_idx:].copy()
 
-    with tf.Session() as sess:
+    with score_source(equation, dataset, features) as source:
         evaluator = AutocompleteEvaluator(
-            tf_session=sess,
-            data_init_op=iterator.initializer,
-            score_op=score_op,
+            score_source=source,
             datasets={'test': df_test},
-            top_k=top_k,
-            variables_ops=variables_by_name)
+            top_k=top_k)
 
-        sess.run(tf.global_variables_initializer())
-        evaluator.initialize(next_batch)
+        evaluator.initialize()
         # Assign best values
-        sess.run([variables_by_name[k].assign(v) for k, v in train_report.best_report.variables.items()])
+        source.assign(train_report.best_report.variables)
         final_report = evaluator.evaluate()
 
     print('Initial report:')
@@ -499,21 +659,15 @@ def eval_model(
 
 
 @main.command(
-    with_tfrecords, with_resample, with_batch_size(default=16*1024), with_source_dataset,
+    with_tfrecords, with_features, with_resample, with_batch_size(default=16*1024), with_source_dataset,
     with_equation, with_top_k, with_test_size, with_context, with_language, with_seed,
     with_train_report(required=False),
     with_arg('--sensitivity-width', dest='width', type=positive_int, default=20, required=False),
 )
 def analyze_sensitivity(
-    dataset, out_path, resample, batch_size, df_source, equation, top_k, test_size,
+    dataset, features, out_path, resample, batch_size, df_source, equation, top_k, test_size,
     context, language, seed, train_report, width,
 ):
-    iterator = dataset.make_initializable_iterator()
-    next_batch = iterator.get_next()
-    score_op = equation.to_tf(next_batch)
-    variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
-    variables_by_name = {var.name: var for var in variables}
-
     # Sort from oldest to newest. test on second half of data
     cond = (df_source['context'] == context) & (df_source['language'] == language)
     df_source = df_source[cond].sort_values('dt', ascending=True, inplace=False)
@@ -522,25 +676,19 @@ def analyze_sensitivity(
     split_idx = int(len(df_source) * (1 - test_size))
     df_test = df_source.iloc[split_idx:].copy()
 
-    with tf.Session() as sess:
+    with score_source(equation, dataset, features) as source:
         evaluator = AutocompleteEvaluator(
-            tf_session=sess,
-            data_init_op=iterator.initializer,
-            score_op=score_op,
+            score_source=source,
             datasets={'test': df_test},
-            top_k=top_k,
-            variables_ops=variables_by_name)
+            top_k=top_k)
 
         analyzer = SensitivityAnalyzer(
-            tf_session=sess,
             evaluator=evaluator,
-            variables=variables,
             width=width)
 
-        sess.run(tf.global_variables_initializer())
         if train_report is not None:
-            sess.run([variables_by_name[k].assign(v) for k, v in train_report.best_report.variables.items()])
-        evaluator.initialize(next_batch)
+            source.assign(train_report.best_report.variables)
+        evaluator.initialize()
         sensitivity_report = analyzer.evaluate()
 
     with GzipFile(out_path, 'wb') as f:
@@ -0,0 +1,101 @@
+"""Time prefix query expansion on synthetic search logs
+
+Usage:
+
+    python -m relforge_wbsearchentities.benchmark --rows 1000000 --workers 4
+"""
+import argparse
+from collections import defaultdict
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from relforge_wbsearchentities import queries
+
+
+def make_source(R, num_rows, num_terms=None, alphabet='abcdefghijklmnopqrstuvwxyzáéż ',
+                variants=(('item', 'en'), ('item', 'de'), ('property', 'en'))):
+    """Generate search logs with zipf distributed repeats of random searchterms"""
+    if num_terms is None:
+        num_terms = max(1, num_rows // 4)
+    lengths = R.randint(1, 30, size=num_terms)
+    chars = np.asarray(list(alphabet))
+    terms = np.asarray([''.join(chars[R.randint(0, len(chars), size=n)]) for n in lengths], dtype=object)
+    picks = np.minimum(R.zipf(1.5, size=num_rows), num_terms) - 1
+    variant_idx = R.randint(0, len(variants), size=num_rows)
+    return pd.DataFrame({
+        'context': [variants[i][0] for i in variant_idx],
+        'language': [variants[i][1] for i in variant_idx],
+        'searchterm': terms[picks],
+    })
+
+
+def iterrows_expand(df_source):
+    """Prefix expansion as previously performed by expand_and_split_queries"""
+    all_prefixes = defaultdict(set)
+    for index, row in df_source.iterrows():
+        key = (row['context'], row['language'])
+        searchterm = row['searchterm']
+        all_prefixes[key].update(searchterm[:i] for i in range(1, len(searchterm) + 1))
+    return pd.DataFrame(
+        (k + (p,) for k, prefixes in all_prefixes.items() for p in prefixes),
+        columns=queries.COLUMNS)
+
+
+def timed(label, num_rows, fn):
+    start = time.time()
+    result = fn()
+    took = time.time() - start
+    print('%-28s %8.2fs %12.0f rows/s' % (label, took, num_rows / took))
+    return result, took
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark prefix query expansion', prog=sys.argv[0])
+    parser.add_argument(
+        '-r', '--rows', dest='num_rows', type=int, default=1000000,
+        help='Number of synthetic search log rows, default is 1000000')
+    parser.add_argument(
+        '-b', '--batch-size', dest='batch_size', type=int, default=1000,
+        help='Queries per split, default is 1000')
+    parser.add_argument(
+        '-j', '--workers', dest='workers', type=int, default=4,
+        help='Processes writing splits, default is 4')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=0, help='Random seed')
+    parser.add_argument(
+        '--skip-iterrows', dest='skip_iterrows', action='store_true',
+        help='Only time the vectorized expansion')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    R = np.random.RandomState(args.seed)
+    print('Generating %d search log rows' % (args.num_rows))
+    df_source = make_source(R, args.num_rows)
+
+    groups, took = timed('expand (vectorized)', args.num_rows, lambda: list(queries.expand_queries(df_source)))
+    num_prefixes = sum(len(df) for _, df in groups)
+    print('%-28s %8d prefix queries' % ('', num_prefixes))
+    if not args.skip_iterrows:
+        df_prefix, old_took = timed('expand (iterrows)', args.num_rows, lambda: iterrows_expand(df_source))
+        assert len(df_prefix) == num_prefixes
+        print('%-28s %8.1fx speedup' % ('', old_took / took))
+
+    for workers in sorted({1, args.workers}):
+        out_path = tempfile.mkdtemp()
+        try:
+            timed('expand and write (%d workers)' % (workers), args.num_rows,
+                  lambda: queries.write_splits(out_path, df_source, args.batch_size, workers))
+        finally:
+            shutil.rmtree(out_path)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""Time building top-k result lists from the scores of synthetic hits
+
+Compares AutocompleteEvaluator.evaluate build_lookup_sec against the
+previous implementation, which gathered all scores into prefix order and
+fully sorted every prefix on each evaluation.
+
+Usage:
+
+    python -m relforge_wbsearchentities.benchmark_lookup --hits 50000000
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from relforge_wbsearchentities.tf_optimizer import AutocompleteEvaluator, EXAM_PROB, njit, prange
+
+
+@njit(parallel=True)
+def argsort_lookup(scores, sort_idx, indptr, page_ids, result):
+    """Results lookup as previously performed by AutocompleteEvaluator"""
+    top_k = result.shape[1]
+    scores = scores.ravel()[sort_idx]
+    for i in prange(len(indptr) - 1):
+        search_scores = scores[indptr[i]:indptr[i+1]]
+        top_k_idx = np.argsort(search_scores)[-top_k:][::-1]
+        result[i, :len(top_k_idx)] = page_ids[indptr[i] + top_k_idx]
+    return result
+
+
+class ArrayScoreSource(object):
+    """Score source returning fixed scores, without variables"""
+    def __init__(self, scores, page_ids, prefixes):
+        self._scores = scores
+        self.page_ids = page_ids
+        self.prefixes = prefixes
+        self.variable_names = []
+
+    def get_values(self):
+        return {}
+
+    def assign(self, values):
+        pass
+
+    def metadata(self):
+        return self.page_ids, self.prefixes
+
+    def reorder(self, order):
+        self._scores = self._scores[order]
+        self.page_ids = self.page_ids[order]
+        self.prefixes = self.prefixes[order]
+
+    def scores(self):
+        return self._scores
+
+    def scores_batch(self, candidates):
+        return np.broadcast_to(self._scores, (len(candidates), len(self._scores)))
+
+
+def make_hits(R, num_hits, min_group=100, max_group=500):
+    """Generate hits stored one search at a time, as fetched from elasticsearch
+
+    Returns
+    -------
+    scores : np.ndarray
+    page_ids : np.ndarray
+    prefixes : np.ndarray
+        object array of the prefix of each hit, sharing one string per
+        prefix.
+    """
+    sizes = R.randint(min_group, max_group + 1, size=num_hits // min_group + 1)
+    sizes = sizes[:np.searchsorted(np.cumsum(sizes), num_hits) + 1]
+    sizes[-1] -= sizes.sum() - num_hits
+    # Random names, so file order does not match prefix order
+    names = np.asarray(['p{:x}'.format(x) for x in R.permutation(len(sizes))], dtype=object)
+    prefixes = np.repeat(names, sizes)
+    scores = R.rand(num_hits).astype(np.float32)
+    page_ids = R.randint(1, 10000000, size=num_hits).astype(np.int64)
+    return scores, page_ids, prefixes
+
+
+def best_of(repeats, fn):
+    took = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        took.append(time.time() - start)
+    return min(took)
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark building top-k result lists', prog=sys.argv[0])
+    parser.add_argument(
+        '-n', '--hits', dest='num_hits', type=int, default=50000000,
+        help='Number of synthetic hits, default is 50000000')
+    parser.add_argument(
+        '--top-k', dest='top_k', type=int, default=len(EXAM_PROB),
+        help='Results per search, default is {}'.format(len(EXAM_PROB)))
+    parser.add_argument(
+        '--repeats', dest='repeats', type=int, default=3,
+        help='Evaluations to take the best time of, default is 3')
+    parser.add_argument(
+        '--seed', dest='seed', type=int, default=0, help='Random seed')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    R = np.random.RandomState(args.seed)
+    print('Generating %d hits' % (args.num_hits))
+    scores, page_ids, prefixes = make_hits(R, args.num_hits)
+
+    evaluator = AutocompleteEvaluator(
+        ArrayScoreSource(scores, page_ids, prefixes),
+        {'test': pd.DataFrame({'searchterm': [prefixes[0]], 'clickpage': [page_ids[0]]})},
+        top_k=args.top_k)
+    evaluator.initialize()
+    num_groups = len(evaluator.prefix_indptr) - 1
+    print('%d searches, %.0f hits per search' % (num_groups, args.num_hits / num_groups))
+
+    # The previous lookup, given the same hits in file order
+    cats = pd.Series(prefixes).astype('category').values
+    sort_idx = np.argsort(cats.codes)
+    sorted_page_ids = page_ids[sort_idx]
+    result = np.empty((num_groups, args.top_k), dtype=np.int64)
+    before = best_of(args.repeats, lambda: argsort_lookup(
+        scores, sort_idx, evaluator.prefix_indptr, sorted_page_ids, result))
+    after = min(evaluator.evaluate().timing['build_lookup_sec'] for _ in range(args.repeats))
+
+    print('%-32s %8.3fs' % ('build_lookup_sec (argsort)', before))
+    print('%-32s %8.3fs' % ('build_lookup_sec (top-k)', after))
+    print('%-32s %8.1fx speedup' % ('', before / after))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
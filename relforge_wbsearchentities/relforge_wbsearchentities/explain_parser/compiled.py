@@ -0,0 +1,446 @@
+"""Compile merged explains into numpy/numba scoring functions
+
+An alternative to `BaseExplain.to_tf` that does not require tensorflow.
+Every explain implements `to_numpy`, which emits the python source of its
+part of the scoring equation into an EquationBuilder. The resulting
+function takes a dense (n_hits, n_columns) float32 feature matrix, laid
+out by a FeatureLayout, and a float32 vector of variable values, and
+returns the score of every hit. When numba is available the function is
+jit compiled, fusing the whole equation into a single parallel pass over
+the feature matrix.
+
+Scores match the tensorflow graph: feature vectors of varying width are
+zero padded to the widest seen, sums reduce over every column of their
+children and products broadcast.
+
+    layout = FeatureLayout.from_explain(equation, widths)
+    compiled = compile_equation(equation, layout)
+    scores = compiled(features, compiled.initial_values())
+
+Many candidate variable vectors can be scored in a single pass over the
+feature matrix with `CompiledEquation.batch`. When candidates only change
+a few variables `CompiledEquation.partial` caches every intermediate array
+that does not depend on them and only re-computes the rest:
+
+    partial = compiled.partial(['a:0'])
+    cache = partial.prepare(features, values)
+    scores = partial.batch(features, candidate_values, cache)
+"""
+from collections import OrderedDict, namedtuple
+import re
+
+import numpy as np
+
+
+use_numba = True
+if use_numba:
+    try:
+        from numba import njit, prange
+    except ImportError:
+        use_numba = False
+
+# Rows of the feature matrix scored at a time by CompiledEquation.batch. Small
+# enough for a block of rows to stay in cache while every candidate scores it.
+BATCH_ROWS = 4096
+
+
+# python source of an array expression and its width, or None for scalars
+Expr = namedtuple('Expr', ['source', 'width'])
+# assignment of an expression to a local of the equation
+Statement = namedtuple('Statement', ['name', 'source', 'width'])
+
+VARIABLE_RE = re.compile(r'\bvariables\[(\d+)\]')
+LOCAL_RE = re.compile(r'\b(t\d+)\b')
+
+
+class FeatureLayout(object):
+    """Columns of each feature vector in a dense feature matrix
+
+    Parameters
+    ----------
+    widths : list of (str, int)
+        Name and number of columns of each feature vector, in column order.
+    """
+    def __init__(self, widths):
+        self.widths = OrderedDict(widths)
+        self.offsets = {}
+        offset = 0
+        for name, width in self.widths.items():
+            self.offsets[name] = offset
+            offset += width
+        self.num_columns = offset
+
+    @classmethod
+    def from_explain(cls, explain, widths=None):
+        """Layout the feature vectors of an equation
+
+        Parameters
+        ----------
+        explain : core.BaseExplain
+        widths : dict or None
+            Number of columns of feature vectors that can be wider than
+            a single column. Defaults to the width in explain.
+        """
+        widths = widths or {}
+        return cls([(name, max(1, widths.get(name, len(value))))
+                    for name, value in sorted(explain.feature_vec().items())])
+
+    def columns(self, name):
+        """Return the (start, stop) columns of a feature vector"""
+        offset = self.offsets[name]
+        return offset, offset + self.widths[name]
+
+    def to_dict(self):
+        return {'widths': list(self.widths.items())}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([tuple(x) for x in data['widths']])
+
+    def __eq__(self, other):
+        return isinstance(other, FeatureLayout) and self.widths == other.widths
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class EquationBuilder(object):
+    """Collects the statements and variables of a scoring equation
+
+    Parameters
+    ----------
+    layout : FeatureLayout
+    """
+    def __init__(self, layout):
+        self.layout = layout
+        self.statements = []
+        self.variables = OrderedDict()
+
+    def emit(self, source, width):
+        """Assign an expression to a new local, returning the local"""
+        name = 't{}'.format(len(self.statements))
+        self.statements.append(Statement(name, source, width))
+        return Expr(name, width)
+
+    def feature(self, name):
+        start, stop = self.layout.columns(name)
+        return self.emit('features[:, {}:{}]'.format(start, stop), stop - start)
+
+    def variable(self, name, value):
+        """A tunable scalar, named like the equivalent tensorflow variable"""
+        name += ':0'
+        if name in self.variables:
+            raise ValueError('Variable {} already exists'.format(name))
+        self.variables[name] = float(value)
+        return Expr('variables[{}]'.format(len(self.variables) - 1), None)
+
+    def constant(self, value):
+        return Expr('np.float32({!r})'.format(float(value)), None)
+
+    @staticmethod
+    def width(exprs):
+        """Width of the result of broadcasting exprs together"""
+        widths = [expr.width for expr in exprs if expr.width is not None]
+        if len(set(w for w in widths if w > 1)) > 1:
+            raise Exception('Cannot broadcast feature vectors of different widths')
+        return max(widths) if widths else None
+
+    def sum(self, exprs):
+        """Sum every column of exprs into a single column"""
+        if not exprs:
+            return self.constant(0.0)
+        terms = []
+        for expr in exprs:
+            if expr.width is not None and expr.width > 1:
+                # reshape((-1, 1)) miscompiles under numba's parallel=True
+                expr = self.emit('np.expand_dims(np.sum({}, axis=1), 1)'.format(expr.source), 1)
+            terms.append(expr)
+        width = 1 if any(expr.width is not None for expr in terms) else None
+        return self.emit(' + '.join(expr.source for expr in terms), width)
+
+    def add(self, exprs):
+        """Broadcasting elementwise sum of exprs"""
+        if len(exprs) == 1:
+            return exprs[0]
+        return self.emit(' + '.join(expr.source for expr in exprs), self.width(exprs))
+
+    def product(self, exprs):
+        """Broadcasting product of exprs"""
+        if len(exprs) == 1:
+            return exprs[0]
+        return self.emit(' * '.join(expr.source for expr in exprs), self.width(exprs))
+
+    def maximum(self, exprs):
+        """Broadcasting elementwise maximum of exprs"""
+        source = exprs[0].source
+        for expr in exprs[1:]:
+            source = 'np.maximum({}, {})'.format(source, expr.source)
+        return self.emit(source, self.width(exprs))
+
+    def source(self, result):
+        """Python source of a function returning result as a 1d score array"""
+        return _function_source('equation', ['features', 'variables'], self.statements, _scores_source(result))
+
+
+def _scores_source(result):
+    """Expression converting the result of an equation into a 1d score array"""
+    if result.width is None:
+        return 'np.full(features.shape[0], {}, dtype=np.float32)'.format(result.source)
+    elif result.width == 1:
+        return 'np.ascontiguousarray({}[:, 0])'.format(result.source)
+    raise Exception('Equation must score each hit with a single value, got width {}'.format(result.width))
+
+
+def _function_source(name, args, statements, returns):
+    lines = ['def {}({}):'.format(name, ', '.join(args))]
+    lines.extend('    {} = {}'.format(statement.name, statement.source) for statement in statements)
+    lines.append('    return {}'.format(returns))
+    return '\n'.join(lines) + '\n'
+
+
+def _exec_function(source, name, **namespace):
+    namespace = dict(namespace, np=np)
+    exec(compile(source, '<equation>', 'exec'), namespace)
+    return namespace[name]
+
+
+def _dependencies(source):
+    """Indices of the variables and names of the locals read by an expression"""
+    return set(int(i) for i in VARIABLE_RE.findall(source)), set(LOCAL_RE.findall(source))
+
+
+class CompiledEquation(object):
+    """Scoring function of a merged explain
+
+    Parameters
+    ----------
+    statements : list of Statement
+        Body of the function, as collected by EquationBuilder.
+    result : Expr
+        Score of each hit, computed from the statements.
+    variables : OrderedDict
+        Map from variable name to its initial value, in the order of the
+        variables vector.
+    layout : FeatureLayout
+    jit : bool
+        Compile the function with numba when available.
+    """
+    def __init__(self, statements, result, variables, layout, jit=True):
+        self.statements = [Statement(*statement) for statement in statements]
+        self.result = Expr(*result)
+        self.source = _function_source(
+            'equation', ['features', 'variables'], self.statements, _scores_source(self.result))
+        self.variables = variables
+        self.variable_index = {name: i for i, name in enumerate(variables)}
+        self.layout = layout
+        self.jit = jit
+        self.partials = {}
+        fn = _exec_function(self.source, 'equation')
+        self.fn = fn
+        self.batch_fn = None
+        if jit and use_numba:
+            self.fn = njit(parallel=True)(fn)
+            self.batch_fn = _make_batch_fn(njit(fn))
+
+    def initial_values(self):
+        """Variable values from the explains, as a vector for __call__"""
+        return np.asarray(list(self.variables.values()), dtype=np.float32)
+
+    def __call__(self, features, values):
+        """Score hits
+
+        Parameters
+        ----------
+        features : np.ndarray
+            (n_hits, layout.num_columns) float32 feature matrix.
+        values : np.ndarray
+            float32 vector of variable values, indexed by variable_index.
+
+        Returns
+        -------
+        np.ndarray
+            (n_hits,) float32 scores
+        """
+        return self.fn(features, values)
+
+    def batch(self, features, values):
+        """Score hits with many candidate variable vectors
+
+        Parameters
+        ----------
+        features : np.ndarray
+            (n_hits, layout.num_columns) float32 feature matrix.
+        values : np.ndarray
+            (n_candidates, n_variables) float32 variable values.
+
+        Returns
+        -------
+        np.ndarray
+            (n_candidates, n_hits) float32 scores
+        """
+        if self.batch_fn is None:
+            return np.vstack([self.fn(features, row) for row in values]).reshape((len(values), len(features)))
+        return self.batch_fn(features, values)
+
+    def partial(self, changed):
+        """Scoring function re-computing only what depends on some variables
+
+        Parameters
+        ----------
+        changed : iterable of str
+            Names of the variables that may differ from the values the
+            cache is prepared with.
+
+        Returns
+        -------
+        PartialEquation
+        """
+        changed = frozenset(self.variable_index[name] for name in changed)
+        if changed not in self.partials:
+            self.partials[changed] = PartialEquation(self, changed)
+        return self.partials[changed]
+
+    def __getstate__(self):
+        # The function is rebuilt from source when unpickling
+        return {
+            'statements': self.statements, 'result': self.result, 'variables': self.variables,
+            'layout': self.layout, 'jit': self.jit,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+class PartialEquation(object):
+    """Scoring function of an equation when only some variables change
+
+    Intermediate arrays of the equation that do not depend on the changed
+    variables are computed once by `prepare` and passed back in to `batch`,
+    which only re-computes the statements depending on a changed variable.
+
+    Parameters
+    ----------
+    compiled : CompiledEquation
+    changed : frozenset of int
+        Indices of the changed variables.
+    """
+    def __init__(self, compiled, changed):
+        self.changed = changed
+        dependent = set()
+        for statement in compiled.statements:
+            variables, locals_ = _dependencies(statement.source)
+            if variables & changed or locals_ & dependent:
+                dependent.add(statement.name)
+        # Feature slices are views and cheaper to take again than to cache
+        body = [statement for statement in compiled.statements
+                if statement.name in dependent or _dependencies(statement.source) == (set(), set())]
+        in_body = set(statement.name for statement in body)
+        returns = _scores_source(compiled.result)
+        needed = set(_dependencies(returns)[1])
+        for statement in body:
+            needed.update(_dependencies(statement.source)[1])
+        self.cached = [statement for statement in compiled.statements
+                       if statement.name in needed and statement.name not in in_body]
+
+        # Only the statements leading to a cached local are needed to prepare
+        required = set(statement.name for statement in self.cached)
+        prepare = []
+        for statement in reversed(compiled.statements):
+            if statement.name in required:
+                prepare.append(statement)
+                required.update(_dependencies(statement.source)[1])
+        prepare.reverse()
+
+        cached_names = [statement.name for statement in self.cached]
+        self.prepare_source = _function_source(
+            'prepare', ['features', 'variables'], prepare, '({})'.format(''.join(n + ', ' for n in cached_names)))
+        self.source = _function_source('equation', ['features', 'variables'] + cached_names, body, returns)
+        self.prepare_fn = _exec_function(self.prepare_source, 'prepare')
+        fn = _exec_function(self.source, 'equation')
+        self.fn = fn
+        self.batch_fn = None
+        if compiled.jit and use_numba:
+            if self.cached:
+                self.prepare_fn = njit(parallel=True)(self.prepare_fn)
+            self.fn = njit(parallel=True)(fn)
+            self.batch_fn = _make_batch_fn(njit(fn), self.cached)
+
+    def prepare(self, features, values):
+        """Intermediate arrays independent of the changed variables
+
+        Parameters
+        ----------
+        features : np.ndarray
+            (n_hits, layout.num_columns) float32 feature matrix.
+        values : np.ndarray
+            float32 vector of variable values. Only the values of
+            unchanged variables matter.
+
+        Returns
+        -------
+        tuple
+            cache to pass to __call__ and batch
+        """
+        if not self.cached:
+            return ()
+        return self.prepare_fn(features, values)
+
+    def __call__(self, features, values, cache):
+        return self.fn(features, values, *cache)
+
+    def batch(self, features, values, cache):
+        """Score hits with many candidates, see CompiledEquation.batch"""
+        if self.batch_fn is None:
+            scores = [self.fn(features, row, *cache) for row in values]
+            return np.vstack(scores).reshape((len(values), len(features)))
+        return self.batch_fn(features, values, *cache)
+
+
+def _make_batch_fn(fn, cached=()):
+    """Jit a single pass over features scoring all candidates with fn
+
+    Parameters
+    ----------
+    fn : callable
+        jitted equation, taking features, variables and the cached locals.
+    cached : list of Statement
+        Locals computed ahead of time and passed through to fn, sliced to
+        the rows being scored unless they are scalars.
+    """
+    names = [statement.name for statement in cached]
+    blocks = [name if statement.width is None else '{}[start:stop]'.format(name)
+              for name, statement in zip(names, cached)]
+    source = '\n'.join([
+        'def batch({}):'.format(', '.join(['features', 'values'] + names)),
+        '    n_hits = features.shape[0]',
+        '    out = np.empty((values.shape[0], n_hits), dtype=np.float32)',
+        '    for block in prange((n_hits + BATCH_ROWS - 1) // BATCH_ROWS):',
+        '        start = block * BATCH_ROWS',
+        '        stop = min(n_hits, start + BATCH_ROWS)',
+        '        rows = features[start:stop]',
+        '        for i in range(values.shape[0]):',
+        '            out[i, start:stop] = fn({})'.format(', '.join(['rows', 'values[i]'] + blocks)),
+        '    return out',
+    ]) + '\n'
+    batch = _exec_function(source, 'batch', fn=fn, prange=prange, BATCH_ROWS=BATCH_ROWS)
+    return njit(parallel=True)(batch)
+
+
+def compile_equation(explain, layout, jit=True):
+    """Compile a merged explain into a scoring function
+
+    Parameters
+    ----------
+    explain : core.BaseExplain
+    layout : FeatureLayout
+        Columns of the feature vectors of explain in the feature matrix.
+    jit : bool
+        Compile with numba when available.
+
+    Returns
+    -------
+    CompiledEquation
+    """
+    builder = EquationBuilder(layout)
+    result = explain.to_numpy(builder)
+    return CompiledEquation(builder.statements, result, builder.variables, layout, jit)
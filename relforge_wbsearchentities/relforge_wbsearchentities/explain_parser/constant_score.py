@@ -1,5 +1,3 @@
-import tensorflow as tf
-
 from relforge_wbsearchentities.explain_parser.core import (
     BaseExplain,
     BaseExplainParser,
@@ -8,7 +6,7 @@ from relforge_wbsearchentities.explain_parser.core import (
     explain_parser_from_query,
     register_parser,
 )
-from relforge_wbsearchentities.explain_parser.utils import join_name, isclose
+from relforge_wbsearchentities.explain_parser.utils import join_name, isclose, tf
 
 
 class ConstantScoreExplainParser(BaseExplainParser):
@@ -62,3 +60,7 @@ class ConstantExplain(BaseExplain):
         prefix = join_name(join_name(self.name_prefix, self.name), self.field)
         boost = join_name(prefix, 'boost')
         return vecs[prefix] * tf.get_variable(boost, initializer=self.value)
+
+    def to_numpy(self, builder):
+        prefix = join_name(join_name(self.name_prefix, self.name), self.field)
+        return builder.product([builder.feature(prefix), builder.variable(join_name(prefix, 'boost'), self.value)])
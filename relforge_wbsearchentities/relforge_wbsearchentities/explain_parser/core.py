@@ -92,10 +92,8 @@ recreates the appropriate scoring equation.
 from collections import defaultdict
 from functools import reduce
 
-import tensorflow as tf
-
 from relforge_wbsearchentities.explain_parser.utils import (
-    isclose, join_name, name_fixer, clean_newlines)
+    isclose, join_name, name_fixer, clean_newlines, tf)
 
 
 # Full explain parser implementations
@@ -593,6 +591,25 @@ class BaseExplain(object):
         """
         raise NotImplementedError(type(self))
 
+    def child_exprs(self, builder):
+        """Emit the equations of children into a compiled.EquationBuilder"""
+        return [child.to_numpy(builder) for child in self.children]
+
+    def to_numpy(self, builder):
+        """Emit the equation of the explain into a compiled.EquationBuilder
+
+        The numpy counterpart of to_tf, see compiled.compile_equation.
+
+        Parameters
+        ----------
+        builder : compiled.EquationBuilder
+
+        Returns
+        -------
+        compiled.Expr
+        """
+        raise NotImplementedError(type(self))
+
     def feature_vec(self):
         """Extract feature vector from explain
 
@@ -641,6 +658,9 @@ class TunableVariableExplain(BaseExplain):
     def to_tf(self, vecs):
         return tf.get_variable(join_name(self.name_prefix, self.name), initializer=self.value)
 
+    def to_numpy(self, builder):
+        return builder.variable(join_name(self.name_prefix, self.name), self.value)
+
     def feature_vec(self):
         return {}
 
@@ -657,6 +677,9 @@ class PassThruExplain(BaseExplain):
     def to_tf(self, vecs):
         return vecs[join_name(self.name_prefix, self.name)]
 
+    def to_numpy(self, builder):
+        return builder.feature(join_name(self.name_prefix, self.name))
+
     def feature_vec(self):
         return {join_name(self.name_prefix, self.name): [self.value]}
 
@@ -676,6 +699,9 @@ class GlobalConstantExplain(BaseExplain):
             name = self.description.replace(' ', '-')
         return tf.constant(self.value, name=name)
 
+    def to_numpy(self, builder):
+        return builder.constant(self.value)
+
 
 class SumExplain(BaseExplain):
     boost = False  # TODO: What is this?
@@ -690,6 +716,9 @@ class SumExplain(BaseExplain):
             tensor = tf.reshape(tensor, shape=[-1, 1])
         return tensor
 
+    def to_numpy(self, builder):
+        return builder.sum(self.child_exprs(builder))
+
 
 class ProductExplain(BaseExplain):
     def to_tf(self, vecs):
@@ -717,6 +746,9 @@ class ProductExplain(BaseExplain):
             tensor = tf.reshape(tensor, [-1, 1])
         return tensor
 
+    def to_numpy(self, builder):
+        return builder.product(self.child_exprs(builder))
+
 
 class RescoreExplain(BaseExplain):
     def __init__(self, lucene_explain, name_prefix, operation_explain=None,
@@ -738,6 +770,11 @@ class RescoreExplain(BaseExplain):
             raise IncorrectExplainException("Cannot build the equation: not all rescore queries have been seen")
         return self.operation_explain.to_tf(vecs)
 
+    def to_numpy(self, builder):
+        if self.operation_explain is None:
+            raise IncorrectExplainException("Cannot build the equation: not all rescore queries have been seen")
+        return self.operation_explain.to_numpy(builder)
+
     @property
     def is_missing(self):
         return self.description == 'MISSING'
@@ -766,3 +803,6 @@ class RootExplain(BaseExplain):
 
     def to_tf(self, vecs):
         return self.children[0].to_tf(vecs)
+
+    def to_numpy(self, builder):
+        return self.children[0].to_numpy(builder)
@@ -1,5 +1,3 @@
-import tensorflow as tf
-
 from relforge_wbsearchentities.explain_parser.core import (
     explain_parser_from_query,
     merge_children,
@@ -10,7 +8,7 @@ from relforge_wbsearchentities.explain_parser.core import (
     BaseExplainParser,
     IncorrectExplainException,
 )
-from relforge_wbsearchentities.explain_parser.utils import join_name
+from relforge_wbsearchentities.explain_parser.utils import join_name, tf
 
 
 class DisMaxQueryExplainParser(BaseExplainParser):
@@ -92,3 +90,14 @@ class DisMaxExplain(BaseExplain):
             join_name(prefix, 'tie_breaker'),
             initializer=self.tie_breaker)
         return tie_breaker * total + top * (1 - tie_breaker)
+
+    def to_numpy(self, builder):
+        prefix = join_name(self.name_prefix, self.name)
+        child_exprs = self.child_exprs(builder)
+        if not child_exprs:
+            return builder.constant(0.0)
+        top = builder.maximum(child_exprs)
+        total = builder.add(child_exprs)
+        tie_breaker = builder.variable(join_name(prefix, 'tie_breaker'), self.tie_breaker)
+        return builder.emit('{tb} * {total} + {top} * (np.float32(1.0) - {tb})'.format(
+            tb=tie_breaker.source, total=total.source, top=top.source), builder.width([total, top]))
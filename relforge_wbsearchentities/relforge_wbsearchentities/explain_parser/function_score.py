@@ -1,8 +1,6 @@
 """function_score query implementation for explain parser"""
 import re
 
-import tensorflow as tf
-
 from relforge_wbsearchentities.explain_parser.core import (
     explain_parser_from_query,
     merge_children,
@@ -18,7 +16,8 @@ from relforge_wbsearchentities.explain_parser.core import (
     TunableVariableExplain
 )
 from relforge_wbsearchentities.explain_parser.match_all import MatchAllExplainParser
-from relforge_wbsearchentities.explain_parser.utils import join_name, isclose
+from relforge_wbsearchentities.explain_parser.utils import join_name, isclose, tf
+
 
 FLT_MAX = 3.4028235e+38  # in elasticsearch
 FUNCTION_SCORE_PARSERS = {}
@@ -379,6 +378,14 @@ class FunctionScoreSatuExplain(BaseExplain):
         pow_x_a = tf.pow(x, a)
         return pow_x_a / (tf.pow(k, a) + pow_x_a)
 
+    def to_numpy(self, builder):
+        prefix = join_name(self.name_prefix, self.name)
+        a = builder.variable(join_name(prefix, 'a'), self.a)
+        k = builder.variable(join_name(prefix, 'k'), self.k)
+        x = builder.feature(prefix)
+        pow_x_a = builder.emit('{} ** {}'.format(x.source, a.source), x.width)
+        return builder.emit('{p} / ({k} ** {a} + {p})'.format(p=pow_x_a.source, k=k.source, a=a.source), x.width)
+
     def feature_vec(self):
         name = join_name(self.name_prefix, self.name)
         value = self.reverse_satu(self.value)
@@ -3,8 +3,6 @@
 from collections import defaultdict
 import re
 
-import tensorflow as tf
-
 from relforge_wbsearchentities.explain_parser.core import (
     BaseExplain,
     BaseExplainParser,
@@ -19,7 +17,7 @@ from relforge_wbsearchentities.explain_parser.core import (
     parse_list,
     register_parser,
 )
-from relforge_wbsearchentities.explain_parser.utils import isclose, join_name
+from relforge_wbsearchentities.explain_parser.utils import isclose, join_name, tf
 
 
 FLT_MAX = 3.4028235e+38  # in elasticsearch
@@ -298,6 +296,9 @@ class PerFieldSumExplain(SumExplain):
         # (batch_size, n) rather than (batch_size, 1) like in most explains.
         return self.children[0].to_tf(vecs)
 
+    def child_exprs(self, builder):
+        return [self.children[0].to_numpy(builder)]
+
     def feature_vec(self):
         data = defaultdict(list)
         for child in self.children:
@@ -327,6 +328,9 @@ class PerFieldSimilarityExplain(BaseExplain):
     def to_tf(self, vecs):
         return self.children[0].to_tf(vecs)
 
+    def to_numpy(self, builder):
+        return self.children[0].to_numpy(builder)
+
     def feature_vec(self):
         return self.children[0].feature_vec()
 
@@ -371,3 +375,21 @@ class TfNormExplain(BaseExplain):
         else:
             denom = termFreq + k1
         return tf.identity((termFreq * (k1 + 1)) / denom, name=join_name(self.name_prefix, self.name))
+
+    def to_numpy(self, builder):
+        children = {c.name: c.to_numpy(builder) for c in self.children}
+        termFreq = children['termFreq']
+        k1 = children['k1']
+        if self.bm25:
+            b = children['b']
+            fieldLength = children['fieldLength']
+            # Same epsilon as to_tf, padded hits have an avgFieldLength of 0
+            denom = '{tf} + {k1} * (np.float32(1.0) - {b} + {b} * {fl} / ({avg} + np.float32(1e-6)))'.format(
+                tf=termFreq.source, k1=k1.source, b=b.source, fl=fieldLength.source,
+                avg=children['avgFieldLength'].source)
+            width = builder.width([termFreq, fieldLength])
+        else:
+            denom = '{} + {}'.format(termFreq.source, k1.source)
+            width = termFreq.width
+        return builder.emit('({tf} * ({k1} + np.float32(1.0))) / ({denom})'.format(
+            tf=termFreq.source, k1=k1.source, denom=denom), width)
@@ -1,3 +1,5 @@
+import importlib
+
 import numpy as np
 import re
 
@@ -41,3 +43,24 @@ def print_explain(lucene_explain, indent=''):
     if 'PerFieldSimilarity' not in lucene_explain['description']:
         for child in lucene_explain['details']:
             print_explain(child, indent + '\t')
+
+
+class LazyModule(object):
+    """Import a module on first attribute access
+
+    Allows modules with optional uses of heavy dependencies, such as
+    tensorflow, to be imported without paying for or requiring them.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Only needed to build and run tensorflow graphs, commands and score
+# sources working from feature matrices do not need tensorflow installed
+tf = LazyModule('tensorflow')
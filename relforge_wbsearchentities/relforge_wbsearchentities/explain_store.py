@@ -0,0 +1,384 @@
+"""Columnar storage of elasticsearch explains
+
+An explain store replaces a gzipped stream of pickled (row, hits) tuples
+with a directory of column files:
+
+* One string column per field of the query rows (context, language, prefix).
+* ``hit_offsets``: for each query row the range of its hits in the hit columns.
+* ``hit_score``: the ``_score`` of each hit.
+* ``hit_id_prefix`` and ``hit_id_number``: the ``_id`` of each hit, when
+  all of them are a prefix followed by a number (such as Q42), split into
+  an index into the prefixes listed in the metadata and the number. Other
+  ids are stored as a string column, ``hit_id``.
+* ``explain.bin``: for each query row the json encoded ``_explanation`` of
+  its hits, concatenated and zlib compressed into one block per row.
+  ``explain_block_offsets`` holds the byte range of each block, and
+  ``explain_length`` the length of each explain within its uncompressed
+  block.
+
+Integer columns use the smallest unsigned type holding their values.
+
+Everything is memory-mapped on read. Query rows can be filtered on their
+fields, and hits selected by score, without decoding any explain, and any
+range of query rows can be read independently of the others, allowing a
+store to be split between parallel readers.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+
+from relforge.cli_utils import iterate_pickle
+
+
+log = logging.getLogger(__name__)
+
+VERSION = 2
+META_FILE = 'meta.json'
+EXPLAIN_FILE = 'explain.bin'
+# Explains are written once and read many times, favor size over write speed
+COMPRESS_LEVEL = 9
+NUMERIC_ID = re.compile(r'([A-Za-z]*)(0|[1-9][0-9]{0,17})')
+
+
+def encode_strings(values):
+    """Encode strings into a utf8 byte array and (n + 1,) offsets into it"""
+    encoded = [value.encode('utf8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def compact_ints(values):
+    """Convert non-negative integers to the smallest unsigned type holding them"""
+    values = np.asarray(values)
+    if values.size == 0:
+        return values.astype(np.uint8)
+    return values.astype(np.min_scalar_type(int(values.max())))
+
+
+def encode_ids(values):
+    """Encode ids made of a prefix and a number, such as Q42, as integers
+
+    Returns
+    -------
+    (list of str, np.ndarray, np.ndarray) or None
+        The distinct prefixes, the index of each id's prefix, and the
+        number of each id. None if any id does not fit.
+    """
+    prefixes = {}
+    codes = np.zeros(len(values), dtype=np.uint8)
+    numbers = np.zeros(len(values), dtype=np.int64)
+    for i, value in enumerate(values):
+        match = NUMERIC_ID.fullmatch(value)
+        if match is None:
+            return None
+        prefix, number = match.groups()
+        code = prefixes.setdefault(prefix, len(prefixes))
+        if code > np.iinfo(np.uint8).max:
+            return None
+        codes[i] = code
+        numbers[i] = int(number)
+    return list(prefixes), codes, compact_ints(numbers)
+
+
+def decode_strings(data, offsets, start=0, stop=None):
+    """Decode strings start through stop from encode_strings output"""
+    offsets = offsets[start:None if stop is None else stop + 1]
+    if len(offsets) < 2:
+        return []
+    base = offsets[0]
+    text = data[base:offsets[-1]].tobytes()
+    bounds = (offsets - base).tolist()
+    return [text[a:b].decode('utf8') for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def is_explain_store(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+class ExplainStoreWriter(object):
+    """Write (row, hits) pairs, as returned by fetch_explain, to an explain store
+
+    The store is built in a temporary directory next to path and renamed
+    into place by close, readers never see a partial store. Explains are
+    compressed and streamed to disk as they are added, other columns are
+    held in memory.
+
+    Parameters
+    ----------
+    path : str
+        Directory to create. An existing store at this path is replaced.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = tempfile.mkdtemp(
+            prefix='.tmp-', dir=os.path.dirname(os.path.abspath(path)))
+        self.explain_file = open(os.path.join(self.tmp_path, EXPLAIN_FILE), 'wb')
+        self.row_columns = None
+        self.rows = None
+        self.hit_offsets = [0]
+        self.hit_ids = []
+        self.hit_scores = []
+        self.explain_lengths = []
+        self.explain_block_offsets = [0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, row, hits):
+        """Add a query row and its hits
+
+        Parameters
+        ----------
+        row : mapping from str to str
+            Fields describing the query, such as a pd.Series from
+            iterating a dataframe. Every row must have the same fields.
+        hits : list of dict
+            Hits from the elasticsearch _search api, with explanations.
+        """
+        if self.row_columns is None:
+            self.row_columns = list(row.keys())
+            self.rows = [[] for _ in self.row_columns]
+        elif list(row.keys()) != self.row_columns:
+            raise ValueError('Expected row with fields {} but got {}'.format(
+                self.row_columns, list(row.keys())))
+        for values, name in zip(self.rows, self.row_columns):
+            value = row[name]
+            if not isinstance(value, str):
+                raise ValueError('Only string row values can be stored, {} is {}'.format(
+                    name, type(value).__name__))
+            values.append(value)
+
+        explains = []
+        for hit in hits:
+            self.hit_ids.append(str(hit['_id']))
+            self.hit_scores.append(hit['_score'])
+            explain = json.dumps(hit.get('_explanation')).encode('utf8')
+            explains.append(explain)
+            self.explain_lengths.append(len(explain))
+        self.hit_offsets.append(len(self.hit_ids))
+        block = zlib.compress(b''.join(explains), COMPRESS_LEVEL) if explains else b''
+        self.explain_file.write(block)
+        self.explain_block_offsets.append(self.explain_block_offsets[-1] + len(block))
+
+    def _save(self, name, data):
+        np.save(os.path.join(self.tmp_path, name + '.npy'), data, allow_pickle=False)
+
+    def close(self):
+        self.explain_file.close()
+        try:
+            row_columns = self.row_columns or []
+            for i, name in enumerate(row_columns):
+                data, offsets = encode_strings(self.rows[i])
+                self._save('row{}'.format(i), data)
+                self._save('row{}_offsets'.format(i), compact_ints(offsets))
+            self._save('hit_offsets', compact_ints(self.hit_offsets))
+            numeric_ids = encode_ids(self.hit_ids)
+            if numeric_ids is None:
+                hit_id_prefixes = None
+                data, offsets = encode_strings(self.hit_ids)
+                self._save('hit_id', data)
+                self._save('hit_id_offsets', compact_ints(offsets))
+            else:
+                hit_id_prefixes, codes, numbers = numeric_ids
+                self._save('hit_id_prefix', codes)
+                self._save('hit_id_number', numbers)
+            self._save('hit_score', np.asarray(self.hit_scores, dtype=np.float64))
+            self._save('explain_length', compact_ints(self.explain_lengths))
+            self._save('explain_block_offsets', compact_ints(self.explain_block_offsets))
+            with open(os.path.join(self.tmp_path, META_FILE), 'w') as f:
+                json.dump({
+                    'version': VERSION,
+                    'rows': len(self.hit_offsets) - 1,
+                    'hits': len(self.hit_ids),
+                    'row_columns': row_columns,
+                    'hit_id_prefixes': hit_id_prefixes,
+                }, f)
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            os.rename(self.tmp_path, self.path)
+        except:  # noqa: E722
+            self.abort()
+            raise
+
+    def abort(self):
+        self.explain_file.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+class ExplainStore(object):
+    """Read an explain store written by ExplainStoreWriter
+
+    Parameters
+    ----------
+    path : str
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        if meta['version'] != VERSION:
+            raise ValueError('Unsupported explain store version {} in {}'.format(meta['version'], path))
+        self.num_rows = meta['rows']
+        self.num_hits = meta['hits']
+        self.row_columns = meta['row_columns']
+        self.hit_id_prefixes = meta['hit_id_prefixes']
+        self.explain_size = os.path.getsize(os.path.join(path, EXPLAIN_FILE))
+        self._columns = {}
+
+    def __len__(self):
+        return self.num_rows
+
+    def _load(self, name):
+        if name not in self._columns:
+            if name == EXPLAIN_FILE:
+                if self.explain_size == 0:
+                    data = np.zeros(0, dtype=np.uint8)
+                else:
+                    data = np.memmap(os.path.join(self.path, EXPLAIN_FILE), dtype=np.uint8, mode='r')
+            else:
+                data = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r', allow_pickle=False)
+            self._columns[name] = data
+        return self._columns[name]
+
+    def hit_ids(self, start, stop):
+        """Decode the _id of hits start through stop"""
+        if self.hit_id_prefixes is None:
+            return decode_strings(self._load('hit_id'), self._load('hit_id_offsets'), start, stop)
+        codes = self._load('hit_id_prefix')[start:stop].tolist()
+        numbers = self._load('hit_id_number')[start:stop].tolist()
+        return [self.hit_id_prefixes[code] + str(number) for code, number in zip(codes, numbers)]
+
+    def row_column(self, name, start=0, stop=None):
+        """Decode the values of a single row field"""
+        i = self.row_columns.index(name)
+        return decode_strings(self._load('row{}'.format(i)), self._load('row{}_offsets'.format(i)), start, stop)
+
+    def split(self, n):
+        """Divide rows into at most n contiguous ranges with similar numbers of hits
+
+        Returns
+        -------
+        list of (int, int)
+            start and stop row of each range, suitable for iterate.
+        """
+        hit_offsets = self._load('hit_offsets')
+        targets = np.linspace(0, self.num_hits, n + 1)[1:-1]
+        bounds = [0] + np.searchsorted(hit_offsets, targets).tolist() + [self.num_rows]
+        return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    def iterate(self, start=0, stop=None, where=None, min_score=None):
+        """Iterate over (row, hits) pairs, as stored by fetch_explain
+
+        Parameters
+        ----------
+        start : int
+        stop : int or None
+            Range of rows to read.
+        where : dict, callable or None
+            Only return rows whose fields equal these values, or for which
+            where(row) is true. Other rows are skipped without reading
+            their hits.
+        min_score : float or None
+            Only return hits with a score greater than this, skipping the
+            decoding of others.
+
+        Yields
+        ------
+        row : dict
+        hits : list of dict
+            Hits with their _id, _score and _explanation.
+        """
+        if stop is None:
+            stop = self.num_rows
+        if start >= stop:
+            return
+        columns = {name: self.row_column(name, start, stop) for name in self.row_columns}
+        if callable(where):
+            keep = np.asarray([
+                where({name: columns[name][i] for name in self.row_columns})
+                for i in range(stop - start)], dtype=bool)
+        else:
+            keep = np.ones(stop - start, dtype=bool)
+            for name, value in (where or {}).items():
+                keep &= np.asarray([x == value for x in columns[name]], dtype=bool)
+        if not keep.any():
+            return
+
+        hit_offsets = self._load('hit_offsets')
+        hit_scores = self._load('hit_score')
+        explain_data = self._load(EXPLAIN_FILE)
+        explain_lengths = self._load('explain_length')
+        explain_block_offsets = self._load('explain_block_offsets')
+        for i in np.flatnonzero(keep).tolist():
+            row = {name: columns[name][i] for name in self.row_columns}
+            first, last = int(hit_offsets[start + i]), int(hit_offsets[start + i + 1])
+            ids = self.hit_ids(first, last)
+            scores = hit_scores[first:last].tolist()
+            bounds = [0] + np.cumsum(explain_lengths[first:last], dtype=np.int64).tolist()
+            block = None
+            hits = []
+            for j, (hit_id, score) in enumerate(zip(ids, scores)):
+                if min_score is not None and not score > min_score:
+                    continue
+                if block is None:
+                    a, b = int(explain_block_offsets[start + i]), int(explain_block_offsets[start + i + 1])
+                    block = zlib.decompress(explain_data[a:b].tobytes())
+                hits.append({
+                    '_id': hit_id,
+                    '_score': score,
+                    '_explanation': json.loads(block[bounds[j]:bounds[j + 1]].decode('utf8')),
+                })
+            yield row, hits
+
+
+def iterate_explains(path, where=None):
+    """Iterate over (row, hits) pairs of an explain store or pickle file
+
+    Parameters
+    ----------
+    path : str
+        An explain store, or a pickle file written by earlier versions of
+        fetch_explain.
+    where : dict, callable or None
+        Only return rows whose fields equal these values, or for which
+        where(row) is true.
+    """
+    if is_explain_store(path):
+        for row, hits in ExplainStore(path).iterate(where=where):
+            yield row, hits
+        return
+    for row, hits in iterate_pickle(path):
+        if callable(where):
+            if not where(row):
+                continue
+        elif where and any(row[k] != v for k, v in where.items()):
+            continue
+        yield row, hits
+
+
+def convert_pickle(in_path, out_path):
+    """Convert a pickle file of (row, hits) pairs into an explain store
+
+    Returns
+    -------
+    int
+        Number of rows converted
+    """
+    with ExplainStoreWriter(out_path) as writer:
+        for row, hits in iterate_pickle(in_path):
+            writer.add(row, hits)
+    log.info('Converted %d rows from %s', len(writer.hit_offsets) - 1, in_path)
+    return len(writer.hit_offsets) - 1
@@ -0,0 +1,152 @@
+"""Dense feature matrices for scoring hits without tensorflow
+
+The numpy counterpart of the tfrecords written by make_tfrecord. The
+feature vectors of every hit are held in a single float32 matrix laid out
+by an explain_parser.compiled.FeatureLayout, ready to be scored by a
+compiled equation, along with the page id, prefix and lucene score of
+each hit.
+
+On disk a feature matrix is a directory of .npy files and a meta.json
+holding the layout. Arrays are memory-mapped on load.
+"""
+from collections import defaultdict
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from relforge_wbsearchentities.explain_parser import parse_hits
+from relforge_wbsearchentities.explain_parser.compiled import FeatureLayout
+from relforge_wbsearchentities.explain_store import decode_strings, encode_strings
+
+
+VERSION = 1
+META_FILE = 'meta.json'
+
+
+class FeatureMatrix(object):
+    """Feature vectors and metadata of hits
+
+    Parameters
+    ----------
+    data : np.ndarray
+        (n_hits, layout.num_columns) float32 feature vectors.
+    layout : FeatureLayout
+    page_ids : np.ndarray
+        (n_hits,) int64 page id of each hit.
+    prefixes : np.ndarray
+        (n_hits,) object array of the prefix each hit was found by.
+    explain_values : np.ndarray
+        (n_hits,) float32 score of each hit in its explain.
+    """
+    def __init__(self, data, layout, page_ids, prefixes, explain_values):
+        assert data.shape == (len(page_ids), layout.num_columns)
+        assert len(page_ids) == len(prefixes) == len(explain_values)
+        self.data = data
+        self.layout = layout
+        self.page_ids = page_ids
+        self.prefixes = prefixes
+        self.explain_values = explain_values
+
+    def __len__(self):
+        return len(self.page_ids)
+
+    def take(self, idx):
+        """Copy of the hits selected by an index array, in its order"""
+        return FeatureMatrix(
+            np.ascontiguousarray(self.data[idx]), self.layout, self.page_ids[idx],
+            self.prefixes[idx], self.explain_values[idx])
+
+    @classmethod
+    def from_explains(cls, equation, explains):
+        """Build a feature matrix from parsed hits
+
+        Parameters
+        ----------
+        equation : explain_parser.core.BaseExplain
+            Merged explain the features will be scored with. Only its
+            feature vectors are collected.
+        explains : iterable of (str, int, explain_parser.core.BaseExplain)
+            Prefix, page id and explain of each hit.
+
+        Returns
+        -------
+        FeatureMatrix
+        """
+        names = sorted(equation.feature_vec().keys())
+        page_ids = []
+        prefixes = []
+        explain_values = []
+        vectors = []
+        widths = defaultdict(int)
+        for prefix, page_id, explain in explains:
+            page_ids.append(int(page_id))
+            prefixes.append(prefix)
+            explain_values.append(explain.value)
+            vec = explain.feature_vec()
+            vectors.append(vec)
+            for name, value in vec.items():
+                widths[name] = max(widths[name], len(value))
+        # Vectors missing from all hits still get a column of zeros
+        layout = FeatureLayout([(name, max(1, widths[name])) for name in names])
+        data = np.zeros((len(vectors), layout.num_columns), dtype=np.float32)
+        for i, vec in enumerate(vectors):
+            for name, value in vec.items():
+                if name in layout.offsets:
+                    start = layout.offsets[name]
+                    data[i, start:start + len(value)] = value
+        return cls(data, layout,
+                   np.asarray(page_ids, dtype=np.int64),
+                   np.asarray(prefixes, dtype=object),
+                   np.asarray(explain_values, dtype=np.float32))
+
+    @classmethod
+    def from_lucene_explains(cls, parser, equation, lucene_explains):
+        """Build a feature matrix from (row, hits) pairs as stored by fetch_explain
+
+        Parameters
+        ----------
+        parser : explain_parser.core.RootExplainParser
+        equation : explain_parser.core.BaseExplain
+        lucene_explains : iterable of (dict, list of dict)
+        """
+        def explains():
+            for row, hits in lucene_explains:
+                for page_id, explain in parse_hits(parser, hits):
+                    yield row['prefix'], page_id, explain
+        return cls.from_explains(equation, explains())
+
+    def save(self, path):
+        """Write the feature matrix to a directory, replacing any existing one"""
+        tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            for name, value in [
+                ('data', self.data), ('page_ids', self.page_ids), ('explain_values', self.explain_values),
+            ]:
+                np.save(os.path.join(tmp_path, name + '.npy'), value, allow_pickle=False)
+            prefix_data, prefix_offsets = encode_strings(self.prefixes)
+            np.save(os.path.join(tmp_path, 'prefix.npy'), prefix_data, allow_pickle=False)
+            np.save(os.path.join(tmp_path, 'prefix_offsets.npy'), prefix_offsets, allow_pickle=False)
+            with open(os.path.join(tmp_path, META_FILE), 'w') as f:
+                json.dump(dict(self.layout.to_dict(), version=VERSION, hits=len(self)), f)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+        except:  # noqa: E722
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        if meta['version'] != VERSION:
+            raise ValueError('Unsupported feature matrix version {} in {}'.format(meta['version'], path))
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r', allow_pickle=False)
+        prefixes = decode_strings(load('prefix'), load('prefix_offsets'))
+        return cls(load('data'), FeatureLayout.from_dict(meta), load('page_ids'),
+                   np.asarray(prefixes, dtype=object), load('explain_values'))
@@ -0,0 +1,350 @@
+"""Concurrent retrieval of search explains from elasticsearch
+
+Requests are issued from a bounded pool of threads, optionally grouped
+into _msearch requests, and retried with exponential backoff when the
+cluster is overloaded. Responses are returned in request order.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import logging
+import os
+import random
+import threading
+import time
+
+import elasticsearch
+
+
+log = logging.getLogger(__name__)
+
+
+QUERY_STRING = '{{query_string}}'
+UPPER_QUERY_STRING = '{{QUERY_STRING}}'
+
+
+class QueryTemplate(object):
+    """A json document with placeholder strings to substitute
+
+    The document is walked once on construction, recording the path to
+    every string equal to a placeholder. Rendering copies only the dicts
+    and lists along those paths, everything else is shared between the
+    template and all rendered documents, which must be treated as
+    read-only.
+
+    Parameters
+    ----------
+    doc : dict
+        Decoded json document.
+    placeholders : iterable of str
+        Strings to substitute. Only complete string values are matched.
+    """
+    def __init__(self, doc, placeholders):
+        self.doc = doc
+        self.placeholders = set(placeholders)
+        self.substitutions = self._compile(doc)
+
+    def _compile(self, node):
+        """Build a tree of the substitutions below node
+
+        Returns a placeholder for a node to substitute, a dict from
+        key or list index to the substitutions below it for containers
+        with placeholders, and None otherwise.
+        """
+        if isinstance(node, str):
+            return node if node in self.placeholders else None
+        if isinstance(node, dict):
+            children = node.items()
+        elif isinstance(node, list):
+            children = enumerate(node)
+        else:
+            return None
+        substitutions = {}
+        for key, child in children:
+            child_substitutions = self._compile(child)
+            if child_substitutions is not None:
+                substitutions[key] = child_substitutions
+        return substitutions or None
+
+    def render(self, values):
+        """Substitute placeholders with values
+
+        Parameters
+        ----------
+        values : dict
+            Map from placeholder to its replacement.
+
+        Returns
+        -------
+        dict
+        """
+        if self.substitutions is None:
+            return self.doc
+        return _render(self.doc, self.substitutions, values)
+
+
+def _render(node, substitutions, values):
+    if isinstance(substitutions, str):
+        return values[substitutions]
+    node = dict(node) if isinstance(node, dict) else list(node)
+    for key, child_substitutions in substitutions.items():
+        node[key] = _render(node[key], child_substitutions, values)
+    return node
+
+
+def explain_requests(df, es_query, size):
+    """Build the explain search request of each row of a query dataframe
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Queries to run, with the query string in the prefix column.
+    es_query : dict
+        Elasticsearch query, as dumped by cirrus, containing
+        {{query_string}} and {{QUERY_STRING}} placeholders.
+    size : int
+        Number of hits to request.
+
+    Yields
+    ------
+    row : pd.Series
+    body : dict
+        Request body. Parts without placeholders are shared between
+        requests and must not be modified.
+    """
+    # Template queries are deprecated as of 5.0.0, so lets do our
+    # own replacement i guess.
+    body = {
+        'size': size,
+        'query': es_query['query'],
+        'explain': True,
+        '_source': False,
+    }
+    if 'rescore' in es_query:
+        body['rescore'] = es_query['rescore']
+    template = QueryTemplate(body, [QUERY_STRING, UPPER_QUERY_STRING])
+
+    for _, row in df.iterrows():
+        prefix = row['prefix']
+        yield row, template.render({QUERY_STRING: prefix, UPPER_QUERY_STRING: prefix.upper()})
+
+
+class FetchStats(object):
+    """Thread-safe counters describing the progress of a fetch"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.searches = 0
+        self.hits = 0
+        self.retries = 0
+        self.request_sec = 0.
+
+    def add_request(self, searches, took):
+        with self.lock:
+            self.requests += 1
+            self.searches += searches
+            self.request_sec += took
+
+    def add_hits(self, hits):
+        with self.lock:
+            self.hits += hits
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    @property
+    def summary(self):
+        took = time.time() - self.start
+        return {
+            'took_s': took,
+            'requests': self.requests,
+            'searches': self.searches,
+            'hits': self.hits,
+            'retries': self.retries,
+            'searches_per_s': self.searches / took if took > 0 else 0.,
+            'hits_per_s': self.hits / took if took > 0 else 0.,
+            'mean_request_latency_s': self.request_sec / self.requests if self.requests else 0.,
+        }
+
+    def __str__(self):
+        return ('{searches} searches in {requests} requests ({retries} retried), '
+                '{hits} hits in {took_s:.1f}s: {searches_per_s:.1f} searches/s, '
+                '{hits_per_s:.1f} hits/s, {mean_request_latency_s:.3f}s mean latency').format(**self.summary)
+
+
+def is_retryable(status_code):
+    """Check if an error status indicates an overloaded or unavailable cluster
+
+    Connection errors, without a status, are retryable as well.
+    """
+    return status_code == 'N/A' or status_code == 429 \
+        or (isinstance(status_code, int) and status_code >= 500)
+
+
+def make_elasticsearch(es, concurrency=None):
+    """Connect to elasticsearch with a connection per concurrent request
+
+    The client does not retry failed requests itself, Retrier is the only
+    retry policy and backs off between attempts.
+    """
+    return elasticsearch.Elasticsearch(
+        es, verify_certs=not os.environ.get('RELFORGE_SKIP_CERTS'), maxsize=max(10, concurrency or 0),
+        max_retries=0, retry_on_status=())
+
+
+class Retrier(object):
+    """Retry transient elasticsearch failures with exponential backoff and jitter
+
+    Parameters
+    ----------
+    max_retries : int
+        Retries after the first attempt before giving up.
+    backoff : float
+        Seconds to wait before the first retry, doubling on each retry.
+    stats : FetchStats or None
+    sleep : callable
+    """
+    def __init__(self, max_retries=5, backoff=0.5, stats=None, sleep=time.sleep):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.stats = stats
+        self.sleep = sleep
+
+    def wait(self, attempt):
+        if self.stats is not None:
+            self.stats.add_retry()
+        self.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def __call__(self, fn):
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except elasticsearch.TransportError as e:
+                if attempt >= self.max_retries or not is_retryable(e.status_code):
+                    raise
+                log.debug('Retrying failed request: %s', e)
+            self.wait(attempt)
+            attempt += 1
+
+
+def search(es, index, body, retrier, stats):
+    """Run a single search request, returning its hits"""
+    def request():
+        start = time.time()
+        res = es.search(index=index, body=body)
+        stats.add_request(1, time.time() - start)
+        return res
+    return retrier(request)['hits']['hits']
+
+
+def msearch(es, index, bodies, retrier, stats):
+    """Run searches in a single _msearch request, returning the hits of each
+
+    Searches that individually fail with a retryable error are retried,
+    along with other failed searches, in a new _msearch request.
+    """
+    results = [None] * len(bodies)
+    todo = list(range(len(bodies)))
+    attempt = 0
+    while True:
+        request_body = []
+        for i in todo:
+            request_body.extend([{'index': index}, bodies[i]])
+
+        def request():
+            start = time.time()
+            res = es.msearch(body=request_body)
+            stats.add_request(len(todo), time.time() - start)
+            return res
+        responses = retrier(request)['responses']
+
+        failed = []
+        for i, response in zip(todo, responses):
+            if 'error' not in response:
+                results[i] = response['hits']['hits']
+            elif attempt < retrier.max_retries and is_retryable(response.get('status')):
+                failed.append(i)
+            else:
+                raise elasticsearch.TransportError(response.get('status', 'N/A'), 'msearch failed', response['error'])
+        if not failed:
+            return results
+        log.debug('Retrying %d failed searches of _msearch', len(failed))
+        todo = failed
+        retrier.wait(attempt)
+        attempt += 1
+
+
+def map_ordered(fn, items, concurrency):
+    """Apply fn to items from a thread pool, yielding (item, result) in input order
+
+    At most concurrency items are in flight, or waiting to be yielded, at
+    any time.
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield item, fn(item)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(fn, item)))
+            if len(pending) >= concurrency:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def chunked(iterable, size):
+    iterable = iter(iterable)
+    return iter(lambda: list(islice(iterable, size)), [])
+
+
+def fetch_hits(es, index, requests, concurrency=1, msearch_size=0,
+               max_retries=5, backoff=0.5, stats=None):
+    """Run search requests concurrently, yielding hits in request order
+
+    Parameters
+    ----------
+    es : elasticsearch.Elasticsearch
+    index : str
+    requests : iterable of (object, dict)
+        Pairs of a key, passed through to the output, and a search body.
+    concurrency : int
+        Maximum number of requests in flight.
+    msearch_size : int
+        When greater than 0 searches are grouped into _msearch requests of
+        this many searches.
+    max_retries : int
+    backoff : float
+        Retry policy for requests failing with 429, 5xx or connection
+        errors, see Retrier.
+    stats : FetchStats or None
+        Collects throughput metrics.
+
+    Yields
+    ------
+    key : object
+    hits : list of dict
+    """
+    if stats is None:
+        stats = FetchStats()
+    retrier = Retrier(max_retries, backoff, stats)
+
+    if msearch_size > 0:
+        def fetch_batch(batch):
+            return msearch(es, index, [body for _, body in batch], retrier, stats)
+        for batch, batch_hits in map_ordered(fetch_batch, chunked(requests, msearch_size), concurrency):
+            for (key, _), hits in zip(batch, batch_hits):
+                stats.add_hits(len(hits))
+                yield key, hits
+    else:
+        def fetch_one(request):
+            return search(es, index, request[1], retrier, stats)
+        for (key, _), hits in map_ordered(fetch_one, requests, concurrency):
+            stats.add_hits(len(hits))
+            yield key, hits
@@ -0,0 +1,136 @@
+"""Expansion of search logs into the prefix queries to collect explains for
+
+Every searchterm typed into autocomplete was issued as each of its
+prefixes, so each unique prefix of the searchterms of a (context,
+language) pair is one query to run. Expansion works on numpy arrays of
+unicode code points rather than per-row python strings: searchterms are
+deduplicated, grouped by length, and the prefixes of each length are cut
+from all searchterms at least that long in one slice.
+"""
+from gzip import GzipFile
+import logging
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from relforge.parallel import map_ordered
+
+
+log = logging.getLogger(__name__)
+
+COLUMNS = ('context', 'language', 'prefix')
+
+
+def expand_prefixes(searchterms):
+    """Return the unique non-empty prefixes of an array of strings
+
+    Parameters
+    ----------
+    searchterms : array-like of str
+
+    Returns
+    -------
+    np.ndarray of object
+        Unique prefixes, ordered by length and then by code point.
+    """
+    terms = pd.unique(np.asarray(searchterms, dtype=object))
+    lengths = pd.Series(terms, dtype=object).str.len().values.astype(np.int64)
+    order = np.argsort(lengths, kind='stable')
+    terms, lengths = terms[order], lengths[order]
+
+    # (n, length) arrays of code points for each length of searchterm
+    by_length = []
+    for length in np.unique(lengths).tolist():
+        if length == 0:
+            continue
+        start, stop = np.searchsorted(lengths, [length, length + 1])
+        codes = np.array(terms[start:stop].tolist(), dtype='U{}'.format(length))
+        by_length.append((length, codes.view(np.uint32).reshape(-1, length)))
+
+    result = []
+    for i in range(1, by_length[-1][0] + 1 if by_length else 1):
+        dtype = 'U{}'.format(i)
+        # Prefixes of different lengths are distinct, deduplicate
+        # within each length only.
+        cut = [np.ascontiguousarray(codes[:, :i]).view(dtype).ravel()
+               for length, codes in by_length if length >= i]
+        result.append(np.unique(np.concatenate(cut)).astype(object))
+    if not result:
+        return np.zeros(0, dtype=object)
+    return np.concatenate(result)
+
+
+def expand_queries(df_source):
+    """Expand searchterms into the unique prefixes of each (context, language)
+
+    Parameters
+    ----------
+    df_source : pd.DataFrame
+        Search logs with context, language and searchterm columns.
+
+    Yields
+    ------
+    key : (str, str)
+        The context and language.
+    df : pd.DataFrame
+        Prefix queries with context, language and prefix columns.
+    """
+    df_terms = df_source[['context', 'language', 'searchterm']].drop_duplicates()
+    for (context, language), df_group in df_terms.groupby(['context', 'language']):
+        prefixes = expand_prefixes(df_group['searchterm'].values)
+        yield (context, language), pd.DataFrame({
+            'context': context,
+            'language': language,
+            'prefix': prefixes,
+        }, columns=COLUMNS)
+
+
+def iterate_splits(out_path, groups, batch_size):
+    """Divide prefix queries into files of at most batch_size queries
+
+    Yields
+    ------
+    path : str
+    df_batch : pd.DataFrame
+    """
+    for (context, language), df_one in groups:
+        log.info('Generating splits for (%s, %s) with %d searches to perform', context, language, len(df_one))
+        for i, start in enumerate(range(0, len(df_one), batch_size)):
+            batch_filename = 'query-{:04d}.{}_{}.pkl.gz'.format(i, context, language)
+            yield os.path.join(out_path, batch_filename), df_one.iloc[start:start + batch_size]
+
+
+def write_split(split):
+    path, df_batch = split
+    with GzipFile(path, 'wb') as f:
+        pickle.dump(df_batch, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def write_splits(out_path, df_source, batch_size, workers=1):
+    """Expand search logs into prefix queries and write them out in splits
+
+    Parameters
+    ----------
+    out_path : str
+        Directory to write splits to.
+    df_source : pd.DataFrame
+        Search logs with context, language and searchterm columns.
+    batch_size : int
+        Maximum number of queries per split.
+    workers : int
+        Number of processes compressing and writing splits.
+
+    Returns
+    -------
+    int
+        Number of splits written.
+    """
+    splits = iterate_splits(out_path, expand_queries(df_source), batch_size)
+    count = 0
+    for path in map_ordered(write_split, splits, workers):
+        log.info('Wrote query split %s', path)
+        count += 1
+    return count
@@ -0,0 +1,9 @@
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers', 'forks: forks worker processes, run before numba starts its thread pool')
+
+
+def pytest_collection_modifyitems(items):
+    # Forking after compiled equations have started numba's threads can
+    # deadlock the child, so run the tests that fork first.
+    items.sort(key=lambda item: item.get_closest_marker('forks') is None)
@@ -0,0 +1,27 @@
+import numpy as np
+
+from relforge_wbsearchentities.features import FeatureMatrix
+from .test_explain_parser import TESTS
+
+
+def make_explain(name='MatchQueryExplainParser_multi_term'):
+    return dict(TESTS['tensor_equiv'])[name]()
+
+
+def make_features():
+    explain = make_explain()
+    hits = [('q', 1, explain), ('q', 2, explain), ('qü', 1, explain), ('qü\0x', 3, explain)]
+    return explain, FeatureMatrix.from_explains(explain, hits)
+
+
+def make_hit_data(R, n_hits):
+    """Features of n_hits hits of one explain, varied so hits score differently
+
+    Returns
+    -------
+    explain, FeatureLayout and np.ndarray of shape (n_hits, num_columns)
+    """
+    explain = make_explain()
+    base = FeatureMatrix.from_explains(explain, [('q', 1, explain)])
+    data = (base.data * R.uniform(0.5, 2, (n_hits, base.layout.num_columns))).astype(np.float32)
+    return explain, base.layout, data
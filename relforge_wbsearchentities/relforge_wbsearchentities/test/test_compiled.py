@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from relforge_wbsearchentities.explain_parser.compiled import compile_equation
+from .helpers import make_hit_data
+
+
+def make_compiled(jit, n_hits=200, seed=0):
+    explain, layout, data = make_hit_data(np.random.RandomState(seed), n_hits)
+    return compile_equation(explain, layout, jit=jit), data
+
+
+@pytest.mark.parametrize('jit', [True, False])
+def test_compiled_batch(jit):
+    compiled, data = make_compiled(jit)
+    R = np.random.RandomState(0)
+    values = compiled.initial_values() * R.uniform(0.5, 1.5, (3, len(compiled.variables))).astype(np.float32)
+    expected = np.vstack([compiled(data, row) for row in values])
+    np.testing.assert_allclose(compiled.batch(data, values), expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize('jit', [True, False])
+def test_partial_equation(jit):
+    compiled, data = make_compiled(jit)
+    R = np.random.RandomState(0)
+    initial_values = compiled.initial_values()
+    for i, name in enumerate(compiled.variables):
+        partial = compiled.partial([name])
+        assert compiled.partial([name]) is partial
+        cache = partial.prepare(data, initial_values)
+        values = np.tile(initial_values, (3, 1))
+        values[:, i] *= R.uniform(0.5, 1.5, 3).astype(np.float32)
+        expected = compiled.batch(data, values)
+        np.testing.assert_allclose(partial.batch(data, values, cache), expected, rtol=1e-5)
+        np.testing.assert_allclose(partial(data, values[0], cache), expected[0], rtol=1e-5)
@@ -5,9 +5,9 @@ import pickle
 
 import numpy as np
 import pytest
-import tensorflow as tf
 from . import token_count_router_suite
 
+from relforge_wbsearchentities.explain_parser.compiled import compile_equation
 from relforge_wbsearchentities.explain_parser.core import \
     BaseExplain, RootExplainParser
 from relforge_wbsearchentities.explain_parser.bool import \
@@ -24,6 +24,8 @@ from relforge_wbsearchentities.explain_parser.match_all import \
     MATCH_ALL_EXPLAIN, MatchAllExplainParser
 from relforge_wbsearchentities.explain_parser.match import \
     MatchQueryExplainParser, MultiMatchQueryExplainParser
+from relforge_wbsearchentities.explain_parser.utils import tf
+from relforge_wbsearchentities.features import FeatureMatrix
 
 
 TESTS = defaultdict(list)
@@ -1963,6 +1965,30 @@ def test_trainable_tensors(name, make_explain, expected_tunables):
         assert var.dtype.is_floating
 
 
+@pytest.mark.parametrize('jit', [True, False])
+@pytest.mark.parametrize('name,make_explain', TESTS['tensor_equiv'])
+def test_numpy_is_equivalent(name, make_explain, jit):
+    explain = make_explain()
+    features = FeatureMatrix.from_explains(explain, [('pytest', 1, explain)])
+    compiled = compile_equation(explain, features.layout, jit=jit)
+    result = compiled(features.data, compiled.initial_values())
+    assert result.shape == (1,)
+    assert result.dtype == np.float32
+    assert result[0] == pytest.approx(explain.value), compiled.source
+
+
+@pytest.mark.parametrize('name,make_explain,expected_tunables', TESTS['trainable'])
+def test_numpy_variables(name, make_explain, expected_tunables):
+    explain = make_explain()
+    features = FeatureMatrix.from_explains(explain, [('pytest', 1, explain)])
+    compiled = compile_equation(explain, features.layout, jit=False)
+    assert set(compiled.variables.keys()) == set(expected_tunables)
+    # Survives pickling, as done when passing equations to worker processes
+    unpickled = pickle.loads(pickle.dumps(compiled))
+    values = compiled.initial_values()
+    np.testing.assert_array_equal(unpickled(features.data, values), compiled(features.data, values))
+
+
 @pytest.mark.parametrize('name,make_explain,other_explains', TESTS['merge'])
 def test_merge(name, make_explain, other_explains):
     parser, explain = make_explain(verbose=True)
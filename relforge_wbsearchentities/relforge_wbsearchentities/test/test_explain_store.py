@@ -0,0 +1,135 @@
+from gzip import GzipFile
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from relforge_wbsearchentities import explain_store
+
+
+def make_hit(page_id, score):
+    return {
+        '_id': str(page_id),
+        '_score': score,
+        '_explanation': {
+            'value': score,
+            'description': 'sum of: ü',
+            'details': [{'value': score, 'description': 'weight(title:q{})'.format(page_id), 'details': []}],
+        },
+    }
+
+
+RECORDS = [
+    (pd.Series({'context': 'item', 'language': 'en', 'prefix': 'q'}), [make_hit(1, 2.0), make_hit(2, 0.)]),
+    (pd.Series({'context': 'item', 'language': 'de', 'prefix': 'qu'}), [make_hit(3, 1.5)]),
+    (pd.Series({'context': 'item', 'language': 'en', 'prefix': ''}), []),
+    (pd.Series({'context': 'item', 'language': 'en', 'prefix': 'qü\0x'}), [make_hit(4, 1.0), make_hit(5, 0.5)]),
+]
+
+
+@pytest.fixture
+def pickle_path(tmpdir):
+    path = str(tmpdir.join('explain.pkl.gz'))
+    with GzipFile(path, 'wb') as f:
+        for record in RECORDS:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def as_dicts(records):
+    return [(dict(row), hits) for row, hits in records]
+
+
+def test_convert_roundtrip(pickle_path, tmpdir):
+    out_path = str(tmpdir.join('explain.explain'))
+    assert explain_store.convert_pickle(pickle_path, out_path) == len(RECORDS)
+    assert explain_store.is_explain_store(out_path)
+    assert not explain_store.is_explain_store(pickle_path)
+    store = explain_store.ExplainStore(out_path)
+    assert len(store) == len(RECORDS)
+    assert store.num_hits == 5
+    assert list(store.iterate()) == as_dicts(RECORDS)
+    assert list(explain_store.iterate_explains(out_path)) == as_dicts(RECORDS)
+    assert as_dicts(explain_store.iterate_explains(pickle_path)) == as_dicts(RECORDS)
+    assert store.row_column('prefix', 1, 3) == ['qu', '']
+    assert store.row_column('prefix') == [row['prefix'] for row, _ in RECORDS]
+
+
+@pytest.mark.parametrize('convert', [False, True])
+def test_iterate_where(pickle_path, tmpdir, convert):
+    path = pickle_path
+    if convert:
+        path = str(tmpdir.join('explain.explain'))
+        explain_store.convert_pickle(pickle_path, path)
+    records = as_dicts(explain_store.iterate_explains(path, where={'language': 'en'}))
+    assert records == as_dicts([RECORDS[0], RECORDS[2], RECORDS[3]])
+    records = as_dicts(explain_store.iterate_explains(path, where=lambda row: row['prefix'].startswith('qu')))
+    assert records == as_dicts([RECORDS[1]])
+
+
+def test_iterate_min_score(pickle_path, tmpdir):
+    out_path = str(tmpdir.join('explain.explain'))
+    explain_store.convert_pickle(pickle_path, out_path)
+    store = explain_store.ExplainStore(out_path)
+    hits = [hits for _, hits in store.iterate(min_score=0)]
+    assert [[hit['_id'] for hit in x] for x in hits] == [['1'], ['3'], [], ['4', '5']]
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 10])
+def test_split(pickle_path, tmpdir, n):
+    out_path = str(tmpdir.join('explain.explain'))
+    explain_store.convert_pickle(pickle_path, out_path)
+    store = explain_store.ExplainStore(out_path)
+    ranges = store.split(n)
+    assert len(ranges) <= n
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(RECORDS)
+    assert all(a[1] == b[0] for a, b in zip(ranges[:-1], ranges[1:]))
+    records = [record for start, stop in ranges for record in store.iterate(start, stop)]
+    assert records == as_dicts(RECORDS)
+
+
+def test_empty_store(tmpdir):
+    out_path = str(tmpdir.join('explain.explain'))
+    with explain_store.ExplainStoreWriter(out_path):
+        pass
+    store = explain_store.ExplainStore(out_path)
+    assert len(store) == 0
+    assert list(store.iterate()) == []
+    assert store.split(4) == []
+
+
+def test_failed_write_leaves_nothing(tmpdir):
+    out_path = str(tmpdir.join('explain.explain'))
+    with pytest.raises(ValueError):
+        with explain_store.ExplainStoreWriter(out_path) as writer:
+            writer.add({'prefix': 'a'}, [])
+            writer.add({'prefix': 1}, [])
+    assert tmpdir.listdir() == []
+
+
+def test_decode_strings():
+    data, offsets = explain_store.encode_strings(['a', 'bü', '', 'c'])
+    assert explain_store.decode_strings(data, offsets) == ['a', 'bü', '', 'c']
+    assert explain_store.decode_strings(data, offsets, 2) == ['', 'c']
+    assert explain_store.decode_strings(data, offsets, 1, 2) == ['bü']
+    assert explain_store.decode_strings(data, explain_store.compact_ints(offsets), 1) == ['bü', '', 'c']
+
+
+@pytest.mark.parametrize('ids,numeric', [
+    (['Q1', 'P22', 'Q333', 'L4', '5'], True),
+    (['Q1', 'Q2', 'Q3', 'Q4', 'Q05'], False),
+    (['Q1', 'Q2', 'Q3', 'Q4', 'L1-S1'], False),
+    (['Q1', 'Q2', 'Q3', 'Q4', 'Q12345678901234567890'], False),
+])
+def test_hit_ids(tmpdir, ids, numeric):
+    out_path = str(tmpdir.join('explain.explain'))
+    ids = iter(ids)
+    records = [(row, [dict(hit, _id=next(ids)) for hit in hits]) for row, hits in RECORDS]
+    with explain_store.ExplainStoreWriter(out_path) as writer:
+        for row, hits in records:
+            writer.add(row, hits)
+    store = explain_store.ExplainStore(out_path)
+    assert (store.hit_id_prefixes is not None) == numeric
+    assert store._load('hit_offsets').dtype == np.uint8
+    assert list(store.iterate()) == as_dicts(records)
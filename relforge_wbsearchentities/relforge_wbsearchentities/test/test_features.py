@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from relforge_wbsearchentities.features import FeatureMatrix
+from .helpers import make_explain, make_features
+
+
+def test_from_explains():
+    explain, features = make_features()
+    assert len(features) == 4
+    assert features.data.shape == (4, features.layout.num_columns)
+    assert features.page_ids.tolist() == [1, 2, 1, 3]
+    assert features.prefixes.tolist() == ['q', 'q', 'qü', 'qü\0x']
+    assert features.explain_values.tolist() == [pytest.approx(explain.value)] * 4
+
+
+def test_save_load(tmpdir):
+    _, features = make_features()
+    path = str(tmpdir.join('features'))
+    features.save(path)
+    # Saving again replaces the existing matrix
+    features.save(path)
+    loaded = FeatureMatrix.load(path)
+    assert loaded.layout == features.layout
+    np.testing.assert_array_equal(loaded.data, features.data)
+    assert loaded.page_ids.tolist() == features.page_ids.tolist()
+    assert loaded.prefixes.tolist() == features.prefixes.tolist()
+    np.testing.assert_array_equal(loaded.explain_values, features.explain_values)
+
+
+def test_save_load_empty(tmpdir):
+    explain = make_explain()
+    features = FeatureMatrix.from_explains(explain, [])
+    path = str(tmpdir.join('features'))
+    features.save(path)
+    loaded = FeatureMatrix.load(path)
+    assert len(loaded) == 0
+    assert loaded.data.shape == (0, features.layout.num_columns)
@@ -0,0 +1,211 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+import elasticsearch
+import pandas as pd
+import pytest
+
+from relforge_wbsearchentities import fetch
+
+
+class StubElasticsearch(object):
+    """Answer _search and _msearch with a hit per request naming its query string
+
+    The first `failures` searches are rejected with `failure_status`, and
+    each search takes `delay` seconds.
+    """
+    def __init__(self, failures=0, failure_status=429, delay=0.):
+        self.failures = failures
+        self.failure_status = failure_status
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.searches = 0
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+
+    def search(self, body):
+        with self.lock:
+            self.searches += 1
+            if self.failures > 0:
+                self.failures -= 1
+                return self.failure_status, {'error': {'type': 'es_rejected_execution_exception'},
+                                             'status': self.failure_status}
+        query_string = body['query']['match']['title']
+        return 200, {'hits': {'hits': [{
+            '_id': query_string,
+            '_score': 1.0,
+            '_explanation': {'value': 1.0, 'description': 'stub', 'details': []},
+        }]}}
+
+    def handle(self, path, payload):
+        with self.lock:
+            self.requests += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            if path.endswith('/_msearch'):
+                lines = [json.loads(line) for line in payload.decode('utf8').splitlines() if line]
+                responses = []
+                for body in lines[1::2]:
+                    status, response = self.search(body)
+                    responses.append(dict(response, status=status) if status != 200 else response)
+                return 200, {'responses': responses}
+            return self.search(json.loads(payload.decode('utf8')))
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@pytest.fixture
+def stub():
+    stub = StubElasticsearch()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_request(self):
+            payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            status, response = stub.handle(self.path.split('?')[0], payload)
+            data = json.dumps(response).encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_request
+        do_POST = do_request
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    stub.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    yield stub
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def es(stub):
+    return fetch.make_elasticsearch(stub.url, concurrency=8)
+
+
+def make_requests(n):
+    return [(i, {'query': {'match': {'title': 'query {}'.format(i)}}}) for i in range(n)]
+
+
+def hit_ids(results):
+    return [(key, [hit['_id'] for hit in hits]) for key, hits in results]
+
+
+@pytest.mark.parametrize('concurrency,msearch_size', [(1, 0), (4, 0), (1, 3), (4, 3)])
+def test_fetch_hits_in_order(stub, es, concurrency, msearch_size):
+    stub.delay = 0.01
+    stats = fetch.FetchStats()
+    results = list(fetch.fetch_hits(es, 'index', make_requests(20), concurrency=concurrency,
+                                    msearch_size=msearch_size, stats=stats))
+    assert hit_ids(results) == [(i, ['query {}'.format(i)]) for i in range(20)]
+    assert stub.max_active <= concurrency
+    assert stats.searches == 20
+    assert stats.hits == 20
+    assert stats.requests == (20 if msearch_size == 0 else 7)
+    assert 'searches/s' in str(stats)
+
+
+@pytest.mark.parametrize('msearch_size', [0, 3])
+@pytest.mark.parametrize('status', [429, 503])
+def test_fetch_hits_retries(stub, es, msearch_size, status):
+    stub.failures = 4
+    stub.failure_status = status
+    stats = fetch.FetchStats()
+    results = list(fetch.fetch_hits(es, 'index', make_requests(6), concurrency=2, msearch_size=msearch_size,
+                                    backoff=0.001, stats=stats))
+    assert hit_ids(results) == [(i, ['query {}'.format(i)]) for i in range(6)]
+    assert stats.retries > 0
+    assert stub.searches == 10
+
+
+@pytest.mark.parametrize('msearch_size', [0, 3])
+@pytest.mark.parametrize('status', [429, 503])
+def test_fetch_hits_gives_up(stub, es, msearch_size, status):
+    stub.failures = 100
+    stub.failure_status = status
+    with pytest.raises(elasticsearch.TransportError) as excinfo:
+        list(fetch.fetch_hits(es, 'index', make_requests(3), msearch_size=msearch_size,
+                              max_retries=2, backoff=0.001))
+    assert excinfo.value.status_code == status
+    # Only Retrier retries, the client makes a single attempt per call
+    assert stub.requests == 3
+
+
+def test_fetch_hits_does_not_retry_bad_requests(stub, es):
+    stub.failures = 1
+    stub.failure_status = 400
+    with pytest.raises(elasticsearch.TransportError):
+        list(fetch.fetch_hits(es, 'index', make_requests(3), backoff=0.001))
+    assert stub.searches == 1
+
+
+def test_retrier_backoff():
+    sleeps = []
+    retrier = fetch.Retrier(max_retries=3, backoff=1., sleep=sleeps.append)
+    attempts = []
+
+    def fail():
+        attempts.append(1)
+        raise elasticsearch.ConnectionError('N/A', 'connection refused', None)
+    with pytest.raises(elasticsearch.ConnectionError):
+        retrier(fail)
+    assert len(attempts) == 4
+    assert [0.5 <= s / (2 ** i) <= 1.5 for i, s in enumerate(sleeps)] == [True] * 3
+
+
+def test_explain_requests():
+    df = pd.DataFrame({'prefix': ['ab', 'c"d']})
+    es_query = {
+        'query': {'match': {'title': '{{query_string}}', 'upper': '{{QUERY_STRING}}'}},
+        'rescore': [{'query': {'rescore_query': {'match': {'title': '{{query_string}}'}}}}],
+    }
+    requests = list(fetch.explain_requests(df, es_query, 10))
+    assert [row['prefix'] for row, _ in requests] == ['ab', 'c"d']
+    assert requests[1][1] == {
+        'size': 10,
+        'query': {'match': {'title': 'c"d', 'upper': 'C"D'}},
+        'explain': True,
+        '_source': False,
+        'rescore': [{'query': {'rescore_query': {'match': {'title': 'c"d'}}}}],
+    }
+
+
+def test_query_template():
+    shared = {'term': {'field': 'value'}}
+    doc = {
+        'bool': {
+            'should': [shared, {'match': {'title': '{{query_string}}'}}],
+            'filter': [{'prefix': {'title': '{{query_string}}'}}, '{{query_string}} suffix'],
+        },
+        'count': 3,
+    }
+    template = fetch.QueryTemplate(doc, ['{{query_string}}'])
+    rendered = template.render({'{{query_string}}': 'foo'})
+    assert rendered == {
+        'bool': {
+            'should': [shared, {'match': {'title': 'foo'}}],
+            'filter': [{'prefix': {'title': 'foo'}}, '{{query_string}} suffix'],
+        },
+        'count': 3,
+    }
+    # Subtrees without placeholders are shared, the template is untouched
+    assert rendered['bool']['should'][0] is shared
+    assert doc['bool']['should'][1]['match']['title'] == '{{query_string}}'
+    assert template.render({'{{query_string}}': 'bar'})['bool']['filter'][0]['prefix']['title'] == 'bar'
+
+
+def test_query_template_without_placeholders():
+    doc = {'match_all': {}}
+    assert fetch.QueryTemplate(doc, ['{{query_string}}']).render({'{{query_string}}': 'foo'}) is doc
@@ -0,0 +1,135 @@
+from gzip import GzipFile
+import json
+import os
+import pickle
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import relforge_wbsearchentities.__main__ as cli
+from relforge_wbsearchentities.explain_store import ExplainStoreWriter
+
+
+ROWS = [
+    ('item', 'en', 'a', ['1', '2']),
+    ('item', 'de', 'b', ['3']),
+    ('property', 'en', 'c', ['4']),
+    ('item', 'en', 'd', []),
+    ('item', 'en', 'e', ['5']),
+    ('item', 'de', 'f', ['6', '7']),
+]
+
+
+def make_records():
+    for context, language, prefix, ids in ROWS:
+        row = pd.Series({'context': context, 'language': language, 'prefix': prefix})
+        hits = [{'_id': hit_id, '_score': 1.0, '_explanation': {}} for hit_id in ids]
+        yield row, hits
+
+
+class FakeRecordWriter(object):
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+
+    def write(self, example):
+        self.f.write(example + b'\n')
+
+    def close(self):
+        self.f.close()
+
+
+@pytest.fixture
+def fake_examples(monkeypatch):
+    """Replace tensorflow examples with '<prefix>:<id>' lines"""
+    monkeypatch.setattr(cli, '_variant_parser', lambda es_query_path: es_query_path)
+    monkeypatch.setattr(cli, 'make_examples', lambda parser, row, hits: [
+        '{}:{}'.format(row['prefix'], hit['_id']).encode('utf8') for hit in hits])
+    monkeypatch.setattr(cli, 'tf', SimpleNamespace(python_io=SimpleNamespace(TFRecordWriter=FakeRecordWriter)))
+
+
+@pytest.fixture
+def store_path(tmpdir):
+    path = str(tmpdir.join('explain.explain'))
+    with ExplainStoreWriter(path) as writer:
+        for row, hits in make_records():
+            writer.add(row, hits)
+    return path
+
+
+@pytest.fixture
+def pickle_path(tmpdir):
+    path = str(tmpdir.join('explain.pkl.gz'))
+    with GzipFile(path, 'wb') as f:
+        for record in make_records():
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+ES_QUERY_PATHS = {'item_en': 'en.pkl', 'item_de': 'de.pkl'}
+
+
+def test_make_examples_units(store_path, pickle_path):
+    units = list(cli.make_examples_units([store_path, pickle_path], ES_QUERY_PATHS, 4))
+    assert units == [
+        (store_path, 0, 4, ES_QUERY_PATHS),
+        (store_path, 4, 6, ES_QUERY_PATHS),
+        (pickle_path, None, None, ES_QUERY_PATHS),
+    ]
+
+
+@pytest.mark.parametrize('rows_per_unit', [1, 4, 100])
+def test_make_examples_units_cover_store(store_path, rows_per_unit):
+    units = list(cli.make_examples_units([store_path], ES_QUERY_PATHS, rows_per_unit))
+    assert units[0][1] == 0 and units[-1][2] == len(ROWS)
+    assert all(a[2] == b[1] for a, b in zip(units[:-1], units[1:]))
+    assert all(stop - start <= rows_per_unit for _, start, stop, _ in units)
+
+
+def test_make_examples_unit_routes_by_pair(fake_examples, store_path, pickle_path):
+    expected = {'item_en': [b'a:1', b'a:2', b'e:5'], 'item_de': [b'b:3', b'f:6', b'f:7']}
+    # Rows of property_en, and those without hits, are skipped
+    assert cli.make_examples_unit((store_path, 0, len(ROWS), ES_QUERY_PATHS)) == expected
+    assert cli.make_examples_unit((pickle_path, None, None, ES_QUERY_PATHS)) == expected
+    assert cli.make_examples_unit((store_path, 2, 4, ES_QUERY_PATHS)) == {}
+    assert cli.make_examples_unit((store_path, 1, 2, {'item_de': 'de.pkl'})) == {'item_de': [b'b:3']}
+
+
+@pytest.mark.forks
+@pytest.mark.parametrize('workers', [1, 2])
+def test_make_tfrecords_keeps_order(fake_examples, store_path, pickle_path, tmpdir, workers):
+    out_dir = tmpdir.mkdir('tfrecord')
+    summary = str(out_dir.join('.complete'))
+    cli.make_tfrecords(
+        cli.LuceneExplains([store_path, pickle_path]), summary, workers,
+        str(tmpdir.join('cirrus_queries.{}.pkl.gz')), ['item_en', 'item_de'], str(out_dir), 1)
+    assert out_dir.join('item_en.tfrecord').read() == 'a:1\na:2\ne:5\n' * 2
+    assert out_dir.join('item_de.tfrecord').read() == 'b:3\nf:6\nf:7\n' * 2
+    assert not os.path.exists(str(out_dir.join('property_en.tfrecord')))
+    with open(summary) as f:
+        assert json.load(f) == {'item_en': 6, 'item_de': 6}
+
+
+@pytest.mark.parametrize('raw_val,expected', [('2', 2), ('3', 3), ('1', None), ('0', None)])
+def test_int_at_least(raw_val, expected):
+    if expected is None:
+        with pytest.raises(ValueError):
+            cli.int_at_least(2)(raw_val)
+    else:
+        assert cli.int_at_least(2)(raw_val) == expected
+
+
+@pytest.mark.parametrize('raw_val,expected', [('1', 1.0), ('0.25', 0.25), ('0', None), ('-0.5', None), ('1.5', None)])
+def test_positive_fraction(raw_val, expected):
+    if expected is None:
+        with pytest.raises(ValueError):
+            cli.positive_fraction(raw_val)
+    else:
+        assert cli.positive_fraction(raw_val) == expected
+
+
+def test_hyperband_rejects_tfrecord():
+    def minimize(make_optimizer, **kwargs):
+        raise AssertionError('should not minimize')
+    with pytest.raises(ValueError):
+        cli.hyperband(minimize=minimize, eta=3, min_fraction=1 / 27, dataset=object(), features=None)
@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from relforge.cli_utils import load_pkl
+from relforge_wbsearchentities import benchmark, queries
+
+
+def test_expand_prefixes():
+    prefixes = queries.expand_prefixes(['abc', 'ab', 'abd', '', 'żółw', 'abc'])
+    assert prefixes.tolist() == ['a', 'ż', 'ab', 'żó', 'abc', 'abd', 'żół', 'żółw']
+
+
+def test_expand_prefixes_empty():
+    assert queries.expand_prefixes([]).tolist() == []
+    assert queries.expand_prefixes(['']).tolist() == []
+
+
+def test_expand_queries_matches_iterrows():
+    df_source = benchmark.make_source(np.random.RandomState(0), 2000)
+    expected = benchmark.iterrows_expand(df_source)
+    groups = list(queries.expand_queries(df_source))
+    assert [key for key, _ in groups] == sorted(set(zip(df_source['context'], df_source['language'])))
+    df_prefix = pd.concat([df for _, df in groups])
+    assert list(df_prefix.columns) == list(queries.COLUMNS)
+    assert sorted(map(tuple, df_prefix.values.tolist())) == sorted(map(tuple, expected.values.tolist()))
+
+
+@pytest.mark.forks
+@pytest.mark.parametrize('workers', [1, 2])
+def test_write_splits(tmpdir, workers):
+    df_source = pd.DataFrame({
+        'context': ['item'] * 3 + ['property'],
+        'language': ['en'] * 4,
+        'searchterm': ['abcd', 'abce', 'x', 'p'],
+    })
+    assert queries.write_splits(str(tmpdir), df_source, 3, workers) == 3
+
+    names = ['query-0000.item_en.pkl.gz', 'query-0001.item_en.pkl.gz', 'query-0000.property_en.pkl.gz']
+    assert sorted(os.listdir(str(tmpdir))) == sorted(names)
+    # The first prefix of each group is included in the first split
+    prefixes = [load_pkl(os.path.join(str(tmpdir), name))['prefix'].tolist() for name in names]
+    assert prefixes == [['a', 'x', 'ab'], ['abc', 'abcd', 'abce'], ['p']]
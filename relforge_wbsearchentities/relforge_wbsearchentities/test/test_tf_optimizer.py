@@ -2,9 +2,12 @@ import json
 import string
 
 import numpy as np
+import pandas as pd
 import pytest
 
+from relforge_wbsearchentities.features import FeatureMatrix
 import relforge_wbsearchentities.tf_optimizer as opt
+from .helpers import make_features, make_hit_data
 
 
 def test_score_query_doesnt_blow_up():
@@ -58,3 +61,194 @@ def test_report_is_json_serializable(make_report):
     json.dumps(report.summary)
     json.dumps(report.to_dict(with_scores=False))
     json.dumps(report.to_dict(with_scores=True))
+
+
+@pytest.mark.parametrize('n,top_k', [(0, 3), (2, 3), (3, 3), (100, 7)])
+def test_select_top_k(n, top_k):
+    scores = np.random.RandomState(0).permutation(n).astype(np.float32)
+    out = np.empty(top_k, dtype=np.int64)
+    assert opt.select_top_k(scores, out) == min(n, top_k)
+    expected = np.argsort(scores)[::-1][:top_k]
+    assert out[:min(n, top_k)].tolist() == expected.tolist()
+
+
+def test_select_top_k_ties():
+    out = np.empty(3, dtype=np.int64)
+    assert opt.select_top_k(np.asarray([1, 2, 1, 2, 1], dtype=np.float32), out) == 3
+    assert out.tolist() == [1, 3, 0]
+
+
+def test_build_results_lookup_matches_argsort():
+    from relforge_wbsearchentities import benchmark_lookup
+    R = np.random.RandomState(0)
+    scores, page_ids, prefixes = benchmark_lookup.make_hits(R, 5000, min_group=1, max_group=50)
+    evaluator = opt.AutocompleteEvaluator(
+        benchmark_lookup.ArrayScoreSource(scores, page_ids, prefixes),
+        {'test': pd.DataFrame({'searchterm': [prefixes[0]], 'clickpage': [page_ids[0]]})},
+        top_k=7)
+    evaluator.initialize()
+    indptr = evaluator.prefix_indptr
+    sort_idx = np.argsort(pd.Series(prefixes).astype('category').values.codes, kind='stable')
+    expected = benchmark_lookup.argsort_lookup(
+        scores, sort_idx, indptr, page_ids[sort_idx], np.full((len(indptr) - 1, 7), -1, dtype=np.int64))
+    result = evaluator._build_results_lookup(
+        evaluator.score_source.scores_batch([{}]), indptr, evaluator.page_ids,
+        np.empty((1, len(indptr) - 1, 7), dtype=np.int64))
+    np.testing.assert_array_equal(result[0], expected)
+
+
+def test_numpy_score_source():
+    explain, features = make_features()
+    source = opt.NumpyScoreSource(explain, features)
+    np.testing.assert_allclose(source.scores(), features.explain_values, rtol=1e-5)
+    page_ids, prefixes = source.metadata()
+    assert page_ids.tolist() == [1, 2, 1, 3]
+    assert prefixes.tolist() == ['q', 'q', 'qü', 'qü\0x']
+
+    initial_values = source.get_values()
+    assert set(initial_values.keys()) == set(source.variable_names)
+    name = source.variable_names[0]
+    source.assign({name: initial_values[name] * 2})
+    assert source.get_values()[name] == pytest.approx(initial_values[name] * 2)
+    assert not np.allclose(source.scores(), features.explain_values)
+
+
+def test_evaluate_numpy_score_source():
+    explain, features = make_features()
+    source = opt.NumpyScoreSource(explain, features)
+    datasets = {
+        'test': pd.DataFrame({'searchterm': ['qü', 'q'], 'clickpage': [1, 2]}),
+    }
+    evaluator = opt.AutocompleteEvaluator(source, datasets, top_k=2)
+    evaluator.initialize()
+    report = evaluator.initial_report
+    assert evaluator.num_hits == 4
+    assert set(report.variables.keys()) == set(source.variable_names)
+    assert len(report['test'].scores) == 2
+
+    analyzer = opt.SensitivityAnalyzer(evaluator, width=3)
+    sensitivity_report = analyzer.evaluate()
+    assert set(sensitivity_report.variables) == set(source.variable_names)
+    # Variables are restored after analysis
+    assert source.get_values() == report.variables
+
+
+def make_evaluator(n_hits=200, seed=0, words=('query',)):
+    R = np.random.RandomState(seed)
+    explain, layout, data = make_hit_data(R, n_hits)
+    all_prefixes = sorted(set(prefix for word in words for prefix in opt.prefixes(word)))
+    prefix_idx = R.randint(0, len(all_prefixes), n_hits)
+    # Every prefix has hits
+    prefix_idx[:len(all_prefixes)] = np.arange(len(all_prefixes))
+    hit_prefixes = np.asarray(all_prefixes, dtype=object)[prefix_idx]
+    page_ids = R.randint(1, 30, n_hits).astype(np.int64)
+    features = FeatureMatrix(data, layout, page_ids, hit_prefixes, np.zeros(n_hits, dtype=np.float32))
+    train_words = list(words) if len(words) > 1 else ['query']
+    test_words = list(words) if len(words) > 1 else ['quer']
+    datasets = {
+        'train': pd.DataFrame({'searchterm': R.choice(train_words, 20), 'clickpage': R.randint(1, 30, 20)}),
+        'test': pd.DataFrame({'searchterm': R.choice(test_words, 20), 'clickpage': R.randint(1, 30, 20)}),
+    }
+    evaluator = opt.AutocompleteEvaluator(opt.NumpyScoreSource(explain, features), datasets, top_k=3)
+    evaluator.initialize()
+    return evaluator
+
+
+def test_evaluate_batch():
+    evaluator = make_evaluator()
+    source = evaluator.score_source
+    initial_values = source.get_values()
+    candidates = [{name: value * scale for name, value in initial_values.items()} for scale in (0.1, 1, 3)]
+    candidates.append({})
+    reports = evaluator.evaluate_batch(candidates)
+    # Candidates do not change the variables of the score source
+    assert source.get_values() == initial_values
+    assert len(reports) == len(candidates)
+    for candidate, report in zip(candidates, reports):
+        source.assign(candidate)
+        expected = evaluator.evaluate()
+        source.assign(initial_values)
+        assert report.variables == expected.variables
+        for name in ('train', 'test'):
+            np.testing.assert_array_equal(report[name].scores, expected[name].scores)
+
+
+@pytest.mark.parametrize('candidates_per_pass', [1, 4])
+def test_hyperopt_minimize(candidates_per_pass):
+    evaluator = make_evaluator()
+    optimizer = opt.HyperoptOptimizer(evaluator, None, 'train', seed=0, candidates_per_pass=candidates_per_pass)
+    report = optimizer.minimize(restarts=2, epochs=6)
+    assert len(report.evaluation_reports) == 12
+    # The best values are assigned when done
+    best = min(report.evaluation_reports[6:], key=lambda r: r['train'].mean)
+    assert evaluator.score_source.get_values() == pytest.approx(best.variables)
+
+
+def test_scores_batch_partial():
+    evaluator = make_evaluator()
+    source = evaluator.score_source
+    name = source.variable_names[0]
+    value = source.get_values()[name]
+    candidates = [{name: value * scale} for scale in (0.5, 2)]
+    for candidate, scores in zip(candidates, source.scores_batch(candidates)):
+        before = source.get_values()
+        source.assign(candidate)
+        np.testing.assert_allclose(scores, source.scores(), rtol=1e-5)
+        source.assign(before)
+    # Cached intermediates are dropped when another variable changes
+    other = source.variable_names[-1]
+    source.assign({other: source.get_values()[other] * 3})
+    for candidate, scores in zip(candidates, source.scores_batch(candidates)):
+        before = source.get_values()
+        source.assign(candidate)
+        np.testing.assert_allclose(scores, source.scores(), rtol=1e-5)
+        source.assign(before)
+
+
+@pytest.mark.parametrize('candidates_per_pass', [0, -1])
+def test_hyperopt_rejects_candidates_per_pass(candidates_per_pass):
+    with pytest.raises(ValueError):
+        opt.HyperoptOptimizer(None, None, 'train', seed=0, candidates_per_pass=candidates_per_pass)
+
+
+WORDS = ('query', 'quest', 'queue', 'label', 'lake', 'lamp', 'wiki', 'data', 'date', 'dog')
+
+
+def test_subsample():
+    evaluator = make_evaluator(n_hits=1000, words=WORDS)
+    full = evaluator.evaluate()
+    # All search terms sampled evaluate the same as the full evaluator
+    sub = evaluator.subsample(1, np.random.RandomState(0))
+    assert list(sub.datasets.keys()) == ['train']
+    np.testing.assert_array_equal(sub.evaluate()['train'].scores, full['train'].scores)
+
+    sub = evaluator.subsample(0.3, np.random.RandomState(0))
+    assert 0 < sub.num_hits < evaluator.num_hits
+    assert 0 < len(sub.datasets['train']) < len(evaluator.datasets['train'])
+    # Sampled clickthroughs score the same as in the full evaluator
+    train_scores = sub.evaluate()['train'].scores
+    assert set(train_scores.tolist()) <= set(full['train'].scores.tolist())
+
+
+def test_hyperband_minimize():
+    evaluator = make_evaluator(n_hits=1000, words=WORDS)
+    optimizer = opt.HyperbandOptimizer(evaluator, None, 'train', seed=0, eta=2, min_fraction=0.25)
+    assert optimizer.num_rounds == 3
+    brackets = optimizer.brackets(14)
+    assert [rounds for rounds, _ in brackets] == [3, 2, 1]
+    assert sum(size for _, size in brackets) == 14
+    report = optimizer.minimize(restarts=1, epochs=14)
+    # Only finalists of each bracket are evaluated on all hits
+    assert len(report.evaluation_reports) == sum(max(1, size // 2 ** (rounds - 1)) for rounds, size in brackets)
+    assert report.budget['candidates'] == 14
+    assert 0 < report.budget['saved'] < 1
+    assert report.budget['hit_evaluations'] < report.budget['full_hit_evaluations']
+    assert 'budget' in report.summary
+    best = min(report.evaluation_reports, key=lambda r: r['train'].mean)
+    assert evaluator.score_source.get_values() == pytest.approx(best.variables)
+
+
+@pytest.mark.parametrize('eta,min_fraction', [(1, 0.25), (0, 0.25), (2, 0), (2, 1.5)])
+def test_hyperband_rejects_bounds(eta, min_fraction):
+    with pytest.raises(ValueError):
+        opt.HyperbandOptimizer(None, None, 'train', seed=0, eta=eta, min_fraction=min_fraction)
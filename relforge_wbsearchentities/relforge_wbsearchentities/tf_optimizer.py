@@ -1,10 +1,16 @@
+import copy
 import logging
 import time
 
 import hyperopt
+import hyperopt.base
+import hyperopt.pyll.stochastic
+import hyperopt.tpe
 import numpy as np
 import pandas as pd
-import tensorflow as tf
+
+from relforge_wbsearchentities.explain_parser.compiled import compile_equation
+from relforge_wbsearchentities.explain_parser.utils import tf
 
 
 use_numba = True
@@ -70,6 +76,44 @@ def score_query(search_results, clickpage, exam_prob=EXAM_PROB):
     return result
 
 
+@njit()
+def select_top_k(scores, out):
+    """Indices of the largest scores, from highest to lowest
+
+    A partial selection, keeping the top len(out) indices sorted by
+    insertion as scores are visited once. Ties keep the earlier index
+    first.
+
+    Parameters
+    ----------
+    scores : 1d float ndarray
+    out : 1d int ndarray
+        Receives the selected indices into scores.
+
+    Returns
+    -------
+    int
+        Number of indices written to out, the lesser of len(scores)
+        and len(out).
+    """
+    top_k = out.shape[0]
+    n = 0
+    for i in range(scores.shape[0]):
+        score = scores[i]
+        if n < top_k:
+            j = n
+            n += 1
+        elif score > scores[out[top_k - 1]]:
+            j = top_k - 1
+        else:
+            continue
+        while j > 0 and scores[out[j - 1]] < score:
+            out[j] = out[j - 1]
+            j -= 1
+        out[j] = i
+    return n
+
+
 class EvaluationScores(object):
     def __init__(self, scores):
         self.scores = scores
@@ -130,12 +174,16 @@ class EvaluationReport(object):
 
 
 class MinimizeReport(object):
-    def __init__(self, initial_report, evaluation_reports, num_observations, num_hits, dataset='test'):
+    def __init__(
+        self, initial_report, evaluation_reports, num_observations, num_hits, dataset='test', budget=None
+    ):
         self.initial_report = initial_report
         self.evaluation_reports = evaluation_reports
         self.num_hits = num_hits
         self.num_observations = num_observations
         self.dataset = dataset
+        # Compute spent by optimizers evaluating candidates on subsamples
+        self.budget = budget
         # TODO: This are set after creation because reasons...
         self.run_parameters = None
 
@@ -151,13 +199,16 @@ class MinimizeReport(object):
 
     @property
     def summary(self):
-        return {
+        summary = {
             'run_parameters': self.run_parameters,
             'num_observations': self.num_observations,
             'num_hits': self.num_hits,
             'initial_report': self.initial_report.summary,
             'best_report': self.best_report.summary,
         }
+        if self.budget is not None:
+            summary['budget'] = self.budget
+        return summary
 
     def to_dict(self, with_scores=False):
         """Create a json serializable dictionary version of the report"""
@@ -196,18 +247,219 @@ class SensitivityReport(object):
         }
 
 
-class AutocompleteEvaluator(object):
-    def __init__(
-        self, tf_session, data_init_op, score_op, datasets, top_k,
-        variables_ops, metric=score_query, train='train', test='test',
-        max_prefix_len=10,
-    ):
+class TfScoreSource(object):
+    """Score hits by running a tensorflow graph over a dataset
+
+    Parameters
+    ----------
+    tf_session : tf.Session
+    data_init_op : tf.Operation
+        Initializer of the dataset iterator.
+    score_op : tf.Tensor
+        Scores of a batch of hits, as built by BaseExplain.to_tf.
+    next_batch : dict
+        Tensors of the next batch of the dataset, including the
+        meta/page_id and meta/prefix of the hits.
+    variables : list of tf.Variable
+        Tunable variables, addressed by their name.
+    """
+    def __init__(self, tf_session, data_init_op, score_op, next_batch, variables):
         self.tf_session = tf_session
         self.data_init_op = data_init_op
         self.score_op = score_op
+        self.next_batch = next_batch
+        self.order = None
+        self.variables = {var.name: var for var in variables}
+        self.assign_var = tf.placeholder(shape=(), dtype=tf.float32)
+        self.assign_ops = {name: var.assign(self.assign_var) for name, var in self.variables.items()}
+
+    @property
+    def variable_names(self):
+        return list(self.variables.keys())
+
+    def get_values(self):
+        """Current value of each variable, by name"""
+        return self.tf_session.run(self.variables)
+
+    def assign(self, values):
+        """Set variables from a dict of name to value"""
+        for var_name, value in values.items():
+            self.tf_session.run(self.assign_ops[var_name], {
+                self.assign_var: value,
+            })
+
+    def metadata(self):
+        """Page id and prefix of each hit, in the order they are scored"""
+        results = np.hstack(tf_run_all(self.tf_session, self.data_init_op, [
+            self.next_batch['meta/page_id'],
+            self.next_batch['meta/prefix']]))
+        page_ids = results[0].ravel().astype(np.int64)
+        prefixes = pd.Series(results[1].ravel()).str.decode('utf8').values
+        if self.order is not None:
+            return page_ids[self.order], prefixes[self.order]
+        return page_ids, prefixes
+
+    def reorder(self, order):
+        """Return hits in the provided order from now on
+
+        The dataset is read in file order, so scores are re-ordered after
+        every pass.
+        """
+        self.order = order if self.order is None else self.order[order]
+
+    def take(self, idx):
+        """Score source returning only the hits selected by an index array
+
+        Shares the session and variables. Every pass still reads and
+        scores the whole dataset before selecting the hits.
+        """
+        source = copy.copy(self)
+        source.reorder(idx)
+        return source
+
+    def scores(self):
+        scores = np.vstack(tf_run_all(self.tf_session, self.data_init_op, self.score_op)).ravel()
+        if self.order is not None:
+            return scores[self.order]
+        return scores
+
+    def scores_batch(self, candidates):
+        """Scores of the hits with each candidate, see NumpyScoreSource.scores_batch
+
+        The graph only holds one value per variable, each candidate is
+        a separate pass over the dataset.
+        """
+        initial_values = self.get_values()
+        changed = set()
+        scores = []
+        try:
+            for values in candidates:
+                self.assign(values)
+                changed.update(values.keys())
+                scores.append(self.scores())
+        finally:
+            self.assign({name: initial_values[name] for name in changed})
+        return np.vstack(scores)
+
+
+class NumpyScoreSource(object):
+    """Score hits with a compiled equation over a feature matrix
+
+    Keeps the whole optimization in-process without tensorflow, see
+    explain_parser.compiled.
+
+    Parameters
+    ----------
+    equation : explain_parser.core.BaseExplain
+        Merged explain to score hits with.
+    features : features.FeatureMatrix
+    variable_names : list of str or None
+        Names of the tunable variables, as reported by the tensorflow
+        graph. Defaults to all variables of the equation.
+    """
+    def __init__(self, equation, features, variable_names=None):
+        self.compiled = compile_equation(equation, features.layout)
+        self.features = features
+        self.values = self.compiled.initial_values()
+        if variable_names is None:
+            variable_names = list(self.compiled.variables.keys())
+        self.variable_names = variable_names
+        # Changed variable indices and the partial equation cache prepared
+        # from the current values, see scores_batch
+        self._partial_cache = None
+
+    def get_values(self):
+        """Current value of each variable, by name"""
+        return {name: self.values[self.compiled.variable_index[name]] for name in self.variable_names}
+
+    def _set_values(self, out, values):
+        for var_name, value in values.items():
+            out[self.compiled.variable_index[var_name]] = value
+
+    def assign(self, values):
+        """Set variables from a dict of name to value"""
+        before = self.values.copy()
+        self._set_values(self.values, values)
+        if not np.array_equal(before, self.values):
+            self._partial_cache = None
+
+    def metadata(self):
+        """Page id and prefix of each hit, in the order they are scored"""
+        return np.asarray(self.features.page_ids, dtype=np.int64), self.features.prefixes
+
+    def reorder(self, order):
+        """Score hits in the provided order from now on
+
+        Copies the feature matrix into the new order a single time.
+        """
+        self.features = self.features.take(order)
+        self._partial_cache = None
+
+    def take(self, idx):
+        """Score source over the hits selected by an index array
+
+        Shares the compiled equation, starting from the current values.
+        """
+        source = copy.copy(self)
+        source.features = self.features.take(idx)
+        source.values = self.values.copy()
+        source._partial_cache = None
+        return source
+
+    def scores(self):
+        return self.compiled(self.features.data, self.values)
+
+    def scores_batch(self, candidates):
+        """Scores of the hits with each candidate in a single pass over the features
+
+        When the candidates only change some of the variables, intermediate
+        arrays not depending on them are computed once and re-used until
+        the variables are next assigned.
+
+        Parameters
+        ----------
+        candidates : list of dict
+            Map from variable name to value. Variables not included keep
+            their current value.
+
+        Returns
+        -------
+        np.ndarray
+            (len(candidates), n_hits) float32 scores
+        """
+        values = np.tile(self.values, (len(candidates), 1))
+        for i, candidate in enumerate(candidates):
+            self._set_values(values[i], candidate)
+        changed = [name for name, i in self.compiled.variable_index.items() if np.any(values[:, i] != self.values[i])]
+        if len(changed) == len(self.compiled.variables):
+            return self.compiled.batch(self.features.data, values)
+        partial = self.compiled.partial(changed)
+        if self._partial_cache is None or self._partial_cache[0] != partial.changed:
+            self._partial_cache = (partial.changed, partial.prepare(self.features.data, self.values))
+        return partial.batch(self.features.data, values, self._partial_cache[1])
+
+
+class AutocompleteEvaluator(object):
+    """Evaluate autocomplete rankings of scored hits against clickthroughs
+
+    Parameters
+    ----------
+    score_source : TfScoreSource or NumpyScoreSource
+        Scores the hits, and tracks the variables, of the equation under
+        test.
+    datasets : dict
+        Map from dataset name to a DataFrame of clickthroughs with
+        searchterm and clickpage columns.
+    top_k : int
+        Number of results shown per prefix.
+    """
+    def __init__(
+        self, score_source, datasets, top_k, metric=score_query,
+        train='train', test='test', max_prefix_len=10,
+    ):
+        self.score_source = score_source
         self.datasets = datasets
         self.top_k = top_k
-        self.variables_ops = variables_ops
         self.metric = metric
         self.max_prefix_len = max_prefix_len
 
@@ -219,8 +471,8 @@ class AutocompleteEvaluator(object):
     def num_observations(self):
         return {k: len(df) for k, df in self.datasets.items()}
 
-    def make_agg_report(self, reports):
-        return MinimizeReport(self.initial_report, reports, self.num_observations, self.num_hits)
+    def make_agg_report(self, reports, budget=None):
+        return MinimizeReport(self.initial_report, reports, self.num_observations, self.num_hits, budget=budget)
 
     def _simplify_df(self, df, str_to_cat_id):
         df.reset_index(inplace=True)
@@ -250,16 +502,12 @@ class AutocompleteEvaluator(object):
         _, idx = np.unique(x, return_index=True)
         return np.append(idx, len(x))
 
-    def initialize(self, next_batch):
+    def initialize(self):
         start = time.time()
         # Pull some initial metadata about the dataset that we need for scoring
-        results = np.hstack(tf_run_all(self.tf_session, self.data_init_op, [
-            next_batch['meta/page_id'],
-            next_batch['meta/prefix']]))
-        self.page_ids = results[0].ravel().astype(np.int64)
-        # generate a 0-indexed id for every unqiue string in the tensorflow data
-        prefixes = results[1].ravel()
-        cats = pd.Series(prefixes).str.decode('utf8').astype('category').values
+        self.page_ids, prefixes = self.score_source.metadata()
+        # generate a 0-indexed id for every unqiue string in the data
+        cats = pd.Series(prefixes).astype('category').values
         self.max_cat_id = len(cats.categories)
         # Dict from string to it's id
         str_to_cat_id = {prefix: cat_id for cat_id, prefix in enumerate(cats.categories)}
@@ -268,67 +516,133 @@ class AutocompleteEvaluator(object):
         # sparse, but it needs to be in numpy for numba.
         self.results_lookup_idx = self._build_results_lookup_indexes(str_to_cat_id)
         # Pre-sort into prefix groups and pre-calculate boundaries of
-        # each prefix as in indptr.
-        self.sort_idx = np.argsort(cats.codes)
-        sorted_prefixes = cats.codes[self.sort_idx]
-        self.page_ids = self.page_ids[self.sort_idx]
+        # each prefix as in indptr. The score source returns scores in
+        # the same order, leaving nothing to re-order per evaluation.
+        sort_idx = np.argsort(cats.codes, kind='stable')
+        self.score_source.reorder(sort_idx)
+        sorted_prefixes = cats.codes[sort_idx]
+        self.page_ids = self.page_ids[sort_idx]
         self.prefix_indptr = self._make_indptr(sorted_prefixes)
         # Convert dataframes to ndarrays of ints for numba
         self.datasets = {k: self._simplify_df(df, str_to_cat_id)
                          for k, df in self.datasets.items()}
         # results are same size every evaluation, hold a buffer for them.
-        rlb_shape = (len(self.prefix_indptr) - 1, self.top_k)
-        self.results_lookup_buffer = np.empty(rlb_shape, dtype=self.page_ids.dtype)
+        self.results_lookup_buffer = np.empty((0, len(self.prefix_indptr) - 1, self.top_k), dtype=self.page_ids.dtype)
         took = time.time() - start
         # Must be last step of initialization.
         self.initial_report = self.evaluate()
         self.initial_report.timing['initialize_sec'] = took
 
+    def subsample(self, fraction, R, dataset='train'):
+        """Evaluator over a stratified subsample of a dataset
+
+        Search terms of the dataset are grouped by their number of
+        clickthroughs, on a log2 scale, and fraction of each group is
+        sampled. Only the hits of the prefixes of sampled search terms
+        are kept, so evaluation costs shrink with the fraction while each
+        sampled clickthrough scores the same as in the full evaluator.
+        Must be called after initialize.
+
+        Parameters
+        ----------
+        fraction : float
+            Share of the search terms to sample, between 0 and 1.
+        R : np.random.RandomState
+        dataset : str
+            Name of the dataset to sample, the only dataset of the
+            returned evaluator.
+
+        Returns
+        -------
+        AutocompleteEvaluator
+        """
+        clickthroughs = self.datasets[dataset]
+        searchterms, counts = np.unique(clickthroughs[:, 0], return_counts=True)
+        strata = np.log2(counts).astype(np.int64)
+        keep = []
+        for stratum in np.unique(strata):
+            members = searchterms[strata == stratum]
+            keep.append(R.choice(members, max(1, int(round(len(members) * fraction))), replace=False))
+        keep = np.sort(np.concatenate(keep)) if keep else searchterms
+        clickthroughs = clickthroughs[np.isin(clickthroughs[:, 0], keep)]
+
+        # Searches read by the metric, including the padding of short search terms
+        cat_ids = np.union1d(keep, self.results_lookup_idx[keep].ravel())
+        starts = self.prefix_indptr[cat_ids]
+        sizes = self.prefix_indptr[cat_ids + 1] - starts
+        indptr = np.append(0, np.cumsum(sizes))
+        hits = np.repeat(starts - indptr[:-1], sizes) + np.arange(indptr[-1])
+
+        sub = AutocompleteEvaluator(
+            self.score_source.take(hits), {dataset: None}, self.top_k, self.metric,
+            max_prefix_len=self.max_prefix_len)
+        # Same state initialize would build, with cat_ids renumbered
+        sub.page_ids = self.page_ids[hits]
+        sub.max_cat_id = len(cat_ids)
+        sub.prefix_indptr = indptr
+        sub.results_lookup_idx = np.zeros((len(cat_ids), self.max_prefix_len), dtype=np.int64)
+        sub.results_lookup_idx[np.searchsorted(cat_ids, keep)] = np.searchsorted(
+            cat_ids, self.results_lookup_idx[keep])
+        clickthroughs = clickthroughs.copy()
+        clickthroughs[:, 0] = np.searchsorted(cat_ids, clickthroughs[:, 0])
+        sub.datasets = {dataset: clickthroughs}
+        sub.results_lookup_buffer = np.empty((0, len(cat_ids), self.top_k), dtype=sub.page_ids.dtype)
+        return sub
+
+    def _results_lookup_buffer(self, n_candidates):
+        if self.results_lookup_buffer.shape[0] < n_candidates:
+            self.results_lookup_buffer = np.empty(
+                (n_candidates,) + self.results_lookup_buffer.shape[1:], dtype=self.results_lookup_buffer.dtype)
+        return self.results_lookup_buffer[:n_candidates]
+
     @staticmethod
     @njit(parallel=True)
-    def _build_results_lookup(scores, sort_idx, indptr, page_ids, result):
+    def _build_results_lookup(scores, indptr, page_ids, result):
         """Build search result lists out of scores
 
         Takes the scores generated by the ranker under test and
         populates a result array with the page_ids of the top k
-        results for each group identified by indptr.
+        results for each candidate and group identified by indptr.
 
-        All input ndarrays except indptr must have the same first
-        dimension. Result out must have a first dimension equal
-        to the length of indptr - 1. The second dimension will
-        be populated with rank order page_ids for each search.
+        The second dimension of scores, and the first dimension of
+        page_ids, must be the same. Result out must have a second
+        dimension equal to the length of indptr - 1. The third
+        dimension will be populated with rank order page_ids for each
+        search, padded with -1 when a search has less than k results.
 
         Parameters
         ----------
-        scores : 1d float ndarray
-        sort_idx : 1d int ndarray
-            indices to re-order scores such that it is grouped
-            by search term.
+        scores : 2d float ndarray
+            scores of each hit, per candidate, grouped by search term.
         indptr : 1d int ndarray
             points to search term result start indices in
             scores, page_ids, and result
         page_ids : 1d int ndarray
-            associated page_id for each element in scores after
-            it is sorted by sort_idx
-        result : 2d float ndarray
+            associated page_id for each hit in scores
+        result : 3d int ndarray
             Output array containing top k page_ids for each
-            group in indptr. k is set by the width passed in.
+            candidate and group in indptr. k is set by the width
+            passed in.
 
         Returns
         -------
-        2d float ndarray
+        3d int ndarray
             Returns the result argument
         """
-        top_k = result.shape[1]
-        scores = scores.ravel()[sort_idx]
-        for i in prange(len(indptr) - 1):
-            search_scores = scores[indptr[i]:indptr[i+1]]
-            # argsorts always sorts low to high, so take last top_k
-            # and reverse with ::-1
-            top_k_idx = np.argsort(search_scores)[-top_k:][::-1]
-            # argsort returned indices from the start of search_scores. to
-            # index into page_ids shift by indptr[i]
-            result[i, :len(top_k_idx)] = page_ids[indptr[i] + top_k_idx]
+        n_candidates = scores.shape[0]
+        top_k = result.shape[2]
+        # Short prefixes have many more hits than long ones, spread
+        # every (group, candidate) pair over the threads for balance.
+        for j in prange((len(indptr) - 1) * n_candidates):
+            i = j // n_candidates
+            c = j % n_candidates
+            start = indptr[i]
+            top_k_idx = np.empty(top_k, dtype=np.int64)
+            n = select_top_k(scores[c, start:indptr[i+1]], top_k_idx)
+            for r in range(n):
+                result[c, i, r] = page_ids[start + top_k_idx[r]]
+            for r in range(n, top_k):
+                result[c, i, r] = -1
         return result
 
     @staticmethod
@@ -355,116 +669,183 @@ class AutocompleteEvaluator(object):
         Returns
         -------
         np.ndarray
-            result of applying metric to each row of clickthroughs
+            (n_candidates, n_clickthroughs) result of applying metric to
+            each row of clickthroughs with the results of each candidate
         """
-        out = np.empty(clickthroughs.shape[0], dtype=np.float32)
+        out = np.empty((results_lookup.shape[0], clickthroughs.shape[0]), dtype=np.float32)
         for i in prange(clickthroughs.shape[0]):
             cat_id, clickpage = clickthroughs[i]
             # list of cat_ids for prefix searches on cat_id
             # from shortest to longest
             results_list_idx = results_lookup_idx[cat_id]
-            # the search results for all prefix searches of cat_id
-            # up to self.max_prefix_len
-            searchterm_results = results_lookup[results_list_idx]
-            out[i] = metric(searchterm_results, clickpage)
+            for c in range(results_lookup.shape[0]):
+                # the search results for all prefix searches of cat_id
+                # up to self.max_prefix_len
+                searchterm_results = results_lookup[c][results_list_idx]
+                out[c, i] = metric(searchterm_results, clickpage)
         return out
 
     def evaluate(self):
+        """Evaluate the current variables of the score source"""
+        return self.evaluate_batch([{}])[0]
+
+    def evaluate_batch(self, candidates):
+        """Evaluate many candidate variable values in a single pass over the hits
+
+        Parameters
+        ----------
+        candidates : list of dict
+            Map from variable name to value. Variables not included keep
+            the current value of the score source.
+
+        Returns
+        -------
+        list of EvaluationReport
+            Report of each candidate. Timings are amortized over the batch.
+        """
+        n_candidates = len(candidates)
         start = time.time()
-        scores = np.vstack(tf_run_all(
-            self.tf_session, self.data_init_op, self.score_op))
+        scores = self.score_source.scores_batch(candidates)
         took_generate = time.time() - start
 
         start = time.time()
         results = self._build_results_lookup(
-            scores, self.sort_idx, self.prefix_indptr,
-            self.page_ids, self.results_lookup_buffer)
+            scores, self.prefix_indptr, self.page_ids,
+            self._results_lookup_buffer(n_candidates))
         took_lookup = time.time() - start
 
         start = time.time()
-        scores = {k: self._eval_metric(clickthroughs, results, self.results_lookup_idx, self.metric)
-                  for k, clickthroughs in self.datasets.items()}
+        metrics = {k: self._eval_metric(clickthroughs, results, self.results_lookup_idx, self.metric)
+                   for k, clickthroughs in self.datasets.items()}
         took_eval = time.time() - start
 
-        variables = self.tf_session.run(self.variables_ops)
-        report = EvaluationReport(variables, scores, timing={
-            'generate_sec': took_generate,
-            'build_lookup_sec': took_lookup,
-            'eval_sec': took_eval,
-        })
-        log.info('evaluate: total: %.4fs, gen: %.4fs lookup: %.4fs score: %.4fs',
-                 report.took_sec, took_generate, took_lookup, took_eval)
-        return report
+        variables = self.score_source.get_values()
+        timing = {
+            'generate_sec': took_generate / n_candidates,
+            'build_lookup_sec': took_lookup / n_candidates,
+            'eval_sec': took_eval / n_candidates,
+        }
+        reports = [
+            EvaluationReport(dict(variables, **candidate), {k: v[i] for k, v in metrics.items()}, dict(timing))
+            for i, candidate in enumerate(candidates)]
+        log.info('evaluate %d candidates: total: %.4fs, gen: %.4fs lookup: %.4fs score: %.4fs',
+                 n_candidates, took_generate + took_lookup + took_eval, took_generate, took_lookup, took_eval)
+        return reports
 
 
 class SensitivityAnalyzer(object):
-    def __init__(self, tf_session, evaluator, variables, width=20):
+    def __init__(self, evaluator, variables=None, width=20):
         """Initialize Sensitivity Analyzer
 
         Parameters
         ----------
-        tf_session : tf.Session
         evaluator : AutocompleteEvaluator
-        variables : list of tf.Tensor or None
+        variables : list of str or None
+            Names of the variables to analyze, defaults to all variables
+            of the evaluator's score source.
         width : Number of points to evaluate per variable
         """
-        self.tf_session = tf_session
         self.evaluator = evaluator
+        self.score_source = evaluator.score_source
         if not variables:
-            variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+            variables = self.score_source.variable_names
         self.variables = variables
         self.width = width
-        self.assign_var = tf.placeholder(shape=(), dtype=tf.float32)
-        self.assign_ops = {var.name: var.assign(self.assign_var) for var in self.variables}
-
-    def _assign_value(self, var_name, value):
-        self.tf_session.run(self.assign_ops[var_name], {
-            self.assign_var: value,
-        })
 
     def evaluate(self):
         var_reports = {}
-        for variable in self.variables:
-            initial_value = self.tf_session.run(variable)
+        initial_values = self.score_source.get_values()
+        for var_name in self.variables:
+            initial_value = initial_values[var_name]
             start_value = max(np.abs(initial_value/100), .01)
             base_space = np.geomspace(start_value, np.abs(initial_value), self.width // 2)
             space = np.hstack((initial_value + base_space, [initial_value], initial_value - base_space))
-            reports = []
-            for test_value in space:
-                self._assign_value(variable.name, test_value)
-                reports.append(self.evaluator.evaluate())
-            self._assign_value(variable.name, initial_value)
-            var_reports[variable.name] = reports
+            # All values of a variable are evaluated in a single pass
+            var_reports[var_name] = self.evaluator.evaluate_batch([
+                {var_name: test_value} for test_value in space])
         return SensitivityReport(var_reports)
 
 
 class HyperoptOptimizer(object):
-    def __init__(self, tf_session, evaluator, variables, train_dataset, seed):
-        self.tf_session = tf_session
+    def __init__(self, evaluator, variables, train_dataset, seed, candidates_per_pass=1):
+        """Initialize Hyperopt Optimizer
+
+        Parameters
+        ----------
+        evaluator : AutocompleteEvaluator
+        variables : list of str or None
+            Names of the variables to tune, defaults to all variables of
+            the evaluator's score source.
+        train_dataset : str
+            Name of the evaluator dataset to minimize the loss of.
+        seed : int
+        candidates_per_pass : int
+            Number of candidates suggested by tpe from the same trial
+            history and evaluated together in a single pass over the hits,
+            at least 1.
+        """
+        if candidates_per_pass < 1:
+            raise ValueError('candidates_per_pass must be at least 1, got {}'.format(candidates_per_pass))
         self.evaluator = evaluator
+        self.score_source = evaluator.score_source
         if not variables:
-            variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
-        self.variables = {var.name: var for var in variables}
+            variables = self.score_source.variable_names
+        self.variables = list(variables)
         self.train_dataset = train_dataset
         self.seed = seed
-        self.assign_var = tf.placeholder(shape=(), dtype=tf.float32)
-        self.assign_ops = {var.name: var.assign(self.assign_var) for var in self.variables.values()}
+        self.candidates_per_pass = candidates_per_pass
 
     def _assign_values(self, values):
-        for var_name, value in values.items():
-            self.tf_session.run(self.assign_ops[var_name], {
-                self.assign_var: value,
-            })
+        self.score_source.assign(values)
 
-    def _evaluate(self, values):
-        self._assign_values(values)
-        report = self.evaluator.evaluate()
+    def _result(self, report):
         return {
             'status': hyperopt.STATUS_OK,
             'loss': report[self.train_dataset].mean,
             'attachments': {'report': report},
         }
 
+    def _evaluate(self, values):
+        self._assign_values(values)
+        return self._result(self.evaluator.evaluate())
+
+    def _suggest(self, domain, trials, n, R):
+        """Insert n new trials suggested by tpe from the completed trials"""
+        new_ids = trials.new_trial_ids(n)
+        trials.refresh()
+        docs = []
+        for new_id in new_ids:
+            # tpe suggests a single trial per call, pending trials are
+            # not part of its history so each call sees the same trials.
+            docs.extend(hyperopt.tpe.suggest([new_id], domain, trials, R.randint(2 ** 31 - 1)))
+        # Inserted docs are copies, return the trials to be updated
+        tids = set(trials.insert_trial_docs(docs))
+        trials.refresh()
+        return [trial for trial in trials.trials if trial['tid'] in tids]
+
+    def _run_trials(self, tune_space, epochs, R):
+        """Evaluate epochs trials, candidates_per_pass at a time
+
+        The batched equivalent of hyperopt.fmin.
+        """
+        trials = hyperopt.Trials()
+        domain = hyperopt.base.Domain(self._evaluate, tune_space)
+        while len(trials.trials) < epochs:
+            n = min(self.candidates_per_pass, epochs - len(trials.trials))
+            docs = self._suggest(domain, trials, n, R)
+            candidates = [hyperopt.space_eval(tune_space, hyperopt.base.spec_from_misc(doc['misc']))
+                          for doc in docs]
+            reports = self.evaluator.evaluate_batch(candidates)
+            for doc, report in zip(docs, reports):
+                result = self._result(report)
+                ctrl = hyperopt.base.Ctrl(trials, current_trial=doc)
+                for key, value in result.pop('attachments').items():
+                    ctrl.attachments[key] = value
+                doc['state'] = hyperopt.JOB_STATE_DONE
+                doc['result'] = result
+            trials.refresh()
+        return trials
+
     def _make_tune_space(self, best_values):
         from hyperopt import hp
         tune_space = {}
@@ -485,23 +866,120 @@ class HyperoptOptimizer(object):
         return tune_space
 
     def minimize(self, restarts=2, epochs=600, tune_space=None):
-        from hyperopt import fmin, tpe, Trials
         if tune_space is None:
-            initial_values = self.tf_session.run(self.variables)
-            tune_space = self._make_tune_space(initial_values)
+            initial_values = self.score_source.get_values()
+            tune_space = self._make_tune_space({k: initial_values[k] for k in self.variables})
         # TODO: This report structure has the downside of not writing
         # anything to disk until it's 100% complete.
         reports = []
         # Make minimize deterministic
         R = np.random.RandomState(self.seed)
         for restarts in range(restarts):
-            trials = Trials()
-            best = fmin(fn=self._evaluate,
-                        space=tune_space,
-                        algo=tpe.suggest,
-                        max_evals=epochs,
-                        trials=trials,
-                        rstate=R)
+            trials = self._run_trials(tune_space, epochs, R)
+            best = hyperopt.space_eval(tune_space, trials.argmin)
             self._assign_values(best)
             reports.extend(trials.trial_attachments(t)['report'] for t in trials.trials)
         return self.evaluator.make_agg_report(reports)
+
+
+class HyperbandOptimizer(HyperoptOptimizer):
+    def __init__(self, evaluator, variables, train_dataset, seed, eta=3, min_fraction=1 / 27):
+        """Initialize Hyperband Optimizer
+
+        Candidates sampled from the tune space race by successive
+        halving. Each round evaluates the remaining candidates on a
+        stratified subsample of the train dataset, see
+        AutocompleteEvaluator.subsample, and promotes the best 1 / eta of
+        them to a subsample eta times larger. The last round evaluates on
+        all hits and datasets. Brackets of races hedge between many
+        candidates starting on tiny subsamples and few starting larger.
+
+        Parameters
+        ----------
+        evaluator : AutocompleteEvaluator
+        variables : list of str or None
+            Names of the variables to tune, defaults to all variables of
+            the evaluator's score source.
+        train_dataset : str
+            Name of the evaluator dataset to minimize the loss of.
+        seed : int
+        eta : int
+            Reduction factor between rounds of successive halving, at
+            least 2.
+        min_fraction : float
+            Share of the train search terms in the smallest subsample,
+            greater than 0 and at most 1.
+        """
+        if eta < 2:
+            raise ValueError('eta must be at least 2, got {}'.format(eta))
+        if not 0 < min_fraction <= 1:
+            raise ValueError('min_fraction must be in (0, 1], got {}'.format(min_fraction))
+        super(HyperbandOptimizer, self).__init__(evaluator, variables, train_dataset, seed)
+        self.eta = eta
+        self.min_fraction = min_fraction
+        self.subsamples = {}
+
+    @property
+    def num_rounds(self):
+        """Rounds of successive halving in the most aggressive bracket"""
+        # Epsilon guards powers of eta, such as 1 / 27, against rounding down
+        return int(np.floor(np.log(1 / self.min_fraction) / np.log(self.eta) + 1e-9)) + 1
+
+    def brackets(self, epochs):
+        """Number of rounds and of initial candidates of each bracket
+
+        Splits about epochs candidates over the brackets in the
+        proportions of hyperband, which spends a similar budget on each.
+        """
+        num_rounds = self.num_rounds
+        rounds = list(range(num_rounds, 0, -1))
+        weights = np.asarray([num_rounds / r * self.eta ** (r - 1) for r in rounds])
+        sizes = np.maximum(1, np.round(epochs * weights / weights.sum())).astype(int)
+        return list(zip(rounds, sizes.tolist()))
+
+    def _subsample(self, fraction):
+        if fraction >= 1:
+            return self.evaluator
+        # Subsamples are shared by brackets, and drawn independently of
+        # the candidates so all brackets race on the same data.
+        if fraction not in self.subsamples:
+            R = np.random.RandomState(self.seed + len(self.subsamples))
+            self.subsamples[fraction] = self.evaluator.subsample(fraction, R, self.train_dataset)
+        return self.subsamples[fraction]
+
+    def _successive_halving(self, candidates, rounds, budget):
+        """Race candidates over rounds, returning full reports of the finalists"""
+        for i in range(rounds):
+            evaluator = self._subsample(float(self.eta) ** (i + 1 - rounds))
+            reports = evaluator.evaluate_batch(candidates)
+            budget['hit_evaluations'] += len(candidates) * evaluator.num_hits
+            if i == rounds - 1:
+                return reports
+            losses = [report[self.train_dataset].mean for report in reports]
+            promote = np.argsort(losses, kind='stable')[:max(1, len(candidates) // self.eta)]
+            log.info('promoting %d of %d candidates from %d hits', len(promote), len(candidates), evaluator.num_hits)
+            candidates = [candidates[j] for j in promote]
+
+    def minimize(self, restarts=2, epochs=600, tune_space=None):
+        if tune_space is None:
+            initial_values = self.score_source.get_values()
+            tune_space = self._make_tune_space({k: initial_values[k] for k in self.variables})
+        R = np.random.RandomState(self.seed)
+        start = time.time()
+        budget = {'candidates': 0, 'hit_evaluations': 0}
+        reports = []
+        for _ in range(restarts):
+            for rounds, size in self.brackets(epochs):
+                candidates = [hyperopt.pyll.stochastic.sample(tune_space, rng=R) for _ in range(size)]
+                budget['candidates'] += size
+                reports.extend(self._successive_halving(candidates, rounds, budget))
+        best = min(reports, key=lambda report: report[self.train_dataset].mean)
+        self._assign_values({k: best.variables[k] for k in self.variables})
+
+        # Compared to evaluating every candidate on all hits
+        budget['full_hit_evaluations'] = budget['candidates'] * self.evaluator.num_hits
+        budget['saved'] = 1 - budget['hit_evaluations'] / budget['full_hit_evaluations']
+        budget['took_sec'] = time.time() - start
+        log.info('evaluated %d candidates with %.1f%% fewer hit evaluations in %.1fs',
+                 budget['candidates'], 100 * budget['saved'], budget['took_sec'])
+        return self.evaluator.make_agg_report(reports, budget=budget)